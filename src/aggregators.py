@@ -1,5 +1,18 @@
+from functools import lru_cache
 from flask import g, current_app
-from schema import get_security_enabled_fields
+from schema import get_security_descriptor
+
+# Aggregation variables holding the requesting user's permissions. Templates reference these; bind_user_context
+# supplies their values for each request.
+USER_CAT = '$$userCat'
+USER_DISS = '$$userDiss'
+
+# (resource, engine) -> (descriptor the template was built from, template stages)
+_redaction_templates = {}
+
+
+class UserBoundStage(dict):
+    """Marks a template stage whose expression refers to $$userCat / $$userDiss and must be bound per request."""
 
 
 def handle_id_match_wildcard(pipeline):
@@ -22,13 +35,76 @@ def add_ascl_redaction(endpoint, pipeline):
     current_app.logger.debug('Setting up redaction pipeline for {}'.format(endpoint))
 
     pipeline = handle_id_match_wildcard(pipeline)
-    sec_fields = get_security_enabled_fields(endpoint)
+    if current_app.config.get('REDACTION_PREFILTER') == "True":
+        insert_after_match(pipeline, [security_prefilter()])
+    pipeline.extend(bind_user_context(redaction_template(endpoint)))
+
+    current_app.logger.debug('Pipeline: {}'.format(pipeline))
+
+
+def insert_after_match(pipeline, stages):
+    """Insert stages after the $match stages at the start of the pipeline (and before any redaction)."""
+    position = 0
+    while position < len(pipeline) and '$match' in pipeline[position]:
+        position += 1
+    pipeline[position:position] = stages
+    return pipeline
+
+
+def security_prefilter():
+    """
+    $match on the document-level label, so documents the user can never see are dropped before $redact, using an
+    index on _sec.cat where one exists. Equivalent to the document-level check in $redact: the category must be one
+    of the user's categories and no dissemination rule may be missing from the user's rules.
+    """
+    return {"$match": label_filter('')}
+
+
+def label_filter(path):
+    """
+    Query conditions that the user satisfies the _sec label of the field at path ("" for the document): the same
+    rules as the match fields of redact_field, as a query that can be used in a $match or the filter of a write.
+    """
+    prefix = '{}.'.format(path) if path else ''
+    return {
+        "{}_sec.cat".format(prefix): {"$in": list(getattr(g, '_cat', []))},
+        "{}_sec.diss".format(prefix): {"$not": {"$elemMatch": {"$nin": list(getattr(g, '_diss', []))}}}
+    }
+
+
+def redaction_template(endpoint):
+    """
+    Get the redaction stages for a resource, building them once per security descriptor. The stages refer to the
+    user's permissions only through the $$userCat and $$userDiss variables, so the same template serves every user.
+
+    REDACTION_ENGINE selects the stages: "legacy" marks each secured field with $addFields, redacts on the marks and
+    projects them away; "single_pass" evaluates every _sec label inline in one $redact.
+    """
+    engine = current_app.config.get('REDACTION_ENGINE', 'legacy')
+    descriptor = get_security_descriptor(endpoint)
+    cached = _redaction_templates.get((endpoint, engine))
+    if cached is not None and cached[0] is descriptor:
+        return cached[1]
+
+    if engine == 'single_pass':
+        template = unlabelled_field_stages(descriptor) + (single_pass_redact_stage(),)
+    else:
+        template = legacy_redaction_stages(descriptor)
+    _redaction_templates[(endpoint, engine)] = (descriptor, template)
+    return template
+
+
+def legacy_redaction_stages(descriptor):
+    """Stages that mark, redact and strip match fields for each secured (non-array) field."""
+    # $addFields can't address individual elements of an array of subdocuments, so only non-array fields apply here
+    sec_fields = descriptor.field_paths(include_arrays=False)
+    stages = []
     for field in sec_fields:
-        pipeline = redact_field(field, pipeline)
+        stages.extend(redact_field_template(field))
 
     # Redact removes any item that contains "false" in cat_matches or diss_matches (including nested items)
-    pipeline.append(redact_logical_AND("$cat_matches"))
-    pipeline.append(redact_logical_AND("$diss_matches"))
+    stages.append(redact_logical_AND("$cat_matches"))
+    stages.append(redact_logical_AND("$diss_matches"))
 
     metadata_fields = []
 
@@ -38,9 +114,87 @@ def add_ascl_redaction(endpoint, pipeline):
             field = '{}.'.format(field)
         metadata_fields.append("{}cat_matches".format(field))
         metadata_fields.append("{}diss_matches".format(field))
-    pipeline.append(remove_metadata_fields(metadata_fields))
+    stages.append(remove_metadata_fields(metadata_fields))
+    return tuple(stages)
 
-    current_app.logger.debug('Pipeline: {}'.format(pipeline))
+
+def unlabelled_field_stages(descriptor):
+    """
+    Stages that remove each secured (non-array) field the schema declares but that has no _sec label, as the legacy
+    stages do. Deeper fields go first, so removing one never recreates its parent.
+    """
+    fields = sorted((field for field in descriptor.fields if field.path and not field.in_array),
+                    key=lambda field: -field.depth)
+    return tuple({
+        "$addFields": {
+            field.path: {
+                "$cond": {
+                    "if": {"$eq": [{"$type": "${}._sec".format(field.path)}, "missing"]},
+                    "then": "$$REMOVE",
+                    "else": "${}".format(field.path)
+                }
+            }
+        }
+    } for field in fields)
+
+
+def single_pass_redact_stage():
+    """
+    One $redact that checks the _sec label of the document and of every subdocument (including array elements) as it
+    descends: a level with a _sec label is kept only if its cat is one of the user's categories and all of its diss
+    rules are among the user's dissemination rules. Levels without a _sec label are kept, except the document itself,
+    which must be labelled; secured fields the schema declares without a label are removed before this stage by
+    unlabelled_field_stages. No match fields are written, so nothing has to be projected away afterwards.
+
+    Unlike the legacy stages, a subdocument is only checked where it carries a _sec label, whether or not the schema
+    declares one for it, and elements of arrays are checked too.
+    """
+    return UserBoundStage({
+        "$redact": {
+            "$cond": {
+                "if": {"$eq": [{"$type": "$_sec"}, "missing"]},
+                "then": {
+                    "$cond": {
+                        # Only the document itself has the root's _id
+                        "if": {"$eq": ["$_id", "$$ROOT._id"]},
+                        "then": "$$PRUNE",
+                        "else": "$$DESCEND"
+                    }
+                },
+                "else": {
+                    "$cond": {
+                        "if": {
+                            "$and": [
+                                {"$setIsSubset": [["$_sec.cat"], USER_CAT]},
+                                {"$setIsSubset": [{"$ifNull": ["$_sec.diss", []]}, USER_DISS]}
+                            ]
+                        },
+                        "then": "$$DESCEND",
+                        "else": "$$PRUNE"
+                    }
+                }
+            }
+        }
+    })
+
+
+def bind_user_context(template):
+    """
+    Bind the current user's permissions (g._cat, g._diss) to a template. The expressions of UserBoundStage stages are
+    wrapped in a $let that defines $$userCat and $$userDiss; the template expressions themselves are shared, not
+    copied, so they must never be modified.
+    """
+    user_vars = {"userCat": getattr(g, '_cat', []), "userDiss": getattr(g, '_diss', [])}
+    stages = []
+    for stage in template:
+        if isinstance(stage, UserBoundStage):
+            if '$addFields' in stage:
+                stage = {"$addFields": {name: {"$let": {"vars": user_vars, "in": expr}}
+                                        for name, expr in stage['$addFields'].items()}}
+            else:
+                stage = {op: {"$let": {"vars": user_vars, "in": expr}} for op, expr in stage.items()}
+        stages.append(stage)
+    return stages
 
 
 def redact_field(path, pipeline):
@@ -48,14 +202,21 @@ def redact_field(path, pipeline):
         Adds a redaction step to the aggregation pipeline for a given security enabled field (fields that contain
         the _sec label).
     """
+    pipeline.extend(bind_user_context(redact_field_template(path)))
+    return pipeline
+
+
+@lru_cache(maxsize=None)
+def redact_field_template(path):
+    """Unbound stages that mark whether the user satisfies the _sec rules of the field at path."""
     if path != "" and path is not None:
         path = '{}.'.format(path)
-    pipeline.append(add_match_field_non_array("{}cat_matches".format(path), "${}_sec.cat".format(path), "_cat"))
-    pipeline.append(add_match_field("{}diss_matches".format(path), "${}_sec.diss".format(path), "_diss"))
-    return pipeline
+    return (UserBoundStage(add_match_field_non_array("{}cat_matches".format(path), "${}_sec.cat".format(path),
+                                                     USER_CAT)),
+            UserBoundStage(add_match_field("{}diss_matches".format(path), "${}_sec.diss".format(path), USER_DISS)))
 
 
-def add_match_field_non_array(new_field_name, rule_field_name, user_context_attrib):
+def add_match_field_non_array(new_field_name, rule_field_name, user_perms):
     """
         Given a set of rules a user passes, checks a specified field with a list of rules and adds a new field
         with a boolean value representing whether all rules in the database field are present in the list of
@@ -67,10 +228,10 @@ def add_match_field_non_array(new_field_name, rule_field_name, user_context_attr
                             - e.g. "dist_matches"
         rule_field_name     - the field that contains the list of rules
                             - e.g. "$__ascl._diss.DISTRIBUTION"
-        user_context_attrib - the attribute of user context to be checked against the list of rules in rule_field_name
-                            - e.g. "_cat"
+        user_perms          - expression for the user permissions to be checked against the list of rules in
+                              rule_field_name
+                            - e.g. "$$userCat"
     """
-    user_perms = getattr(g, user_context_attrib, [])
     stage = {
         "$addFields": {
             new_field_name: {
@@ -97,7 +258,7 @@ def add_match_field_non_array(new_field_name, rule_field_name, user_context_attr
     return stage
 
 
-def add_match_field(new_field_name, rule_field_name, user_context_attrib):
+def add_match_field(new_field_name, rule_field_name, user_perms):
     """
         Given a set of rules a user passes, checks a specified field with a list of rules and adds a new field
         with a boolean value representing whether all rules in the database field are present in the list of
@@ -109,10 +270,10 @@ def add_match_field(new_field_name, rule_field_name, user_context_attrib):
                             - e.g. "dist_matches"
         rule_field_name     - the field that contains the list of rules
                             - e.g. "$__ascl._diss.DISTRIBUTION"
-        user_context_attrib - the attribute of user context to be checked against the list of rules in rule_field_name
-                            - e.g. "_diss"
+        user_perms          - expression for the user permissions to be checked against the list of rules in
+                              rule_field_name
+                            - e.g. "$$userDiss"
     """
-    user_perms = getattr(g, user_context_attrib, [])
     stage = {
         "$addFields": {
             new_field_name: {
@@ -0,0 +1,261 @@
+import copy
+import json
+import uuid
+from datetime import datetime
+from functools import wraps
+
+from bson import ObjectId
+from flask import g, request, current_app, abort, Response
+from pymongo import ReturnDocument
+from eve.methods.common import serialize, resolve_document_etag, last_updated, date_created
+from eve.methods.patch import resolve_nested_documents
+from eve.utils import document_etag
+from aggregators import label_filter
+from auth import require_auth, check_insert_data_context, check_insert_access
+from schema import get_security_descriptor
+from mongo import get_db
+from request_body import request_body
+from update import make_batch_perm_check_pipeline, has_doc_perms, has_field_perms, strip_perm_check_fields
+
+def install_atomic_writes(app):
+    """
+    Serve PATCH and DELETE on the items of every <resource>_write resource with atomic_write, by wrapping the view
+    function Eve registered for the item url. Other methods still go to Eve.
+    """
+    for resource in app.config['DOMAIN']:
+        endpoint = '{}|item_lookup'.format(resource)
+        if resource.endswith('_write') and endpoint in app.view_functions:
+            app.view_functions[endpoint] = atomic_item_endpoint(resource, app.view_functions[endpoint])
+
+
+def atomic_item_endpoint(resource, view):
+    @wraps(view)
+    def endpoint(**lookup):
+        if request.method not in ('PATCH', 'DELETE'):
+            return view(**lookup)
+        return atomic_write(resource, **lookup)
+    return endpoint
+
+
+def atomic_write(resource, **lookup):
+    """
+    PATCH or DELETE one document with a single find_one_and_update / find_one_and_delete. The user's permissions on
+    the document and on the security-enabled fields being changed (all of them for DELETE), and the If-Match etag, are
+    conditions of the write's filter, so they are checked by the same operation that writes and nothing can change
+    between the check and the write. Only when the filter matches nothing does one more query (read_original) find out
+    why: 404 (no such document), 403 (insufficient permissions) or 412 (etag mismatch).
+
+    Some features need the document before it is written, and then it is read first (see needs_original): Eve's
+    on_update / on_delete_item hooks get it, and the etag a PATCH stores is a hash of the updated document, as in Eve
+    (unless ATOMIC_WRITES_ETAG is "token"). The write is then filtered on the document being unchanged since the read,
+    and a miss is answered without retrying, so hooks run once per request.
+
+    Eve's pre-request hooks (and check_perms_in_db) don't run; the new labels of a PATCH are checked with
+    check_insert_data_context and check_insert_access as before.
+    """
+    config = current_app.config
+    resource_def = config['DOMAIN'][resource]
+    require_auth(resource, request.method)
+
+    oid = lookup.get(resource_def.get('item_lookup_field', config['ID_FIELD']))
+    if not ObjectId.is_valid(oid):
+        abort(404)
+    oid = ObjectId(oid)
+
+    if_match = request.headers.get('If-Match')
+    if_match = if_match.replace('"', '') if if_match else None
+    if config.get('IF_MATCH') and config.get('ENFORCE_IF_MATCH') and not if_match:
+        abort(428, description='To edit a document its etag must be provided using the If-Match header')
+
+    sec_enabled_fields = get_security_descriptor(resource[:-6]).field_paths(include_arrays=False)
+    if request.method == 'PATCH':
+        return atomic_update(resource, oid, if_match, sec_enabled_fields)
+    return atomic_delete(resource, oid, if_match, sec_enabled_fields)
+
+
+def atomic_update(resource, oid, if_match, sec_enabled_fields):
+    config = current_app.config
+    resource_def = config['DOMAIN'][resource]
+    check_insert_data_context(resource, request)
+    check_insert_access(resource, request)
+
+    payload = request_body()
+    fields = [key for key in payload if key in sec_enabled_fields]
+    original = None
+    if needs_original(resource, 'on_update'):
+        original = read_original(resource, oid, if_match, fields)
+
+    updates = serialize(copy.deepcopy(payload), resource=resource)
+    validator = current_app.validator(resource_def['schema'], resource=resource)
+    if not validator.validate_update(updates, oid, original):
+        return json_response({config['STATUS']: config['STATUS_ERR'], config['ISSUES']: validator.errors},
+                             config['VALIDATION_ERROR_STATUS'])
+    updates = validator.document
+    updates[config['LAST_UPDATED']] = datetime.utcnow().replace(microsecond=0)
+
+    if original is not None:
+        # As Eve's patch_internal: hooks see the original, and the etag is a hash of the merged document
+        updated = copy.deepcopy(original)
+        getattr(current_app, 'on_update')(resource, updates, original)
+        getattr(current_app, 'on_update_{}'.format(resource))(updates, original)
+        if resource_def.get('merge_nested_documents'):
+            updates = resolve_nested_documents(updates, updated)
+        updated.update(updates)
+        if config.get('IF_MATCH'):
+            resolve_document_etag(updated, resource)
+            updates[config['ETAG']] = updated[config['ETAG']]
+        changes = {"$set": updates}
+    else:
+        if config.get('IF_MATCH'):
+            # ATOMIC_WRITES_ETAG is "token": the updated document isn't read, so its etag is a fresh token
+            updates[config['ETAG']] = uuid.uuid4().hex
+        changes = {"$set": set_paths(updates) if resource_def.get('merge_nested_documents') else updates}
+
+    def write(condition):
+        return collection(resource).find_one_and_update(
+            write_filter(oid, fields, condition), changes, return_document=ReturnDocument.BEFORE)
+
+    original = write_once(write, resource, oid, if_match, fields, original)
+
+    getattr(current_app, 'on_updated')(resource, updates, original)
+    getattr(current_app, 'on_updated_{}'.format(resource))(updates, original)
+
+    response = {
+        config['STATUS']: config['STATUS_OK'],
+        config['ID_FIELD']: oid,
+        config['LAST_UPDATED']: updates[config['LAST_UPDATED']],
+        config['DATE_CREATED']: date_created(original)
+    }
+    headers = {}
+    if config['ETAG'] in updates:
+        response[config['ETAG']] = updates[config['ETAG']]
+        headers['ETag'] = '"{}"'.format(updates[config['ETAG']])
+    return json_response(response, 200, headers)
+
+
+def atomic_delete(resource, oid, if_match, sec_enabled_fields):
+    original = None
+    if needs_original(resource, 'on_delete_item'):
+        original = read_original(resource, oid, if_match, sec_enabled_fields)
+        getattr(current_app, 'on_delete_item')(resource, original)
+        getattr(current_app, 'on_delete_item_{}'.format(resource))(original)
+
+    def write(condition):
+        return collection(resource).find_one_and_delete(write_filter(oid, sec_enabled_fields, condition))
+
+    original = write_once(write, resource, oid, if_match, sec_enabled_fields, original)
+
+    getattr(current_app, 'on_deleted_item')(resource, original)
+    getattr(current_app, 'on_deleted_item_{}'.format(resource))(original)
+    return Response(status=204)
+
+
+def needs_original(resource, event):
+    """
+    Whether the document has to be read before it is written: hooks are registered for the pre-write event (or its
+    per-resource variant), or a PATCH has to store a content-hash etag. This costs a round trip, so it's only done
+    when something uses the document.
+    """
+    config = current_app.config
+    if event == 'on_update' and config.get('IF_MATCH') and config.get('ATOMIC_WRITES_ETAG', 'content') == 'content':
+        return True
+    return bool(len(getattr(current_app, event)) or len(getattr(current_app, '{}_{}'.format(event, resource))))
+
+
+def write_once(write, resource, oid, if_match, fields, original=None):
+    """
+    Run the write, conditional on the If-Match etag or, when the document was read first, on it being unchanged since.
+    Returns the document as it was before the write. When the write matches nothing, read_original aborts with the
+    reason. Otherwise the document changed in the meantime (412), or it predates stored etags and the write is retried
+    once with its etag condition met the way Eve computes it.
+    """
+    config = current_app.config
+    result = write(unchanged_filter(original) if original is not None else etag_filter(if_match))
+    if result is not None:
+        return result
+
+    current = read_original(resource, oid, if_match, fields)
+    if original is None and if_match is not None and config.get('IF_MATCH') and config['ETAG'] not in current:
+        result = write({config['ETAG']: {"$exists": False}})
+    if result is None:
+        abort(412, description='The document changed while it was being written')
+    return result
+
+
+def read_original(resource, oid, if_match, fields):
+    """
+    Read the document with the perm check pipeline and abort with 404, 403 or 412 (If-Match doesn't match its etag,
+    computed as Eve does for documents written before etags were stored).
+    """
+    config = current_app.config
+    docs = list(collection(resource).aggregate(make_batch_perm_check_pipeline([oid], fields)))
+    if not docs:
+        abort(404)
+
+    original = docs[0]
+    if not has_doc_perms(original) or not all(has_field_perms(key, original) for key in fields):
+        current_app.logger.info('User {} has insufficient permissions to modify data in the {} object'.format(
+            g.user, resource[:-6]))
+        abort(403)
+
+    original = strip_perm_check_fields(original, fields)
+    if if_match is not None and config.get('IF_MATCH') and if_match != current_etag(resource, original):
+        abort(412, description='Client and server etags don\'t match')
+    return original
+
+
+def current_etag(resource, original):
+    config = current_app.config
+    if config['ETAG'] in original:
+        return original[config['ETAG']]
+    document = dict(original)
+    document[config['LAST_UPDATED']] = last_updated(original)
+    document[config['DATE_CREATED']] = date_created(original)
+    return document_etag(document, ignore_fields=config['DOMAIN'][resource].get('etag_ignore_fields'))
+
+
+def write_filter(oid, fields, condition):
+    """The document by id, if the user may change it and the fields being written, and it meets condition."""
+    conditions = [{"_id": oid}, label_filter('')]
+    conditions.extend(label_filter(key) for key in fields)
+    if condition:
+        conditions.append(condition)
+    return {"$and": conditions}
+
+
+def etag_filter(if_match):
+    if if_match is None or not current_app.config.get('IF_MATCH'):
+        return None
+    return {current_app.config['ETAG']: if_match}
+
+
+def unchanged_filter(original):
+    """The document has the stored etag it was read with or, if it has none, the same last updated time."""
+    config = current_app.config
+    if config['ETAG'] in original:
+        return {config['ETAG']: original[config['ETAG']]}
+    return {config['ETAG']: {"$exists": False}, config['LAST_UPDATED']: original.get(config['LAST_UPDATED'])}
+
+
+def set_paths(updates, prefix=''):
+    """
+    Dotted $set paths for the values in updates, so nested documents are merged with the stored ones (as Eve's
+    MERGE_NESTED_DOCUMENTS does) without reading them first.
+    """
+    paths = {}
+    for key, value in updates.items():
+        if isinstance(value, dict) and value:
+            paths.update(set_paths(value, '{}{}.'.format(prefix, key)))
+        else:
+            paths['{}{}'.format(prefix, key)] = value
+    return paths
+
+
+def collection(resource):
+    source = current_app.config['DOMAIN'][resource].get('datasource', {}).get('source', resource)
+    return get_db()[source]
+
+
+def json_response(body, status, headers=None):
+    return Response(json.dumps(body, cls=current_app.data.json_encoder_class), status=status, headers=headers,
+                    mimetype='application/json')
@@ -0,0 +1,209 @@
+import os
+import abc
+import json
+import time
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+_cache = None
+_cache_key = None
+_cache_lock = threading.Lock()
+
+
+class AttachmentCache(abc.ABC):
+    """
+    Byte-budgeted LRU cache of decoded attachment content, keyed by S3 key and stored with the object's ETag so
+    entries can be revalidated with a conditional GET. Subclasses decide where the content is kept.
+
+    The cache holds object content only; it sits below redaction, so whether a user may see an attachment is still
+    decided for every request.
+    """
+
+    def __init__(self, max_bytes, max_item_bytes, fresh_seconds=0):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.fresh_seconds = fresh_seconds
+        self._index = OrderedDict()  # key -> (etag, size, stored_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "revalidated": 0, "stale": 0, "evictions": 0}
+
+    def lookup(self, key):
+        """Return (etag, data, fresh) for a cached key, or None. `fresh` entries may be served without revalidating."""
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self._index.move_to_end(key)
+        data = self.load(key, entry[0])
+        if data is None:
+            # Content went missing or was replaced underneath us (e.g. a file removed from the disk tier)
+            self.discard(key)
+            with self._lock:
+                self.counters["misses"] += 1
+            return None
+        etag, size, stored_at = entry
+        return etag, data, time.monotonic() - stored_at < self.fresh_seconds
+
+    def put(self, key, etag, data):
+        size = len(data.encode('utf-8')) if isinstance(data, str) else len(data)
+        if etag is None or size > self.max_item_bytes:
+            return
+        # Content is stored with its etag and load checks it, so the I/O can happen outside the lock: if puts of a
+        # key race, a lookup that finds content and index disagreeing is a miss, never the wrong content
+        self.store(key, etag, data)
+        evicted = []
+        with self._lock:
+            entry = self._index.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+            self._index[key] = (etag, size, time.monotonic())
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._index:
+                old_key, (_, old_size, _) = self._index.popitem(last=False)
+                self._bytes -= old_size
+                self.counters["evictions"] += 1
+                evicted.append(old_key)
+        for old_key in evicted:
+            self.remove(old_key)
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._index.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+        if entry is not None:
+            self.remove(key)
+
+    def record(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats.update({"entries": len(self._index), "bytes": self._bytes, "max_bytes": self.max_bytes})
+        return stats
+
+    @abc.abstractmethod
+    def load(self, key, etag):
+        """The content stored for key, if it is the content with this etag, or None."""
+
+    @abc.abstractmethod
+    def store(self, key, etag, data):
+        pass
+
+    @abc.abstractmethod
+    def remove(self, key):
+        pass
+
+
+class MemoryAttachmentCache(AttachmentCache):
+    def __init__(self, *args, **kwargs):
+        super(MemoryAttachmentCache, self).__init__(*args, **kwargs)
+        self._data = {}
+
+    def load(self, key, etag):
+        stored = self._data.get(key)
+        return stored[1] if stored is not None and stored[0] == etag else None
+
+    def store(self, key, etag, data):
+        self._data[key] = (etag, data)
+
+    def remove(self, key):
+        self._data.pop(key, None)
+
+
+class DiskAttachmentCache(AttachmentCache):
+    """
+    Keeps content in files under a subdirectory of its own (named for the worker's pid), since each worker indexes and
+    evicts entries on its own. Disk use is up to max_bytes per worker. Subdirectories of workers that are gone are
+    removed when a worker starts.
+    """
+
+    def __init__(self, directory, *args, **kwargs):
+        super(DiskAttachmentCache, self).__init__(*args, **kwargs)
+        remove_stale_dirs(directory)
+        self.directory = os.path.join(directory, str(os.getpid()))
+        # Left over from an earlier process with the same pid, and not in this worker's index
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def load(self, key, etag):
+        try:
+            with open(self.path(key)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        return entry.get('data') if entry.get('key') == key and entry.get('etag') == etag else None
+
+    def store(self, key, etag, data):
+        # Write to a temporary file and rename, so other workers never read a partial entry
+        path = self.path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': key, 'etag': etag, 'data': data}, f)
+        os.replace(tmp_path, path)
+
+    def remove(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+
+def remove_stale_dirs(directory):
+    """Remove the cache subdirectories of worker processes that no longer exist."""
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        if not name.isdigit() or int(name) == os.getpid():
+            continue
+        try:
+            os.kill(int(name), 0)
+        except ProcessLookupError:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+        except OSError:
+            pass  # Exists, but belongs to another user
+
+
+def get_attachment_cache():
+    """Return this worker's attachment cache per the ATTACHMENT_CACHE settings, or None if caching is off."""
+    global _cache, _cache_key
+
+    config = current_app.config
+    mode = config.get('ATTACHMENT_CACHE', 'off')
+    if mode not in ('memory', 'disk'):
+        return None
+
+    max_bytes = int(config.get('ATTACHMENT_CACHE_BYTES', 64 * 1024 * 1024))
+    settings = (os.getpid(), mode, max_bytes, config.get('ATTACHMENT_CACHE_DIR'))
+    if _cache is not None and _cache_key == settings:
+        return _cache
+
+    with _cache_lock:
+        if _cache is None or _cache_key != settings:
+            args = (max_bytes, int(config.get('ATTACHMENT_CACHE_MAX_ITEM_BYTES', max_bytes // 8)),
+                    float(config.get('ATTACHMENT_CACHE_FRESH_SECONDS', 0)))
+            if mode == 'disk':
+                _cache = DiskAttachmentCache(config.get('ATTACHMENT_CACHE_DIR', '/tmp/charon-attachments'), *args)
+            else:
+                _cache = MemoryAttachmentCache(*args)
+            _cache_key = settings
+    return _cache
+
+
+def attachment_cache_stats():
+    if _cache is None or _cache_key[0] != os.getpid():
+        return {}
+    return _cache.stats()
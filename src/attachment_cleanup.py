@@ -0,0 +1,199 @@
+import uuid
+import threading
+from datetime import datetime, timedelta
+
+from flask import current_app, g
+from pymongo import ASCENDING
+from mongo import get_db
+from object_store import get_object_store
+
+# Wakes the cleanup worker in this process when keys are queued
+_wake = threading.Event()
+
+# Counts for /_stats, per worker process
+_stats_lock = threading.Lock()
+stats = {"queued": 0, "deleted": 0, "skipped": 0, "retried": 0, "dead": 0}
+
+
+def _count(**changes):
+    with _stats_lock:
+        for name, value in changes.items():
+            stats[name] += value
+
+
+def queue_collection(config=None):
+    config = config or current_app.config
+    return get_db(config=config)[config.get('ATTACHMENT_DELETE_QUEUE', 'charon_attachment_deletions')]
+
+
+def queue_attachment_deletion(resource, original):
+    """
+    on_deleted_item hook: queue the attachment keys of a deleted document for deletion from the object store. The
+    delete itself happens on the cleanup worker, so the DELETE request doesn't wait on the object store.
+    """
+    queue_documents(resource, [original])
+
+
+def remember_deleted_documents(resource, originals, lookup):
+    """on_delete_resource_originals hook: keep the documents a resource DELETE is about to remove."""
+    g._deleted_originals = originals
+
+
+def queue_resource_deletion(resource):
+    """on_deleted_resource hook: queue the attachment keys of the documents removed by a resource DELETE."""
+    queue_documents(resource, g.pop('_deleted_originals', None) or [])
+
+
+def queue_documents(resource, originals):
+    if not current_app.config.get('S3_ATTACHMENTS') == "True" or \
+            not current_app.config.get('ATTACHMENT_CASCADE_DELETE') == "True":
+        return
+
+    now = datetime.utcnow()
+    entries = []
+    for original in originals:
+        keys = (original.get('attachments') or {}).get('documents') or []
+        entries.extend({
+            "key": key,
+            "resource": resource,
+            "document": original.get('_id'),
+            "status": "pending",
+            "attempts": 0,
+            "queued_at": now,
+            "next_attempt": now
+        } for key in keys if isinstance(key, str))
+    if not entries:
+        return
+
+    queue_collection().insert_many(entries)
+    _count(queued=len(entries))
+    _wake.set()
+
+
+def attachment_sources(config):
+    """The collections of the resources whose schema has attachments."""
+    return set(settings.get('datasource', {}).get('source', name) for name, settings in config['DOMAIN'].items()
+               if 'attachments' in settings.get('schema', {}))
+
+
+def referenced_keys(config, keys):
+    """The keys still referenced by a document in any resource (attachments can be shared between documents)."""
+    db = get_db(config=config)
+    referenced = set()
+    for source in attachment_sources(config):
+        for doc in db[source].find({"attachments.documents": {"$in": keys}}, {"attachments.documents": 1}):
+            referenced.update(key for key in (doc.get('attachments') or {}).get('documents') or [] if key in keys)
+    return referenced
+
+
+def create_indexes(config):
+    """
+    Index the deletion queue, and attachments.documents so referenced_keys doesn't scan collections. The latter
+    aren't named with indexes.INDEX_PREFIX, so security label index drift checks leave them alone.
+    """
+    queue_collection(config).create_index([("status", ASCENDING), ("next_attempt", ASCENDING)])
+    db = get_db(config=config)
+    for source in attachment_sources(config):
+        db[source].create_index([("attachments.documents", ASCENDING)], sparse=True, background=True)
+
+
+def process_batch(app):
+    """
+    Claim a batch of due queue entries, queued at least ATTACHMENT_DELETE_GRACE_SECONDS ago, and delete their keys
+    from the object store in one batched call. Keys are skipped if a document still references them. Failed keys are
+    retried with exponential backoff, and after ATTACHMENT_DELETE_MAX_ATTEMPTS are kept in the queue with status "dead"
+    and the last error, for an operator to look at. Returns the number of entries processed.
+    """
+    config = app.config
+    coll = queue_collection(config)
+    now = datetime.utcnow()
+    batch_size = int(config.get('ATTACHMENT_DELETE_BATCH', 1000))
+    claim_timeout = float(config.get('ATTACHMENT_DELETE_CLAIM_TIMEOUT', 600))
+    grace = float(config.get('ATTACHMENT_DELETE_GRACE_SECONDS', 300))
+
+    # Release entries claimed by a worker that died before finishing them
+    coll.update_many({"status": "claimed", "claimed_at": {"$lt": now - timedelta(seconds=claim_timeout)}},
+                     {"$set": {"status": "pending"}, "$unset": {"claim": ""}})
+
+    # Keys wait out the grace period, so writes in flight that reference them again have landed before the check
+    candidates = [entry['_id'] for entry in
+                  coll.find({"status": "pending", "next_attempt": {"$lte": now},
+                             "queued_at": {"$lte": now - timedelta(seconds=grace)}}, {"_id": 1}).limit(batch_size)]
+    if not candidates:
+        return 0
+
+    # Several workers run this loop; only the entries this worker manages to claim are processed here
+    claim = uuid.uuid4().hex
+    coll.update_many({"_id": {"$in": candidates}, "status": "pending"},
+                     {"$set": {"status": "claimed", "claim": claim, "claimed_at": now}})
+    entries = list(coll.find({"claim": claim}))
+    if not entries:
+        return 0
+
+    keys = list(set(entry['key'] for entry in entries))
+    referenced = referenced_keys(config, keys)
+    to_delete = [key for key in keys if key not in referenced]
+    if to_delete:
+        # Checking every source takes a while; check the keys about to go once more, right before deleting them. A
+        # document written between this check and the delete below can still lose its attachment.
+        referenced.update(referenced_keys(config, to_delete))
+        to_delete = [key for key in to_delete if key not in referenced]
+    try:
+        failed = get_object_store().delete_objects(to_delete) if to_delete else {}
+    except Exception as exc:
+        failed = dict((key, str(exc)) for key in to_delete)
+
+    done = [entry['_id'] for entry in entries if entry['key'] not in failed]
+    coll.delete_many({"_id": {"$in": done}})
+    _count(deleted=len([key for key in to_delete if key not in failed]), skipped=len(referenced))
+
+    max_attempts = int(config.get('ATTACHMENT_DELETE_MAX_ATTEMPTS', 5))
+    retry_seconds = float(config.get('ATTACHMENT_DELETE_RETRY_SECONDS', 30))
+    for entry in entries:
+        error = failed.get(entry['key'])
+        if error is None:
+            continue
+        attempts = entry.get('attempts', 0) + 1
+        update = {"attempts": attempts, "error": error}
+        if attempts >= max_attempts:
+            update["status"] = "dead"
+            app.logger.error('Giving up deleting attachment {} after {} attempts: {}'.format(
+                entry['key'], attempts, error))
+            _count(dead=1)
+        else:
+            update["status"] = "pending"
+            update["next_attempt"] = now + timedelta(seconds=retry_seconds * 2 ** (attempts - 1))
+            _count(retried=1)
+        coll.update_one({"_id": entry['_id']}, {"$set": update, "$unset": {"claim": ""}})
+    return len(entries)
+
+
+def start_cleanup_worker(app):
+    """Run the attachment cleanup loop on a background thread in this worker process."""
+    def run():
+        with app.app_context():
+            try:
+                create_indexes(app.config)
+            except Exception as exc:
+                app.logger.error('Could not create the attachment cleanup indexes: {}'.format(exc))
+
+            interval = float(app.config.get('ATTACHMENT_DELETE_INTERVAL', 10))
+            while True:
+                try:
+                    processed = process_batch(app)
+                except Exception as exc:
+                    app.logger.error('Attachment cleanup failed: {}'.format(exc))
+                    processed = 0
+                if not processed:
+                    _wake.wait(interval)
+                    _wake.clear()
+
+    thread = threading.Thread(target=run, name='charon-attachment-cleanup')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def cleanup_stats():
+    with _stats_lock:
+        return dict(stats)
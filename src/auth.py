@@ -1,9 +1,8 @@
-import json
-
-from pymongo import MongoClient
 from eve.auth import BasicAuth
 from flask import g, abort, current_app
-from schema import get_security_enabled_fields
+from schema import get_security_descriptor
+from user_context import load_user
+from request_body import request_body
 
 
 class CharonAuth(BasicAuth):
@@ -26,76 +25,92 @@ class CharonAuth(BasicAuth):
         return True
 
 
+def require_auth(resource, method):
+    """
+    Authenticate a request to a Charon route that isn't an Eve endpoint (and set the user's security context), the
+    way Eve does for its own endpoints. Aborts with 401 if the credentials are missing or rejected.
+    """
+    auth = current_app.auth
+    if auth and not auth.authorized([], resource, method):
+        auth.authenticate()
+
+
 def set_context(username):
     current_app.logger.info('Setting security context for user {}'.format(g.user))
 
-    client = MongoClient(current_app.config.get('MONGO_HOST'))
-    db = client['admin']
-    coll = db['charon_user_permissions']
-
     try:
-        user = coll.find({'username': username})[0]
+        user = load_user(username)
     except Exception as exc:
         current_app.logger.error('Failed to find user {}: {}'.format(username, exc))
         g._cat = []
         g._diss = []
+        g._labels = frozenset()
         return
 
-    g._cat = user.get('cat')
-    g._diss = user.get('diss')
+    # Copy so request code can never modify the cached context
+    g._cat = list(user.cat)
+    g._diss = list(user.diss)
+    g._labels = user.labels
 
 
 def check_insert_data_context(resource, request, lookup=None):
-    cat = []
-    diss = []
-    sec_enabled = get_security_enabled_fields(resource[:-6])
+    """Collect the labels (cat and diss) of every _sec object in the incoming data into g._obj_permissions."""
+    descriptor = get_security_descriptor(resource[:-6])
+    req_data = request_body()
     try:
-        # assign incoming object ascl to sec_obj
-        req_data = json.loads(request.data)
-
-        sec_obj = req_data.get('_sec', {})
-        cat = add_cat(cat, sec_obj.get('cat'))
-        diss = add_diss(diss, sec_obj.get('diss'))
-
-        for i in sec_enabled:
-            if i != '':
-                field_obj = req_data.get(i, {}).get('_sec', {})
-                cat = add_cat(cat, field_obj.get('cat'))
-                diss = add_diss(diss, field_obj.get('diss'))
-
-        current_app.logger.debug('Object security categories required: {}'.format(cat))
-        current_app.logger.debug('Object dissemination rules required: {}'.format(diss))
+        g._obj_permissions = required_labels(descriptor, req_data)
+        current_app.logger.debug('Object labels required: {}'.format(sorted(g._obj_permissions)))
     except Exception as exc:
         current_app.logger.critical('Error checking {} context: {}'.format(resource, exc))
         # We don't know that the user is allowed access, so the request must be aborted
         abort(500)
 
-    g._obj_permissions = []
-    g._obj_permissions.extend(cat)
-    g._obj_permissions.extend(diss)
 
-
-def add_cat(cat, val):
-    if val is not None:
-        cat.append(val)
-    return cat
-
-
-def add_diss(diss, val):
-    if val is not None:
-        diss.extend(val)
-    return diss
+def required_labels(descriptor, data):
+    """The labels (cat and diss of every _sec object) a user needs to write `data`, as a frozenset of strings."""
+    labels = set()
+    for path in descriptor.paths:
+        for sec_obj in find_sec_objects(data, path):
+            if sec_obj.get('cat') is not None:
+                labels.add(str(sec_obj.get('cat')))
+            labels.update(str(label) for label in sec_obj.get('diss') or [])
+    return frozenset(labels)
+
+
+def find_sec_objects(data, path):
+    """Get the `_sec` objects at a dotted path in a document, following lists of subdocuments."""
+    nodes = [data]
+    for key in path.split('.') if path else []:
+        children = []
+        for node in nodes:
+            value = node.get(key) if isinstance(node, dict) else None
+            if isinstance(value, list):
+                children.extend(value)
+            elif value is not None:
+                children.append(value)
+        nodes = children
+    return [node['_sec'] for node in nodes if isinstance(node, dict) and isinstance(node.get('_sec'), dict)]
 
 
 def check_insert_access(resource, request, lookup=None):
     method = 'insert' if request.method == 'POST' else 'patch'
     current_app.logger.info('Checking permission for user {} to {} {} object.'.format(g.user, method,
                                                                                       resource[:-6]))
-    current_app.logger.info('Object permissions: {}'.format(g._obj_permissions))
+    current_app.logger.info('Object permissions: {}'.format(sorted(g._obj_permissions)))
 
-    for i in g._obj_permissions:
-        if str(i) not in (g._cat + g._diss):
-            current_app.logger.info('Permission denied for user {} to {} {} object.'.format(g.user, method,
-                                                                                            resource[:-6]))
-            abort(403)
+    missing = g._obj_permissions - getattr(g, '_labels', frozenset())
+    if missing:
+        current_app.logger.info('Permission denied for user {} to {} {} object, missing {}.'.format(
+            g.user, method, resource[:-6], sorted(missing)))
+        deny('missing_labels', missing=sorted(missing))
     return
+
+
+def deny(reason, **details):
+    """
+    Abort with 403 and a structured reason, returned by Eve as the error message, e.g.
+    {"_error": {"code": 403, "message": {"reason": "missing_labels", "missing": ["usg_secret"]}}}
+    """
+    description = {"reason": reason}
+    description.update(details)
+    abort(403, description=description)
@@ -0,0 +1,389 @@
+import json
+from copy import deepcopy
+from datetime import datetime
+
+from bson import ObjectId
+from flask import g, request, current_app, abort, Response
+from pymongo import UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
+from eve.methods.common import serialize, resolve_document_etag, last_updated, date_created
+from eve.methods.patch import resolve_nested_documents
+from eve.utils import document_etag
+from werkzeug.exceptions import BadRequest
+from auth import require_auth, required_labels
+from schema import get_security_descriptor
+from mongo import get_db
+from update import make_batch_perm_check_pipeline, has_doc_perms, has_field_perms, strip_perm_check_fields
+
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+
+def bulk_insert(resource):
+    """
+    POST /<resource>/bulk - insert many documents into <resource>_write in one request. The body is a JSON array of
+    documents, or NDJSON (one document per line) with Content-Type application/x-ndjson.
+
+    The labels required by every document are collected and checked against the user's labels with one set
+    difference for the whole batch; documents are only checked one by one if the batch as a whole is denied. Valid,
+    authorized documents are written with a single unordered insert_many, so one bad document doesn't stop the rest.
+    The response has a result for each document, in order, like an Eve bulk POST.
+    """
+    domain = current_app.config['DOMAIN']
+    write_resource = '{}_write'.format(resource)
+    if write_resource not in domain or 'POST' not in domain[write_resource].get('resource_methods', []):
+        abort(404)
+
+    require_auth(write_resource, 'POST')
+
+    entries = read_documents()
+    max_documents = int(current_app.config.get('BULK_MAX_DOCUMENTS', 10000))
+    if len(entries) > max_documents:
+        abort(413, description='A bulk insert can have at most {} documents'.format(max_documents))
+    current_app.logger.info('Bulk insert of {} {} documents by user {}.'.format(len(entries), resource, g.user))
+
+    results = [None if doc is not None else error_result(400, error) for doc, error in entries]
+    authorize_batch(resource, entries, results)
+    documents = validate_documents(write_resource, entries, results)
+    insert_documents(write_resource, documents, results)
+
+    return bulk_response(results, 201)
+
+
+def bulk_response(results, success_status):
+    """The response for a bulk request: success_status if every item succeeded, else 207 (Multi-Status)."""
+    status = success_status if all(result['_status'] == 'OK' for result in results) else 207
+    body = {"_status": "OK" if status == success_status else "ERR", "_items": results}
+    return Response(json.dumps(body, cls=current_app.data.json_encoder_class), status=status,
+                    mimetype='application/json')
+
+
+def read_documents():
+    """
+    The documents in the request body as a list of (document, None), or (None, error) for an entry that isn't a JSON
+    object. NDJSON is read a line at a time from the request stream.
+    """
+    if request.mimetype in NDJSON_TYPES:
+        entries = []
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entries.append(as_document(json.loads(line.decode('utf-8'))))
+            except ValueError as exc:
+                entries.append((None, 'Unable to parse line as JSON: {}'.format(exc)))
+        return entries
+
+    # The documents are changed as they are inserted, so this reads its own (mutable) parse rather than request_body()
+    try:
+        body = request.get_json(force=True)
+    except BadRequest:
+        abort(400, description='Unable to parse the request body as JSON')
+    if not isinstance(body, list):
+        abort(400, description='Expected a JSON array of documents')
+    return [as_document(doc) for doc in body]
+
+
+def as_document(value):
+    return (value, None) if isinstance(value, dict) else (None, 'Expected a JSON object')
+
+
+def authorize_batch(resource, entries, results):
+    """Deny (403) each document that needs labels the user doesn't have."""
+    descriptor = get_security_descriptor(resource)
+    try:
+        required = [required_labels(descriptor, doc) if doc is not None else frozenset() for doc, _ in entries]
+    except Exception as exc:
+        current_app.logger.critical('Error checking {} context: {}'.format(resource, exc))
+        abort(500)
+
+    labels = getattr(g, '_labels', frozenset())
+    if not frozenset().union(*required) - labels:
+        return
+
+    denied = 0
+    for i, needed in enumerate(required):
+        missing = needed - labels
+        if missing and results[i] is None:
+            results[i] = error_result(403, {"reason": "missing_labels", "missing": sorted(missing)})
+            denied += 1
+    current_app.logger.info('Bulk write by user {} denied for {} {} documents.'.format(g.user, denied, resource))
+
+
+def validate_documents(write_resource, entries, results):
+    """Validate the documents that are still without a result against the schema and add Eve's meta fields."""
+    config = current_app.config
+    validator = current_app.validator(config['DOMAIN'][write_resource]['schema'], resource=write_resource)
+    now = datetime.utcnow().replace(microsecond=0)
+
+    documents = []
+    for i, (doc, _) in enumerate(entries):
+        if results[i] is not None:
+            continue
+        doc = serialize(doc, resource=write_resource)
+        if not validator.validate(doc):
+            results[i] = {"_status": "ERR", "_issues": validator.errors}
+            continue
+        doc = validator.document
+        doc[config['LAST_UPDATED']] = doc[config['DATE_CREATED']] = now
+        resolve_document_etag(doc, write_resource)
+        documents.append((i, doc))
+    return documents
+
+
+def insert_documents(write_resource, documents, results):
+    """Write the documents with one unordered insert_many and record the result of each."""
+    if not documents:
+        return
+    config = current_app.config
+    docs = [doc for _, doc in documents]
+    getattr(current_app, 'on_insert')(write_resource, docs)
+    getattr(current_app, 'on_insert_{}'.format(write_resource))(docs)
+
+    source = config['DOMAIN'][write_resource].get('datasource', {}).get('source', write_resource)
+    try:
+        get_db()[source].insert_many(docs, ordered=False)
+    except BulkWriteError as exc:
+        for error in exc.details.get('writeErrors', []):
+            code = 409 if error.get('code') == 11000 else 400
+            results[documents[error['index']][0]] = error_result(code, error.get('errmsg'))
+
+    inserted = []
+    for i, doc in documents:
+        if results[i] is None:
+            results[i] = {
+                "_status": "OK",
+                config['ID_FIELD']: doc[config['ID_FIELD']],
+                config['ETAG']: doc.get(config['ETAG']),
+                config['DATE_CREATED']: doc[config['DATE_CREATED']],
+                config['LAST_UPDATED']: doc[config['LAST_UPDATED']]
+            }
+            inserted.append(doc)
+    if inserted:
+        getattr(current_app, 'on_inserted')(write_resource, inserted)
+        getattr(current_app, 'on_inserted_{}'.format(write_resource))(inserted)
+
+
+def bulk_write(resource):
+    """
+    PATCH or DELETE /<resource>/bulk - update or delete many documents of <resource>_write in one request. The body
+    is a JSON array of {"_id": ..., "_etag": ..., "changes": {...}} entries (no "changes" for DELETE).
+
+    Permissions for every document are checked with one aggregation ($match on all of the ids), the same checks
+    check_perms_in_db makes for a single document, and the writes are applied with one unordered bulk_write. The
+    response has a result for each entry, in order.
+    """
+    domain = current_app.config['DOMAIN']
+    write_resource = '{}_write'.format(resource)
+    method = request.method
+    if write_resource not in domain or method not in domain[write_resource].get('item_methods', []):
+        abort(404)
+
+    require_auth(write_resource, method)
+
+    entries = read_write_entries(method)
+    current_app.logger.info('Bulk {} of {} {} documents by user {}.'.format(method, len(entries), resource, g.user))
+    results = [None if entry is not None else error_result(400, error) for entry, error in entries]
+
+    if method == 'PATCH':
+        # The new labels must be ones the user has, as for a single PATCH (check_insert_access)
+        authorize_batch(resource, [(entry['changes'] if entry else None, None) for entry, _ in entries], results)
+
+    sec_enabled_fields = get_security_descriptor(resource).field_paths(include_arrays=False)
+    items = check_batch_perms(write_resource, entries, results, sec_enabled_fields)
+    if method == 'PATCH':
+        operations = prepare_updates(write_resource, items, results)
+    else:
+        operations = prepare_deletes(write_resource, items)
+    apply_writes(write_resource, method, operations, results)
+    return bulk_response(results, 200)
+
+
+def read_write_entries(method):
+    """The entries in the request body as a list of ({_id, etag, changes}, None), or (None, error) if not valid."""
+    config = current_app.config
+    try:
+        body = request.get_json(force=True)
+    except BadRequest:
+        abort(400, description='Unable to parse the request body as JSON')
+    if not isinstance(body, list):
+        abort(400, description='Expected a JSON array of entries')
+    max_documents = int(config.get('BULK_MAX_DOCUMENTS', 10000))
+    if len(body) > max_documents:
+        abort(413, description='A bulk write can have at most {} documents'.format(max_documents))
+
+    entries = []
+    seen = set()
+    for entry in body:
+        oid = entry.get(config['ID_FIELD']) if isinstance(entry, dict) else None
+        if not isinstance(oid, str) or not ObjectId.is_valid(oid):
+            entries.append((None, 'Expected an object with a valid {}'.format(config['ID_FIELD'])))
+        elif method == 'PATCH' and (not isinstance(entry.get('changes'), dict) or not entry['changes']):
+            entries.append((None, 'Expected the changes to make to {}'.format(oid)))
+        elif ObjectId(oid) in seen:
+            entries.append((None, 'Duplicate {} {}'.format(config['ID_FIELD'], oid)))
+        else:
+            seen.add(ObjectId(oid))
+            entries.append(({
+                "_id": ObjectId(oid),
+                "etag": entry.get(config['ETAG'], entry.get('etag')),
+                "changes": entry.get('changes') if method == 'PATCH' else None
+            }, None))
+    return entries
+
+
+def check_batch_perms(write_resource, entries, results, sec_enabled_fields):
+    """
+    Read every document to be written with one perm check aggregation and check the user's permissions and the
+    entry's etag against it. Returns (index, entry, original) for each entry that can go ahead.
+    """
+    config = current_app.config
+    pending = [(i, entry) for i, (entry, _) in enumerate(entries) if results[i] is None]
+    if not pending:
+        return []
+
+    if request.method == 'PATCH':
+        # Only consider security-enabled fields being updated by this request
+        fields = sorted(set(key for _, entry in pending for key in entry['changes'] if key in sec_enabled_fields))
+    else:
+        # Consider all security-enabled fields (DELETE affects the entire object)
+        fields = sec_enabled_fields
+    pipeline = make_batch_perm_check_pipeline([entry['_id'] for _, entry in pending], fields)
+    source = config['DOMAIN'][write_resource].get('datasource', {}).get('source', write_resource)
+    originals = dict((doc['_id'], doc) for doc in get_db()[source].aggregate(pipeline))
+
+    ignore_fields = config['DOMAIN'][write_resource].get('etag_ignore_fields')
+    items = []
+    for i, entry in pending:
+        original = originals.get(entry['_id'])
+        if original is None:
+            results[i] = error_result(404, 'No {} with {} {}'.format(write_resource, config['ID_FIELD'], entry['_id']))
+            continue
+
+        checked = fields if request.method == 'DELETE' else [key for key in entry['changes'] if key in fields]
+        if not has_doc_perms(original) or not all(has_field_perms(key, original) for key in checked):
+            current_app.logger.info('User {} has insufficient permissions to modify data in the {} object'.format(
+                g.user, write_resource))
+            results[i] = error_result(403, {"reason": "insufficient_permissions"})
+            continue
+
+        original = strip_perm_check_fields(original, fields)
+        original[config['LAST_UPDATED']] = last_updated(original)
+        original[config['DATE_CREATED']] = date_created(original)
+        if config.get('IF_MATCH'):
+            etag = original.get(config['ETAG'], document_etag(original, ignore_fields=ignore_fields))
+            if entry['etag'] is None and config.get('ENFORCE_IF_MATCH'):
+                results[i] = error_result(428, 'The etag of each document must be provided')
+                continue
+            if entry['etag'] is not None and entry['etag'] != etag:
+                results[i] = error_result(412, 'Client and server etags don\'t match')
+                continue
+        items.append((i, entry, original))
+    return items
+
+
+def prepare_updates(write_resource, items, results):
+    """Validate the changes of each entry and build its UpdateOne. Returns (index, original, updates, operation)."""
+    config = current_app.config
+    resource_def = config['DOMAIN'][write_resource]
+    validator = current_app.validator(resource_def['schema'], resource=write_resource)
+    now = datetime.utcnow().replace(microsecond=0)
+
+    operations = []
+    for i, entry, original in items:
+        updates = serialize(entry['changes'], resource=write_resource)
+        if not validator.validate_update(updates, entry['_id'], original):
+            results[i] = {"_status": "ERR", "_issues": validator.errors}
+            continue
+        updates = validator.document
+        updates[config['LAST_UPDATED']] = now
+
+        updated = deepcopy(original)
+        getattr(current_app, 'on_update')(write_resource, updates, original)
+        getattr(current_app, 'on_update_{}'.format(write_resource))(updates, original)
+        if resource_def.get('merge_nested_documents'):
+            updates = resolve_nested_documents(updates, updated)
+        updated.update(updates)
+        if config.get('IF_MATCH'):
+            resolve_document_etag(updated, write_resource)
+            updates[config['ETAG']] = updated[config['ETAG']]
+
+        operations.append((i, original, updates, UpdateOne(write_filter(original), {"$set": updates})))
+    return operations
+
+
+def prepare_deletes(write_resource, items):
+    """Build the DeleteOne of each entry. Returns (index, original, None, operation)."""
+    operations = []
+    for i, entry, original in items:
+        getattr(current_app, 'on_delete_item')(write_resource, original)
+        getattr(current_app, 'on_delete_item_{}'.format(write_resource))(original)
+        operations.append((i, original, None, DeleteOne(write_filter(original))))
+    return operations
+
+
+def write_filter(original):
+    """Match the document as it was checked: by id, and by etag if it has one stored (as Eve does for writes)."""
+    config = current_app.config
+    query = {config['ID_FIELD']: original[config['ID_FIELD']]}
+    if config['ETAG'] in original:
+        query[config['ETAG']] = original[config['ETAG']]
+    return query
+
+
+def apply_writes(write_resource, method, operations, results):
+    """
+    Apply the operations with one unordered bulk_write and record the result of each. If fewer documents were
+    written than expected (changed or deleted since they were checked), one more query finds which.
+    """
+    if not operations:
+        return
+    config = current_app.config
+    source = config['DOMAIN'][write_resource].get('datasource', {}).get('source', write_resource)
+    coll = get_db()[source]
+
+    failed = set()
+    try:
+        result = coll.bulk_write([operation for _, _, _, operation in operations], ordered=False)
+        written = result.deleted_count if method == 'DELETE' else result.matched_count
+    except BulkWriteError as exc:
+        for error in exc.details.get('writeErrors', []):
+            i = operations[error['index']][0]
+            results[i] = error_result(409 if error.get('code') == 11000 else 400, error.get('errmsg'))
+            failed.add(i)
+        written = exc.details.get('nRemoved' if method == 'DELETE' else 'nMatched', 0)
+
+    if written < len(operations) - len(failed):
+        oids = [original[config['ID_FIELD']] for i, original, _, _ in operations if i not in failed]
+        current = dict((doc[config['ID_FIELD']], doc.get(config['ETAG'])) for doc in
+                       coll.find({config['ID_FIELD']: {"$in": oids}}, {config['ETAG']: 1}))
+        for i, original, updates, _ in operations:
+            oid = original[config['ID_FIELD']]
+            if i in failed:
+                continue
+            if method == 'DELETE' and oid not in current:
+                continue
+            if method == 'PATCH' and oid in current and \
+                    (not config.get('IF_MATCH') or current[oid] == updates.get(config['ETAG'])):
+                continue
+            results[i] = error_result(412, 'The document changed before it could be written')
+            failed.add(i)
+
+    for i, original, updates, _ in operations:
+        if i in failed:
+            continue
+        result = {"_status": "OK", config['ID_FIELD']: original[config['ID_FIELD']]}
+        if method == 'PATCH':
+            result[config['LAST_UPDATED']] = updates[config['LAST_UPDATED']]
+            if config['ETAG'] in updates:
+                result[config['ETAG']] = updates[config['ETAG']]
+            getattr(current_app, 'on_updated')(write_resource, updates, original)
+            getattr(current_app, 'on_updated_{}'.format(write_resource))(updates, original)
+        else:
+            getattr(current_app, 'on_deleted_item')(write_resource, original)
+            getattr(current_app, 'on_deleted_item_{}'.format(write_resource))(original)
+        results[i] = result
+
+
+def error_result(code, message):
+    return {"_status": "ERR", "_error": {"code": code, "message": message}}
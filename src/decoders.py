@@ -0,0 +1,51 @@
+import base64
+
+from flask import current_app
+
+# name -> function turning an S3 object body (bytes) into the attachment value returned in JSON
+DECODERS = {}
+
+# Content types (or type prefixes ending in "/") and the decoder for them. ATTACHMENT_DECODERS adds to these.
+CONTENT_TYPE_DECODERS = {}
+
+
+def register_decoder(name, content_types=()):
+    """Register a decoder under a name, used for the given content types."""
+    def register(func):
+        DECODERS[name] = func
+        for content_type in content_types:
+            CONTENT_TYPE_DECODERS[content_type] = name
+        return func
+    return register
+
+
+@register_decoder('text', ['text/', 'application/json', 'application/xml', 'application/javascript'])
+def decode_text(body):
+    return body.decode('utf-8')
+
+
+@register_decoder('base64', ['application/base64'])
+def decode_base64(body):
+    """Objects uploaded already base64 encoded are returned as they are."""
+    return body.decode('ascii')
+
+
+@register_decoder('binary', ['application/octet-stream', 'application/pdf', 'application/zip', 'image/', 'audio/',
+                             'video/'])
+def decode_binary(body):
+    """Binary objects are base64 encoded once, so they can be returned in JSON."""
+    return base64.b64encode(body).decode('ascii')
+
+
+def get_decoder(content_type):
+    """
+    The decoder for an object's ContentType: an exact match, else a match on the type (e.g. "image/"). None if no
+    decoder is registered, e.g. for objects stored without a content type (S3 reports "binary/octet-stream").
+    """
+    if not content_type:
+        return None
+    mime = content_type.split(';')[0].strip().lower()
+    decoders = dict(CONTENT_TYPE_DECODERS)
+    decoders.update(current_app.config.get('ATTACHMENT_DECODERS', {}))
+    name = decoders.get(mime) or decoders.get('{}/'.format(mime.split('/')[0]))
+    return DECODERS.get(name)
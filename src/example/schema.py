@@ -13,7 +13,9 @@ attachment = {
     "type": "dict",
     "schema": {
         "_sec": ascl,
-        "documents": {"type": "list"}
+        "documents": {"type": "list"},
+        "sizes": {"type": "list", "schema": {"type": "integer"}},
+        "content_types": {"type": "list", "schema": {"type": "string"}}
     }
 }
 
@@ -0,0 +1,163 @@
+import sys
+import json
+import argparse
+import threading
+
+from pymongo import ASCENDING, IndexModel
+from schema import Schema, compile_security_descriptors
+from mongo import get_client, get_db
+
+# Indexes created by Charon are named with this prefix, so drift checks never touch indexes managed by anyone else
+INDEX_PREFIX = 'charon_'
+
+# Result of the last sync in this process, reported by /_stats
+last_sync = {}
+
+
+def security_index_keys(descriptor):
+    """Index keys for the _sec.cat and _sec.diss labels of every secured field. diss is an array, so multikey."""
+    keys = []
+    for field in descriptor.fields:
+        prefix = '{}.'.format(field.path) if field.path else ''
+        keys.append('{}_sec.cat'.format(prefix))
+        keys.append('{}_sec.diss'.format(prefix))
+    return keys
+
+
+def index_name(key):
+    return '{}{}'.format(INDEX_PREFIX, key)
+
+
+def index_drift(coll, keys):
+    """
+    Compare the security label indexes a collection should have with the ones it has.
+    Returns the keys that are missing, the Charon indexes whose definition differs, and Charon indexes no longer needed.
+    """
+    existing = coll.index_information()
+    missing = []
+    mismatched = []
+    for key in keys:
+        info = existing.get(index_name(key))
+        if info is None:
+            # An index on the same key created outside Charon serves just as well
+            if not any(spec.get('key') == [(key, ASCENDING)] for spec in existing.values()):
+                missing.append(key)
+        elif info.get('key') != [(key, ASCENDING)]:
+            mismatched.append(key)
+    wanted = set(index_name(key) for key in keys)
+    extra = [name for name in existing if name.startswith(INDEX_PREFIX) and name not in wanted]
+    return {"missing": missing, "mismatched": mismatched, "extra": extra}
+
+
+def sync_indexes(config, logger, drop_extra=False, dry_run=False):
+    """
+    Create or reconcile the security label indexes for every registered resource. Indexes are built in the
+    background so reads and writes continue while they build. Returns the drift found for each resource.
+    """
+    global last_sync
+
+    db = get_db(config=config)
+    descriptors = Schema().descriptors or compile_security_descriptors()
+    # Only the resources in the configured SCHEMA; the schema_stub resources aren't backed by collections
+    resources = config.get('SCHEMA', descriptors)
+    report = {}
+    for resource, descriptor in descriptors.items():
+        if resource not in resources:
+            continue
+        coll = db[resource]
+        keys = security_index_keys(descriptor)
+        drift = index_drift(coll, keys)
+        report[resource] = drift
+
+        if drift["missing"] or drift["mismatched"] or drift["extra"]:
+            logger.info('Index drift for {}: {}'.format(resource, drift))
+        if dry_run:
+            continue
+
+        for key in drift["mismatched"]:
+            coll.drop_index(index_name(key))
+        if drop_extra:
+            for name in drift["extra"]:
+                coll.drop_index(name)
+        to_create = drift["missing"] + drift["mismatched"]
+        if to_create:
+            logger.info('Building indexes for {}: {}'.format(resource, to_create))
+            coll.create_indexes([IndexModel([(key, ASCENDING)], name=index_name(key), background=True)
+                                 for key in to_create])
+
+    last_sync = report
+    return report
+
+
+def index_build_progress(config):
+    """Index builds currently running on the server, with their progress where Mongo reports it."""
+    ops = get_client(config).admin.aggregate([
+        {"$currentOp": {"allUsers": True}},
+        {"$match": {"$or": [{"command.createIndexes": {"$exists": True}}, {"msg": {"$regex": "^Index Build"}}]}}
+    ])
+    builds = []
+    for op in ops:
+        progress = op.get('progress', {})
+        builds.append({
+            "ns": op.get('ns'),
+            "msg": op.get('msg'),
+            "done": progress.get('done'),
+            "total": progress.get('total'),
+            "secs_running": op.get('secs_running'),
+        })
+    return builds
+
+
+def start_index_sync(app):
+    """Sync indexes on a background thread so worker startup isn't held up by index builds."""
+    def run():
+        try:
+            sync_indexes(app.config, app.logger)
+        except Exception as exc:
+            app.logger.error('Security label index sync failed: {}'.format(exc))
+
+    thread = threading.Thread(target=run, name='charon-index-sync')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def make_app():
+    """An app with Charon's settings and data layer, but none of the hooks or background threads run.py starts."""
+    from eve import Eve
+    from mongo import CharonMongo
+
+    return Eve(data=CharonMongo)
+
+
+def main(argv=None):
+    """
+    Manage security label indexes from the command line:
+        python indexes.py sync [--drop-extra] [--dry-run]
+        python indexes.py status
+    """
+    parser = argparse.ArgumentParser(prog='charon indexes')
+    subparsers = parser.add_subparsers(dest='command')
+    sync = subparsers.add_parser('sync', help='Create or reconcile security label indexes')
+    sync.add_argument('--drop-extra', action='store_true', help='Drop Charon indexes no longer in the schema')
+    sync.add_argument('--dry-run', action='store_true', help='Only report drift')
+    subparsers.add_parser('status', help='Report index drift and index builds in progress')
+    args = parser.parse_args(argv)
+
+    app = make_app()
+
+    with app.app_context():
+        if args.command == 'sync':
+            report = sync_indexes(app.config, app.logger, drop_extra=args.drop_extra, dry_run=args.dry_run)
+            print(json.dumps({"drift": report}, indent=2))
+        elif args.command == 'status':
+            report = sync_indexes(app.config, app.logger, dry_run=True)
+            print(json.dumps({"drift": report, "builds": index_build_progress(app.config)}, indent=2, default=str))
+        else:
+            parser.print_help()
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+import os
+import threading
+
+from pymongo import MongoClient, monitoring
+from eve.io.mongo import Mongo
+from flask import current_app
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Counts connection pool events for the worker's MongoClient so they can be scraped from /_stats."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stats = {
+                "pools_created": 0,
+                "pools_cleared": 0,
+                "connections_created": 0,
+                "connections_closed": 0,
+                "connections_open": 0,
+                "connections_checked_out": 0,
+                "checkouts": 0,
+                "checkout_failures": 0,
+            }
+
+    def _incr(self, **changes):
+        with self._lock:
+            for key, delta in changes.items():
+                self.stats[key] += delta
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def pool_created(self, event):
+        self._incr(pools_created=1)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._incr(pools_cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._incr(connections_created=1, connections_open=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._incr(connections_closed=1, connections_open=-1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._incr(checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self._incr(checkouts=1, connections_checked_out=1)
+
+    def connection_checked_in(self, event):
+        self._incr(connections_checked_out=-1)
+
+
+pool_stats_listener = PoolStatsListener()
+
+
+def client_options(config):
+    """Build MongoClient keyword arguments from the app config (connection, credentials and pool tuning)."""
+    options = {
+        "host": config.get('MONGO_HOST'),
+        "port": int(config.get('MONGO_PORT') or 27017),
+        "maxPoolSize": int(config.get('MONGO_MAX_POOL_SIZE', 100)),
+        "minPoolSize": int(config.get('MONGO_MIN_POOL_SIZE', 0)),
+        "maxIdleTimeMS": int(config.get('MONGO_MAX_IDLE_TIME_MS', 60000)),
+        "waitQueueTimeoutMS": int(config.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000)),
+        "event_listeners": [pool_stats_listener],
+        "connect": False,  # Don't open sockets until first use, so a client built before fork is never shared
+    }
+    if config.get('MONGO_USERNAME'):
+        options["username"] = config.get('MONGO_USERNAME')
+        options["password"] = config.get('MONGO_PASSWORD')
+        options["authSource"] = config.get('MONGO_AUTH_SOURCE', 'admin')
+    return options
+
+
+def get_client(config=None):
+    """
+    Return the MongoClient shared by every request in this worker process.
+
+    The client is created lazily on first use and rebuilt if the process id changes, so each gunicorn worker gets
+    its own connection pool after fork instead of inheriting the parent's sockets.
+    """
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            if config is None:
+                config = current_app.config
+            _log_debug('Creating MongoClient pool for worker {}'.format(pid))
+            pool_stats_listener.reset()
+            _client = MongoClient(**client_options(config))
+            _client_pid = pid
+    return _client
+
+
+def get_db(name=None, config=None):
+    """Get a database from the shared client. Defaults to MONGO_DBNAME."""
+    if config is None:
+        config = current_app.config
+    return get_client(config)[name or config.get('MONGO_DBNAME')]
+
+
+def close_client():
+    """Close the worker's MongoClient (e.g. on worker exit). The next call to get_client opens a new pool."""
+    global _client, _client_pid
+
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
+
+def pool_stats():
+    """Current connection pool statistics for this worker."""
+    stats = pool_stats_listener.snapshot()
+    stats["pid"] = os.getpid()
+    stats["active"] = _client is not None and _client_pid == os.getpid()
+    return stats
+
+
+def _log_debug(msg):
+    try:
+        current_app.logger.debug(msg)
+    except RuntimeError:
+        # Outside of an app context (e.g. CLI tools) there is no app logger
+        pass
+
+
+class SharedPyMongo(object):
+    """Stand-in for Eve's per-prefix PyMongo wrapper that hands out the worker's shared client."""
+
+    def __init__(self, app):
+        self.app = app
+
+    @property
+    def cx(self):
+        return get_client(self.app.config)
+
+    @property
+    def db(self):
+        return get_db(config=self.app.config)
+
+
+class CharonMongo(Mongo):
+    """Eve Mongo data layer that uses the shared, fork-safe connection pool instead of its own MongoClient."""
+
+    def pymongo(self, resource=None, prefix=None):
+        return SharedPyMongo(self.app)
@@ -0,0 +1,560 @@
+import io
+import os
+import abc
+import hmac
+import json
+import mmap
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote, urlencode
+
+import boto3
+from botocore.client import Config
+from botocore.exceptions import ClientError
+from flask import current_app, request, abort, Response
+from werkzeug.wsgi import wrap_file
+
+# Object store shared by every attachment hook in this worker process. Created on first use after fork.
+_store = None
+_store_key = None
+_store_lock = threading.Lock()
+
+# S3 DeleteObjects accepts at most this many keys per call
+S3_MAX_DELETE_KEYS = 1000
+
+# S3 client used by the S3 object store. Created on first use after fork.
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+_s3_clients_created = 0
+
+
+class ObjectStoreError(Exception):
+    pass
+
+
+class NotModified(ObjectStoreError):
+    """The object still has the ETag given in if_none_match."""
+
+
+class ObjectNotFound(ObjectStoreError):
+    """No such object, or no such multipart upload."""
+
+
+class InvalidRange(ObjectStoreError):
+    pass
+
+
+class InvalidUpload(ObjectStoreError):
+    """A multipart upload can't be completed with the parts given."""
+
+
+class ObjectStore(abc.ABC):
+    """
+    Where attachment objects are kept. Attachment hooks only use this interface, so the backend is chosen by the
+    OBJECT_STORE setting (see get_object_store).
+
+    Objects are described by dicts: get_object returns {"body" (bytes), "etag", "content_type"}, head_object returns
+    {"size", "etag", "content_type"} and open_object returns {"body" (file-like), "size", "content_range", "etag",
+    "content_type"}. Presigned urls let clients upload ("put") and download ("get") objects without going through
+    Charon.
+    """
+    name = None
+
+    @abc.abstractmethod
+    def get_object(self, key, if_none_match=None):
+        pass
+
+    @abc.abstractmethod
+    def head_object(self, key):
+        pass
+
+    @abc.abstractmethod
+    def open_object(self, key, byte_range=None):
+        """Open an object (or the part given by an HTTP Range header value) for streaming."""
+
+    @abc.abstractmethod
+    def presign(self, method, key, expires_in, content_type=None):
+        pass
+
+    @abc.abstractmethod
+    def create_multipart_upload(self, key, content_type=None):
+        """Start a multipart upload and return its upload id."""
+
+    @abc.abstractmethod
+    def presign_part(self, key, upload_id, part_number, expires_in):
+        pass
+
+    @abc.abstractmethod
+    def complete_multipart_upload(self, key, upload_id, parts):
+        """Assemble the object from [(part_number, etag)] and return its ETag."""
+
+    @abc.abstractmethod
+    def abort_multipart_upload(self, key, upload_id):
+        pass
+
+    @abc.abstractmethod
+    def delete_objects(self, keys):
+        """
+        Delete objects; keys that don't exist count as deleted. Returns {key: error} for keys that weren't deleted.
+        """
+
+
+@contextmanager
+def s3_errors():
+    """Raise ObjectStoreErrors for the S3 errors callers handle."""
+    try:
+        yield
+    except ClientError as exc:
+        error = exc.response.get('Error', {})
+        code = error.get('Code')
+        if code in ('304', 'NotModified'):
+            raise NotModified()
+        if code in ('404', 'NoSuchKey', 'NoSuchUpload'):
+            raise ObjectNotFound(error.get('Message'))
+        if code == 'InvalidRange':
+            raise InvalidRange(error.get('Message'))
+        if code in ('InvalidPart', 'InvalidPartOrder', 'EntityTooSmall'):
+            raise InvalidUpload(error.get('Message'))
+        raise
+
+
+class S3ObjectStore(ObjectStore):
+    """Objects in an S3 bucket, using a (thread safe) boto3 client."""
+    name = 's3'
+
+    def __init__(self, client, bucket):
+        self.client = client
+        self.bucket = bucket
+
+    def get_object(self, key, if_none_match=None):
+        params = {"Bucket": self.bucket, "Key": key}
+        if if_none_match is not None:
+            params["IfNoneMatch"] = if_none_match
+        with s3_errors():
+            obj = self.client.get_object(**params)
+            body = obj['Body'].read()
+        return {"body": body, "etag": obj.get('ETag'), "content_type": obj.get('ContentType')}
+
+    def head_object(self, key):
+        with s3_errors():
+            head = self.client.head_object(Bucket=self.bucket, Key=key)
+        return {"size": head.get('ContentLength'), "etag": head.get('ETag'), "content_type": head.get('ContentType')}
+
+    def open_object(self, key, byte_range=None):
+        params = {"Bucket": self.bucket, "Key": key}
+        if byte_range:
+            params["Range"] = byte_range
+        with s3_errors():
+            obj = self.client.get_object(**params)
+        return {"body": obj['Body'], "size": obj.get('ContentLength'), "content_range": obj.get('ContentRange'),
+                "etag": obj.get('ETag'), "content_type": obj.get('ContentType')}
+
+    def presign(self, method, key, expires_in, content_type=None):
+        params = {"Bucket": self.bucket, "Key": key}
+        if content_type:
+            params["ContentType"] = content_type
+        return self.client.generate_presigned_url(ClientMethod='{}_object'.format(method), Params=params,
+                                                  ExpiresIn=expires_in)
+
+    def create_multipart_upload(self, key, content_type=None):
+        params = {"Bucket": self.bucket, "Key": key}
+        if content_type:
+            params["ContentType"] = content_type
+        with s3_errors():
+            return self.client.create_multipart_upload(**params)['UploadId']
+
+    def presign_part(self, key, upload_id, part_number, expires_in):
+        return self.client.generate_presigned_url(
+            ClientMethod='upload_part',
+            Params={"Bucket": self.bucket, "Key": key, "UploadId": upload_id, "PartNumber": part_number},
+            ExpiresIn=expires_in
+        )
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        with s3_errors():
+            result = self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={"Parts": [{"PartNumber": number, "ETag": etag} for number, etag in parts]}
+            )
+        return result.get('ETag')
+
+    def abort_multipart_upload(self, key, upload_id):
+        with s3_errors():
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+
+    def delete_objects(self, keys):
+        failed = {}
+        for start in range(0, len(keys), S3_MAX_DELETE_KEYS):
+            batch = keys[start:start + S3_MAX_DELETE_KEYS]
+            try:
+                result = self.client.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+                )
+            except ClientError as exc:
+                failed.update((key, str(exc)) for key in batch)
+                continue
+            for error in result.get('Errors', []):
+                failed[error.get('Key')] = '{}: {}'.format(error.get('Code'), error.get('Message'))
+        return failed
+
+
+class MmapReader(object):
+    """File-like reader over a byte range of a memory mapped file, so responses stream without reading the file."""
+
+    def __init__(self, f, mm, start, end):
+        self._f = f
+        self._mm = mm
+        self._view = memoryview(mm)
+        self._pos = start
+        self._end = end
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._end - self._pos
+        chunk = self._view[self._pos:min(self._end, self._pos + size)].tobytes()
+        self._pos += len(chunk)
+        return chunk
+
+    def close(self):
+        self._view.release()
+        self._mm.close()
+        self._f.close()
+
+
+def parse_range(byte_range, size):
+    """Start and end (exclusive) of a single-range HTTP Range header value. Raises InvalidRange."""
+    try:
+        unit, spec = byte_range.split('=', 1)
+        first, last = spec.strip().split('-', 1)
+        if unit.strip() != 'bytes' or ',' in spec:
+            raise ValueError
+        if first == '':
+            start, end = max(0, size - int(last)), size
+        else:
+            start = int(first)
+            end = min(size, int(last) + 1) if last != '' else size
+    except ValueError:
+        raise InvalidRange(byte_range)
+    if start >= end:
+        raise InvalidRange(byte_range)
+    return start, end
+
+
+class LocalObjectStore(ObjectStore):
+    """
+    Objects kept as files in a directory, for deployments without S3 and for benchmarks. Streamed reads go through mmap.
+    Presigned urls point at this app's /_objects/<key> route (see local_object) and are signed with an HMAC of
+    OBJECT_STORE_LOCAL_SECRET, so they work like S3 presigned urls: anyone holding one can do that one thing with that
+    one object until it expires. Each object's content type is kept in a .meta file next to it.
+    """
+    name = 'local'
+
+    def __init__(self, directory, secret, base_url=''):
+        if not secret:
+            raise ValueError('OBJECT_STORE_LOCAL_SECRET must be set to use the local object store')
+        self.directory = directory
+        self.secret = secret.encode('utf-8')
+        self.base_url = base_url.rstrip('/')
+        os.makedirs(os.path.join(directory, 'uploads'), exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def upload_path(self, upload_id):
+        # Upload ids are generated here; never let one escape the uploads directory
+        return os.path.join(self.directory, 'uploads', os.path.basename(upload_id))
+
+    @staticmethod
+    def etag(stat):
+        return '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+
+    def read_meta(self, path):
+        try:
+            with open('{}.meta'.format(path)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write_meta(self, path, meta):
+        tmp_path = '{}.meta.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, '{}.meta'.format(path))
+
+    def get_object(self, key, if_none_match=None):
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            raise ObjectNotFound(key)
+        with f:
+            stat = os.fstat(f.fileno())
+            etag = self.etag(stat)
+            if if_none_match is not None and if_none_match == etag:
+                raise NotModified()
+            # Callers need the whole content as bytes, and one read gives that without mapping the file first
+            body = f.read()
+        return {"body": body, "etag": etag, "content_type": self.read_meta(path).get('content_type')}
+
+    def head_object(self, key):
+        path = self.path(key)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            raise ObjectNotFound(key)
+        return {"size": stat.st_size, "etag": self.etag(stat), "content_type": self.read_meta(path).get('content_type')}
+
+    def open_object(self, key, byte_range=None):
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            raise ObjectNotFound(key)
+        try:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            start, end = parse_range(byte_range, size) if byte_range else (0, size)
+            if size == 0:
+                f.close()
+                body = io.BytesIO(b'')
+            else:
+                body = MmapReader(f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), start, end)
+        except Exception:
+            f.close()
+            raise
+        content_range = 'bytes {}-{}/{}'.format(start, end - 1, size) if byte_range else None
+        return {"body": body, "size": end - start, "content_range": content_range, "etag": self.etag(stat),
+                "content_type": self.read_meta(path).get('content_type')}
+
+    def presign(self, method, key, expires_in, content_type=None, **extra):
+        params = dict(extra, method=method, expires=int(time.time()) + expires_in)
+        if content_type:
+            params["content_type"] = content_type
+        params["signature"] = self.signature(key, params)
+        return '{}/_objects/{}?{}'.format(self.base_url, quote(key, safe=''), urlencode(sorted(params.items())))
+
+    def signature(self, key, params):
+        message = '\n'.join([key] + ['{}={}'.format(name, params[name]) for name in sorted(params)
+                                     if name != 'signature'])
+        return hmac.new(self.secret, message.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def verify(self, key, params):
+        """The parameters of a presigned url if its signature is valid and it hasn't expired, else None."""
+        params = dict(params.items())
+        if not hmac.compare_digest(params.get('signature', ''), self.signature(key, params)):
+            return None
+        try:
+            if int(params.get('expires')) < time.time():
+                return None
+        except (TypeError, ValueError):
+            return None
+        return params
+
+    def write_file(self, path, stream, chunk_size=64 * 1024):
+        # Write to a temporary file and rename, so readers never see a partial object
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(stream, f, chunk_size)
+        os.replace(tmp_path, path)
+        return self.etag(os.stat(path))
+
+    def put_object(self, key, stream, content_type=None):
+        path = self.path(key)
+        etag = self.write_file(path, stream)
+        self.write_meta(path, {"key": key, "content_type": content_type})
+        return etag
+
+    def create_multipart_upload(self, key, content_type=None):
+        upload_id = uuid.uuid4().hex
+        path = self.upload_path(upload_id)
+        os.makedirs(path)
+        self.write_meta(os.path.join(path, 'upload'), {"key": key, "content_type": content_type})
+        return upload_id
+
+    def upload_meta(self, key, upload_id):
+        path = self.upload_path(upload_id)
+        meta = self.read_meta(os.path.join(path, 'upload'))
+        if meta.get('key') != key:
+            raise ObjectNotFound(upload_id)
+        return path, meta
+
+    def presign_part(self, key, upload_id, part_number, expires_in):
+        return self.presign('part', key, expires_in, upload_id=upload_id, part_number=part_number)
+
+    def put_part(self, key, upload_id, part_number, stream):
+        path, _ = self.upload_meta(key, upload_id)
+        return self.write_file(os.path.join(path, str(int(part_number))), stream)
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        path, meta = self.upload_meta(key, upload_id)
+        part_paths = []
+        for number, etag in parts:
+            part_path = os.path.join(path, str(int(number)))
+            try:
+                if self.etag(os.stat(part_path)) != etag:
+                    raise InvalidUpload('ETag of part {} does not match'.format(number))
+            except FileNotFoundError:
+                raise InvalidUpload('Part {} was not uploaded'.format(number))
+            part_paths.append(part_path)
+
+        object_path = self.path(key)
+        tmp_path = '{}.{}.{}.tmp'.format(object_path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as out:
+            for part_path in part_paths:
+                with open(part_path, 'rb') as part:
+                    shutil.copyfileobj(part, out)
+        os.replace(tmp_path, object_path)
+        self.write_meta(object_path, {"key": key, "content_type": meta.get('content_type')})
+        shutil.rmtree(path, ignore_errors=True)
+        return self.etag(os.stat(object_path))
+
+    def abort_multipart_upload(self, key, upload_id):
+        path, _ = self.upload_meta(key, upload_id)
+        shutil.rmtree(path, ignore_errors=True)
+
+    def delete_objects(self, keys):
+        failed = {}
+        for key in keys:
+            path = self.path(key)
+            for file_path in (path, '{}.meta'.format(path)):
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+                except OSError as exc:
+                    failed[key] = str(exc)
+        return failed
+
+
+def get_s3_client():
+    """
+    Return the boto3 S3 client shared by every S3 hook in this worker. boto3 clients are thread safe, so one client
+    (and its connection pool of S3_MAX_POOL_CONNECTIONS) serves all requests and download threads. The client is
+    created lazily and rebuilt if the process id changes, so workers never share a client created before fork.
+    """
+    global _s3_client, _s3_client_pid, _s3_clients_created
+
+    pid = os.getpid()
+    if _s3_client is not None and _s3_client_pid == pid:
+        return _s3_client
+
+    with _s3_client_lock:
+        if _s3_client is None or _s3_client_pid != pid:
+            timeout = float(current_app.config.get('S3_OBJECT_TIMEOUT', 30))
+            _s3_client = boto3.client(
+                's3',
+                aws_access_key_id=current_app.config.get('AWS_ACCESS_KEY'),
+                aws_secret_access_key=current_app.config.get('AWS_SECRET_KEY'),
+                config=Config(signature_version='s3v4',
+                              max_pool_connections=int(current_app.config.get('S3_MAX_POOL_CONNECTIONS', 32)),
+                              connect_timeout=timeout, read_timeout=timeout)
+            )
+            _s3_client_pid = pid
+            _s3_clients_created += 1
+    return _s3_client
+
+
+def s3_pool_stats():
+    """Connection pool statistics for this worker's S3 client, for /_stats."""
+    if _s3_client is None or _s3_client_pid != os.getpid():
+        return {}
+
+    stats = {
+        "clients_created": _s3_clients_created,
+        "max_pool_connections": _s3_client.meta.config.max_pool_connections,
+        "pools": []
+    }
+    try:
+        # botocore doesn't expose its urllib3 pools publicly
+        manager = _s3_client._endpoint.http_session._manager
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            stats["pools"].append({
+                "host": pool.host,
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+                "idle_connections": pool.pool.qsize() if pool.pool is not None else 0
+            })
+    except AttributeError:
+        pass
+    return stats
+
+
+def get_object_store():
+    """
+    Return this worker's attachment object store: S3 (OBJECT_STORE "s3", the default) or a local directory
+    (OBJECT_STORE "local"). Created lazily and rebuilt after fork or when the settings change.
+    """
+    global _store, _store_key
+
+    config = current_app.config
+    kind = config.get('OBJECT_STORE', 's3')
+    settings = (os.getpid(), kind, config.get('AWS_S3_BUCKET_NAME'), config.get('OBJECT_STORE_LOCAL_DIR'))
+    if _store is not None and _store_key == settings:
+        return _store
+
+    with _store_lock:
+        if _store is None or _store_key != settings:
+            if kind == 'local':
+                _store = LocalObjectStore(config.get('OBJECT_STORE_LOCAL_DIR', '/data/attachments'),
+                                          config.get('OBJECT_STORE_LOCAL_SECRET', ''),
+                                          config.get('OBJECT_STORE_LOCAL_URL', ''))
+            else:
+                _store = S3ObjectStore(get_s3_client(), config.get('AWS_S3_BUCKET_NAME'))
+            _store_key = settings
+    return _store
+
+
+def object_response(obj):
+    """A streamed response for an object opened with open_object. Range reads answer 206 with Content-Range."""
+    headers = {"Accept-Ranges": "bytes", "Content-Length": str(obj.get('size'))}
+    if obj.get('etag'):
+        headers["ETag"] = obj.get('etag')
+    if obj.get('content_range'):
+        headers["Content-Range"] = obj.get('content_range')
+
+    # Hand the body to the server's wsgi.file_wrapper (or werkzeug's), which reads it one chunk at a time
+    body = wrap_file(request.environ, obj['body'],
+                     buffer_size=int(current_app.config.get('ATTACHMENT_CHUNK_SIZE', 64 * 1024)))
+    return Response(body, status=206 if obj.get('content_range') else 200, headers=headers,
+                    mimetype=obj.get('content_type') or 'application/octet-stream', direct_passthrough=True)
+
+
+def local_object(key):
+    """
+    GET / PUT /_objects/<key> - the presigned urls of the local object store. GET streams the object (with Range
+    support); PUT stores the request body as the object, or as a part of a multipart upload.
+    """
+    store = get_object_store()
+    if not isinstance(store, LocalObjectStore):
+        abort(404)
+    params = store.verify(key, request.args)
+    if params is None:
+        abort(403, description='Invalid or expired signature')
+
+    method = params.get('method')
+    try:
+        if request.method == 'GET' and method == 'get':
+            return object_response(store.open_object(key, request.headers.get('Range')))
+        if request.method == 'PUT' and method == 'put':
+            # As with S3, an upload url signed with a content type only accepts that content type
+            if params.get('content_type') and request.content_type != params.get('content_type'):
+                abort(403, description='Content-Type does not match the signed content type')
+            etag = store.put_object(key, request.stream, request.content_type)
+            return Response(status=200, headers={"ETag": etag})
+        if request.method == 'PUT' and method == 'part':
+            etag = store.put_part(key, params.get('upload_id'), params.get('part_number'), request.stream)
+            return Response(status=200, headers={"ETag": etag})
+    except ObjectNotFound:
+        abort(404)
+    except InvalidRange:
+        abort(416)
+    abort(403, description='Url not signed for this method')
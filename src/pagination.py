@@ -0,0 +1,107 @@
+import json
+import base64
+
+from bson import json_util
+from flask import g, request, current_app, abort
+from aggregators import insert_after_match
+
+
+def keyset_enabled():
+    # Streamed reads (see streaming.py) return everything the user can see, in chunks, rather than pages
+    return current_app.config.get('KEYSET_PAGINATION') == "True" and not getattr(g, '_streaming', False)
+
+
+def add_keyset_pagination(endpoint, pipeline):
+    """
+    Page reads by key instead of returning the whole visible collection. Documents are sorted on the configured key
+    (with _id as tie breaker) and start after the position in the `cursor` query parameter. The $limit goes after
+    redaction, so a page is `max_results` documents the user can actually see.
+
+    Must be registered after add_ascl_redaction.
+    """
+    if not keyset_enabled():
+        return
+
+    key = current_app.config.get('KEYSET_PAGINATION_KEY', '_id')
+    max_results = get_max_results()
+    after = decode_cursor(request.args.get('cursor'))
+
+    stages = []
+    if after is not None:
+        stages.append({"$match": keyset_match(key, after)})
+    stages.append({"$sort": sort_spec(key)})
+    insert_after_match(pipeline, stages)
+
+    # Fetch one extra document to know whether there is another page
+    pipeline.append({"$limit": max_results + 1})
+    g._keyset = (key, max_results)
+
+
+def get_max_results():
+    """Requested page size, defaulting to PAGINATION_DEFAULT and capped at PAGINATION_LIMIT."""
+    limit = int(current_app.config.get('PAGINATION_LIMIT', 50))
+    try:
+        max_results = int(request.args.get('max_results', current_app.config.get('PAGINATION_DEFAULT', 25)))
+    except ValueError:
+        abort(400, description='max_results must be an integer')
+    return max(1, min(max_results, limit))
+
+
+def sort_spec(key):
+    if key == '_id':
+        return {"_id": 1}
+    return {key: 1, "_id": 1}
+
+
+def keyset_match(key, after):
+    """Match documents that sort after the (key value, _id) position of the last document on the previous page."""
+    value, oid = after
+    if key == '_id':
+        return {"_id": {"$gt": oid}}
+    return {"$or": [{key: {"$gt": value}}, {key: value, "_id": {"$gt": oid}}]}
+
+
+def encode_cursor(key, document):
+    value = get_path(document, key)
+    data = json_util.dumps([value, document.get('_id')])
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        value, oid = json_util.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except Exception:
+        abort(400, description='Invalid cursor')
+    return value, oid
+
+
+def get_path(document, path):
+    for part in path.split('.'):
+        document = document.get(part) if isinstance(document, dict) else None
+    return document
+
+
+def trim_keyset_page(endpoint, documents):
+    """Drop the extra document fetched by add_keyset_pagination and remember where the next page starts."""
+    keyset = getattr(g, '_keyset', None)
+    if keyset is None:
+        return documents
+
+    key, max_results = keyset
+    g._next_cursor = None
+    if len(documents) > max_results:
+        del documents[max_results:]
+        g._next_cursor = encode_cursor(key, documents[-1])
+    return documents
+
+
+def include_next_cursor(resource, request, payload):
+    """Add the continuation token for the next page (or null on the last page) to the response payload."""
+    if getattr(g, '_keyset', None) is None or payload.status_code != 200:
+        return
+
+    data = json.loads(payload.data)
+    data['_next_cursor'] = getattr(g, '_next_cursor', None)
+    payload.data = json.dumps(data)
@@ -0,0 +1,88 @@
+import copy
+
+from flask import g, request, abort
+from werkzeug.exceptions import BadRequest
+
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError('The request body is shared by all hooks and is read-only; copy it to make changes')
+
+
+class FrozenDict(dict):
+    """
+    A read-only JSON object. Nested objects and arrays are frozen when first read, so only the parts of a body that
+    hooks look at are wrapped, one level at a time. Copies (copy.copy / copy.deepcopy) are ordinary, mutable dicts.
+    """
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        frozen = freeze(value)
+        if frozen is not value:
+            dict.__setitem__(self, key, frozen)
+        return frozen
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def __copy__(self):
+        return dict(self.items())
+
+    def __deepcopy__(self, memo):
+        # Straight from the stored values, without freezing the levels nothing has read yet
+        return copy.deepcopy(dict(dict.items(self)), memo)
+
+
+class FrozenList(list):
+    """A read-only JSON array, frozen lazily like FrozenDict. Copies (copy.copy / copy.deepcopy) are ordinary lists."""
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = clear = extend = insert = pop = remove = reverse = \
+        sort = _read_only
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        value = list.__getitem__(self, index)
+        frozen = freeze(value)
+        if frozen is not value:
+            list.__setitem__(self, index, frozen)
+        return frozen
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(list(list.__iter__(self)), memo)
+
+
+def freeze(value):
+    """Wrap a parsed JSON object or array read-only. Only its top level is copied (shallowly); see FrozenDict."""
+    if isinstance(value, dict) and not isinstance(value, FrozenDict):
+        return FrozenDict(value)
+    if isinstance(value, list) and not isinstance(value, FrozenList):
+        return FrozenList(value)
+    return value
+
+
+def request_body():
+    """
+    The JSON body of the current request, parsed once and shared by every Charon hook. Parsing goes through Flask's
+    request.get_json, whose cached result Eve reuses for its own parse of the payload. The body is returned read-only,
+    so no hook can change what the hooks after it (or Eve) see. Nested values are made read-only as they are read
+    rather than up front, so a large body isn't copied. Aborts with 400 if the body isn't valid JSON.
+    """
+    if '_request_body' not in g:
+        try:
+            g._request_body = freeze(request.get_json(force=True))
+        except BadRequest:
+            abort(400, description='Unable to parse the request body as JSON')
+    return g._request_body
@@ -1,12 +1,24 @@
 from eve import Eve
 import logging
+from flask import jsonify
 from aggregators import add_ascl_redaction
 from auth import check_insert_access, check_insert_data_context, CharonAuth
-from s3 import include_s3_data, generate_presigned_urls, include_presigned_urls
+from s3 import include_s3_data, generate_presigned_urls, include_presigned_urls, stream_attachment, \
+    presigned_url_cache_stats, finish_multipart_upload
+from object_store import s3_pool_stats, local_object
 from update import check_perms_in_db
+from pagination import add_keyset_pagination, trim_keyset_page, include_next_cursor
+from streaming import stream_resource
+from bulk import bulk_insert, bulk_write
+from mongo import CharonMongo, pool_stats
+from user_context import cache_stats
+from attachment_cache import attachment_cache_stats
+import attachment_cleanup
+from atomic_writes import install_atomic_writes
+import indexes
 from flask_cors import CORS
 
-app = Eve(auth=CharonAuth)
+app = Eve(auth=CharonAuth, data=CharonMongo)
 CORS(app)
 
 app.on_pre_POST += check_insert_data_context
@@ -20,10 +32,50 @@ app.on_pre_PATCH += check_perms_in_db
 app.on_post_POST += include_presigned_urls
 
 app.on_pre_DELETE += check_perms_in_db
+app.on_deleted_item += attachment_cleanup.queue_attachment_deletion
+app.on_delete_resource_originals += attachment_cleanup.remember_deleted_documents
+app.on_deleted_resource += attachment_cleanup.queue_resource_deletion
 
 app.before_aggregation += add_ascl_redaction
+app.before_aggregation += add_keyset_pagination
+app.after_aggregation += trim_keyset_page
 app.after_aggregation += include_s3_data
 
+app.on_post_GET += include_next_cursor
+
+app.add_url_rule('/<resource>/stream', 'stream_resource', stream_resource, methods=['GET'])
+app.add_url_rule('/<resource>/bulk', 'bulk_insert', bulk_insert, methods=['POST'])
+app.add_url_rule('/<resource>/bulk', 'bulk_write', bulk_write, methods=['PATCH', 'DELETE'])
+app.add_url_rule('/<resource>/<oid>/attachments/<int:n>', 'stream_attachment', stream_attachment, methods=['GET'])
+app.add_url_rule('/<resource>/attachments/multipart/<action>', 'finish_multipart_upload', finish_multipart_upload,
+                 methods=['POST'])
+app.add_url_rule('/_objects/<path:key>', 'local_object', local_object, methods=['GET', 'PUT'])
+
+
+@app.route('/_stats')
+def stats():
+    """Per-worker runtime statistics for scraping by monitoring."""
+    return jsonify({
+        "mongo": pool_stats(),
+        "s3": s3_pool_stats(),
+        "attachment_cache": attachment_cache_stats(),
+        "presigned_url_cache": presigned_url_cache_stats(),
+        "attachment_cleanup": attachment_cleanup.cleanup_stats(),
+        "user_context_cache": cache_stats(),
+        "index_drift": indexes.last_sync
+    })
+
+
+if app.config.get('ATOMIC_WRITES') == "True":
+    install_atomic_writes(app)
+
+if app.config.get('INDEX_SYNC_ON_STARTUP') == "True":
+    indexes.start_index_sync(app)
+
+if app.config.get('S3_ATTACHMENTS') == "True" and app.config.get('ATTACHMENT_CASCADE_DELETE') == "True":
+    attachment_cleanup.start_cleanup_worker(app)
+
+
 # When not run directly (e.g. through gunicorn), get log level from gunicorn
 if __name__ != '__main__':
     # Using try in case something other than gunicorn or __main__ calls this file
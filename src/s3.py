@@ -1,50 +1,241 @@
-import boto3
 import base64
 import json
-from flask import g, current_app
-from botocore.client import Config
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import g, current_app, request, abort, jsonify
+from attachment_cache import get_attachment_cache
+from request_body import request_body
+from object_store import get_object_store, object_response, NotModified, ObjectNotFound, InvalidRange, InvalidUpload
+from decoders import get_decoder
+from aggregators import add_ascl_redaction
+from auth import require_auth
+from mongo import get_db
+from schema import get_security_descriptor
+from update import make_match_perm_check_pipeline, has_doc_perms, has_field_perms
+
+# S3 allows at most this many parts in a multipart upload, and every part but the last must be at least 5 MiB
+S3_MAX_PARTS = 10000
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Limits concurrent S3 downloads across all requests in this worker process. Created on first use.
+_global_fetch_slots = None
+_global_fetch_slots_lock = threading.Lock()
+
+# Presigned urls still valid for reuse. Created on first use.
+_url_cache = None
+_url_cache_lock = threading.Lock()
+
+
+class PresignedUrlCache(object):
+    """
+    LRU cache of presigned urls, keyed by object store, method, key, content type, expiry and expiry window. A window
+    is half of the url's expiry, so a url is only reused within the window it was signed in and is always handed out
+    with at least half of its lifetime left.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._urls = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0}
+
+    def get_or_sign(self, store, method, key, expires_in, content_type=None):
+        window = int(time.time() // max(1, expires_in // 2))
+        cache_key = (store.name, method, key, content_type, expires_in, window)
+        with self._lock:
+            url = self._urls.get(cache_key)
+            if url is not None:
+                self._urls.move_to_end(cache_key)
+                self.counters["hits"] += 1
+                return url
+            self.counters["misses"] += 1
+
+        url = store.presign(method, key, expires_in, content_type)
+        if self.max_size > 0:
+            with self._lock:
+                self._urls[cache_key] = url
+                while len(self._urls) > self.max_size:
+                    self._urls.popitem(last=False)
+        return url
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats.update({"entries": len(self._urls), "max_size": self.max_size})
+        return stats
+
+
+def get_presigned_url_cache():
+    global _url_cache
+
+    if _url_cache is None:
+        with _url_cache_lock:
+            if _url_cache is None:
+                _url_cache = PresignedUrlCache(int(current_app.config.get('PRESIGNED_URL_CACHE_SIZE', 10000)))
+    return _url_cache
+
+
+def presigned_url_cache_stats():
+    return _url_cache.stats() if _url_cache is not None else {}
 
 
 def include_s3_data(endpoint, documents):
-    """Replaces a list of S3 IDs in the `attachments` field with data from S3 stored under those IDs."""
+    """
+    Replaces a list of S3 IDs in the `attachments` field with data from the object store (see object_store.py) stored
+    under those IDs.
+
+    In "reference" attachment mode (see attachment_mode), each ID is replaced with a short-lived presigned GET url and
+    the object's size and content type instead of its content.
+    """
     # If not configured to use S3 Attachments, don't modify documents array
     if not current_app.config.get('S3_ATTACHMENTS') == "True":
         return documents
 
-    current_app.logger.info('Fetching data for attachments from S3.')
+    mode = attachment_mode(endpoint)
+    current_app.logger.info('Fetching {} for attachments from S3.'.format('references' if mode == 'reference'
+                                                                         else 'data'))
+    fetch = get_s3_reference if mode == 'reference' else get_s3_object
 
-    s3 = boto3.client(
-        's3',
-        aws_access_key_id=current_app.config.get('AWS_ACCESS_KEY'),
-        aws_secret_access_key=current_app.config.get('AWS_SECRET_KEY'),
-        config=Config(signature_version='s3v4')
-    )
+    concurrency = int(current_app.config.get('S3_REQUEST_CONCURRENCY', 8))
+    store = get_object_store()
 
-    # v1 - brute force, get each id in serial. Replace with multi-stream download
+    # Gather the attachment keys of every document in the response, then download them all in parallel
+    doc_keys = []
     for doc in documents:
         try:
-            attachment_data = []
             attachments = doc.get('attachments', {}).get('documents')
-            if attachments is not None and len(attachments) > 0:
-                for s3key in attachments:
-                    attachment_data.append(get_s3_object(s3, s3key))
-            doc['attachments'] = attachment_data
         except Exception as exc:
-            print('Exception: {}'.format(exc))
+            current_app.logger.error('Invalid attachments in document {}: {}'.format(doc.get('_id'), exc))
+            attachments = None
+        doc_keys.append(list(attachments or []))
+
+    # Documents often share attachments (templates, standard forms), so fetch each distinct key once
+    unique_keys = list(OrderedDict.fromkeys(key for keys in doc_keys for key in keys))
+    results = dict(zip(unique_keys, fetch_s3_objects(store, unique_keys, concurrency, fetch)))
+    current_app.logger.debug('Fetched {} distinct S3 keys for {} attachment references'.format(
+        len(unique_keys), sum(len(keys) for keys in doc_keys)))
+
+    for doc, keys in zip(documents, doc_keys):
+        doc_results = [results[key] for key in keys]
+        # As before, a document whose attachments can't all be fetched keeps its list of S3 keys
+        if all(ok for ok, _ in doc_results):
+            doc['attachments'] = [dict(data) if isinstance(data, dict) else data for _, data in doc_results]
     return documents
 
 
-def get_s3_object(s3, s3key):
-    """Get data from S3 for a given object, based on its S3 key. Attempt to decode as UTF-8 and base64."""
-    att_obj = s3.get_object(
-        Bucket=current_app.config.get('AWS_S3_BUCKET_NAME'),
-        Key=s3key,
-        ResponseContentEncoding='utf-8'
-    )
-    att_body = att_obj['Body'].read()
-    att_data = None
+def attachment_mode(endpoint):
+    """
+    How attachments are returned for this read: "inline" (content) or "reference" (presigned urls). Taken from the
+    `attachment_mode` query parameter, else the resource's entry in ATTACHMENT_MODES, else ATTACHMENT_MODE.
+    """
+    mode = request.args.get('attachment_mode') or \
+        current_app.config.get('ATTACHMENT_MODES', {}).get(endpoint) or \
+        current_app.config.get('ATTACHMENT_MODE', 'inline')
+    if mode not in ('inline', 'reference'):
+        abort(400, description='attachment_mode must be "inline" or "reference"')
+    return mode
+
+
+def get_s3_reference(store, s3key):
+    """Describe an object with a presigned GET url, its size and content type, without downloading it."""
+    expires_in = int(current_app.config.get('ATTACHMENT_URL_EXPIRY', 300))
+    head = store.head_object(s3key)
+    url = get_presigned_url_cache().get_or_sign(store, 'get', s3key, expires_in)
+    return {
+        "key": s3key,
+        "url": url,
+        "size": head.get('size'),
+        "content_type": head.get('content_type'),
+        "expires_in": expires_in
+    }
+
+
+def fetch_s3_objects(store, keys, concurrency, fetch_one=None):
+    """
+    Fetch objects in parallel, at most `concurrency` at a time for this request and S3_MAX_CONCURRENCY at a
+    time across the worker. Returns an (ok, data) tuple for each key, in the same order as keys.
+
+    fetch_one(store, key) does the work for one key; it defaults to downloading the object with get_s3_object.
+    """
+    if fetch_one is None:
+        fetch_one = get_s3_object
+    if not keys:
+        return []
+
+    app = current_app._get_current_object()
+    slots = global_fetch_slots(app.config)
+
+    def fetch(key):
+        with slots, app.app_context():
+            return fetch_one(store, key)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(keys))) as pool:
+        futures = [pool.submit(fetch, key) for key in keys]
+        for key, future in zip(keys, futures):
+            try:
+                results.append((True, future.result()))
+            except Exception as exc:
+                current_app.logger.error('Failed to fetch S3 key {}: {}'.format(key, exc))
+                results.append((False, None))
+    return results
+
+
+def global_fetch_slots(config):
+    global _global_fetch_slots
+
+    if _global_fetch_slots is None:
+        with _global_fetch_slots_lock:
+            if _global_fetch_slots is None:
+                _global_fetch_slots = threading.BoundedSemaphore(int(config.get('S3_MAX_CONCURRENCY', 32)))
+    return _global_fetch_slots
+
+
+def get_s3_object(store, s3key):
+    """
+    Get data from the object store for a given object, based on its S3 key, decoded by decode_s3_body.
+
+    If the attachment cache is enabled, a cached copy is revalidated with a conditional GET on its ETag and reused
+    when the store answers Not Modified.
+    """
+    cache = get_attachment_cache()
+    cached = cache.lookup(s3key) if cache is not None else None
+    if cached is not None and cached[2]:
+        cache.record('hits')
+        return cached[1]
+
+    try:
+        att_obj = store.get_object(s3key, if_none_match=cached[0] if cached is not None else None)
+    except NotModified:
+        cache.record('hits')
+        cache.record('revalidated')
+        return cached[1]
+
+    if cached is not None:
+        cache.record('stale')
+    att_data = decode_s3_body(s3key, att_obj['body'], att_obj.get('content_type'))
+    if cache is not None:
+        cache.put(s3key, att_obj.get('etag'), att_data)
+    return att_data
 
-    # Replace with logic based on content-type if that is added to S3
+
+def decode_s3_body(s3key, att_body, content_type=None):
+    """
+    Decode an S3 object body with the decoder registered for its content type (see decoders.py). Objects without a
+    registered content type, e.g. uploaded before content types were recorded, are decoded as UTF-8, then as base64.
+    """
+    decoder = get_decoder(content_type)
+    if decoder is not None:
+        try:
+            return decoder(att_body)
+        except ValueError as exc:
+            current_app.logger.warning('Cannot decode S3 key {} as {}: {}'.format(s3key, content_type, exc))
+
+    att_data = None
     try:
         att_data = att_body.decode('utf-8')
         return att_data
@@ -60,6 +251,46 @@ def get_s3_object(s3, s3key):
     return str(att_body)
 
 
+def stream_attachment(resource, oid, n):
+    """
+    GET /<resource>/<id>/attachments/<n> - stream the n-th attachment of a document from the object store, without
+    decoding it or holding it in memory. The document is read through the redaction pipeline first, so the user must be
+    allowed to see the document and its attachments field. Supports HTTP Range requests.
+    """
+    domain = current_app.config['DOMAIN']
+    if not current_app.config.get('S3_ATTACHMENTS') == "True" or resource not in domain or \
+            'aggregation' not in domain[resource].get('datasource', {}):
+        abort(404)
+
+    require_auth(resource, 'GET')
+
+    try:
+        document = read_redacted_document(resource, {"_id": ObjectId(oid)}) or {}
+    except (InvalidId, TypeError):
+        abort(404)
+    keys = (document.get('attachments') or {}).get('documents') or []
+    if n >= len(keys):
+        abort(404)
+
+    try:
+        att_obj = get_object_store().open_object(keys[n], request.headers.get('Range'))
+    except InvalidRange:
+        abort(416)
+    except ObjectNotFound:
+        abort(404)
+    return object_response(att_obj)
+
+
+def read_redacted_document(resource, match):
+    """Read one document through the same redaction pipeline as GET /<resource>. None if not found or not visible."""
+    pipeline = [{"$match": match}]
+    add_ascl_redaction(resource, pipeline)
+    source = current_app.config['DOMAIN'][resource]['datasource'].get('source', resource)
+    for document in get_db()[source].aggregate(pipeline):
+        return document
+    return None
+
+
 def generate_presigned_urls(resource, request, lookup=None):
     """
     Create presigned urls for each element in the request attachment.documents list. Uses the value in the
@@ -74,43 +305,143 @@ def generate_presigned_urls(resource, request, lookup=None):
     current_app.logger.info('Generating S3 presigned urls for attachments.')
 
     # Get list of doc IDs out of request.data.attachments.documents
-    req_data = json.loads(request.data)
+    req_data = request_body()
     docs = req_data.get('attachments', {}).get('documents')
     if docs is None or len(docs) == 0:
         return
 
+    # Each doc is a string that will be the S3 key. Docs declared (in attachments.sizes) to be at least
+    # ATTACHMENT_MULTIPART_THRESHOLD bytes are uploaded in parts.
+    sizes = req_data.get('attachments', {}).get('sizes') or []
+    content_types = req_data.get('attachments', {}).get('content_types') or []
+    content_types = [content_types[i] if i < len(content_types) else None for i in range(len(docs))]
+    threshold = int(current_app.config.get('ATTACHMENT_MULTIPART_THRESHOLD', 100 * 1024 * 1024))
+    multipart = set(i for i, size in enumerate(sizes[:len(docs)]) if isinstance(size, int) and size >= threshold)
+
+    single = [i for i in range(len(docs)) if i not in multipart]
+    single_urls = iter(presign_urls([docs[i] for i in single], content_types=[content_types[i] for i in single]))
+    store = get_object_store()
     g.presigned_urls = []
+    for i, doc in enumerate(docs):
+        if i not in multipart:
+            g.presigned_urls.append(next(single_urls))
+            continue
+        try:
+            g.presigned_urls.append(presign_multipart_upload(store, doc, sizes[i], content_types[i]))
+        except Exception as exc:
+            current_app.logger.error('Failed to start multipart upload for S3 key {}: {}'.format(doc, exc))
+            g.presigned_urls.append(None)
 
-    for doc in docs:
-        # assume doc is a string that will be the S3 key
-        print('doc (aws key): {}'.format(doc))
-        presigned = get_presigned_url(doc)
-        g.presigned_urls.append(presigned)
+
+def presign_urls(keys, method='put', expires_in=None, content_types=None):
+    """
+    Presign urls for a batch of S3 keys with the shared object store, reusing cached urls that are still valid. Expiry
+    defaults to ATTACHMENT_UPLOAD_URL_EXPIRY. Returns a url for each key, in order, or None for a key that couldn't be
+    signed.
+
+    If content_types are given, each url is signed with the ContentType for its key, so S3 records the content type
+    that later selects how the object is decoded. The upload must then send the same Content-Type header.
+    """
+    if expires_in is None:
+        expires_in = int(current_app.config.get('ATTACHMENT_UPLOAD_URL_EXPIRY', 3600))
+    store = get_object_store()
+    cache = get_presigned_url_cache()
+
+    urls = []
+    for key, content_type in zip(keys, content_types or [None] * len(keys)):
+        try:
+            urls.append(cache.get_or_sign(store, method, key, expires_in, content_type or None))
+        except Exception as exc:
+            current_app.logger.error('Failed to presign S3 key {}: {}'.format(key, exc))
+            urls.append(None)
+    current_app.logger.debug('Presigned {} urls for {} keys'.format(method, len(keys)))
+    return urls
 
 
 def get_presigned_url(key):
-    """Create a presigned POST url for a given key."""
-    s3 = boto3.client(
-        's3',
-        aws_access_key_id=current_app.config.get('AWS_ACCESS_KEY'),
-        aws_secret_access_key=current_app.config.get('AWS_SECRET_KEY'),
-        config=Config(signature_version='s3v4')
-    )
+    """Create a presigned PUT url for a given key."""
+    return presign_urls([key])[0]
+
+
+def presign_multipart_upload(store, key, size, content_type=None):
+    """
+    Start a multipart upload for a key and presign an upload_part url for each part. Parts are
+    ATTACHMENT_MULTIPART_PART_SIZE bytes (at least S3_MIN_PART_SIZE, and more if the object would need over
+    S3_MAX_PARTS parts); the last part holds the rest. Upload ids are single use, so these urls are not cached. The
+    content type, if given, is set when the upload is created.
+    """
+    expires_in = int(current_app.config.get('ATTACHMENT_UPLOAD_URL_EXPIRY', 3600))
+    part_size = max(int(current_app.config.get('ATTACHMENT_MULTIPART_PART_SIZE', 64 * 1024 * 1024)),
+                    S3_MIN_PART_SIZE, -(-size // S3_MAX_PARTS))
+
+    upload_id = store.create_multipart_upload(key, content_type)
+    parts = []
+    for number in range(1, max(1, -(-size // part_size)) + 1):
+        parts.append({"part_number": number, "url": store.presign_part(key, upload_id, number, expires_in)})
+    return {"key": key, "upload_id": upload_id, "part_size": part_size, "parts": parts}
+
+
+def finish_multipart_upload(resource, action):
+    """
+    POST /<resource>/attachments/multipart/complete (or /abort) - complete or abort a multipart attachment upload
+    started by a POST. The body is {"key": ..., "upload_id": ...} and, to complete, "parts": a list of
+    {"part_number": ..., "etag": ...} from the part uploads. The user must have write access to <resource>_write and
+    be allowed to modify a document that references the key, and its attachments field.
+    """
+    domain = current_app.config['DOMAIN']
+    write_resource = '{}_write'.format(resource)
+    if not current_app.config.get('S3_ATTACHMENTS') == "True" or resource not in domain or \
+            write_resource not in domain or action not in ('complete', 'abort'):
+        abort(404)
+
+    require_auth(write_resource, 'PATCH')
 
+    body = request_body()
+    if not isinstance(body, dict):
+        abort(400, description='Expected a JSON object')
+    key = body.get('key')
+    upload_id = body.get('upload_id')
+    if not key or not upload_id:
+        abort(400, description='key and upload_id are required')
+
+    check_attachment_write_perms(write_resource, key)
+
+    store = get_object_store()
     try:
-        post = s3.generate_presigned_url(
-            ClientMethod='put_object',
-            Params={
-                "Bucket": current_app.config.get('AWS_S3_BUCKET_NAME'),
-                "Key": key
-            }
-        )
-    except Exception as exc:
-        print('exception: {}'.format(exc))
-        return None
-    print('POST: {}'.format(post))
-
-    return post
+        if action == 'abort':
+            store.abort_multipart_upload(key, upload_id)
+            return jsonify({"key": key, "upload_id": upload_id, "status": "aborted"})
+
+        try:
+            parts = sorted((int(part['part_number']), part['etag']) for part in body.get('parts') or [])
+        except (KeyError, TypeError, ValueError):
+            abort(400, description='parts must be a list of {"part_number", "etag"}')
+        if not parts:
+            abort(400, description='parts are required to complete an upload')
+        etag = store.complete_multipart_upload(key, upload_id, parts)
+    except ObjectNotFound:
+        abort(404, description='Unknown upload_id')
+    except InvalidUpload as exc:
+        abort(400, description=str(exc))
+    return jsonify({"key": key, "upload_id": upload_id, "status": "completed", "etag": etag})
+
+
+def check_attachment_write_perms(write_resource, key):
+    """
+    Abort with 404 if no document references the attachment key, or 403 if the user isn't allowed to modify any of the
+    documents that do (the document-level label, and the label of the attachments field), as check_perms_in_db would.
+    """
+    rsc = write_resource[:-6]
+    fields = [path for path in get_security_descriptor(rsc).field_paths(include_arrays=False) if path == 'attachments']
+    pipeline = make_match_perm_check_pipeline({"attachments.documents": key}, fields)
+    source = current_app.config['DOMAIN'][write_resource].get('datasource', {}).get('source', write_resource)
+    documents = list(get_db()[source].aggregate(pipeline))
+    if not documents:
+        abort(404)
+    if not any(has_doc_perms(doc) and all(has_field_perms(path, doc) for path in fields) for doc in documents):
+        current_app.logger.info('User {} has insufficient permissions to finish an upload of {} attachments'.format(
+            g.user, rsc))
+        abort(403)
 
 
 def include_presigned_urls(resource, request, payload):
@@ -1,5 +1,9 @@
+from collections import namedtuple
+
+
 class Schema(object):
     _all_schemas = {}
+    _descriptors = {}
 
     @property
     def all_schemas(self):
@@ -9,6 +13,50 @@ class Schema(object):
     def all_schemas(self, val):
         type(self)._all_schemas = val
 
+    @property
+    def descriptors(self):
+        return type(self)._descriptors
+
+    @descriptors.setter
+    def descriptors(self, val):
+        type(self)._descriptors = val
+
+
+# A field tagged with `_sec`. `path` is the full dotted path ("" for the document-level label), `depth` the number
+# of path segments and `in_array` whether any segment of the path is a list of subdocuments.
+SecurityField = namedtuple('SecurityField', ['path', 'depth', 'in_array'])
+
+
+class SecurityDescriptor(object):
+    """Immutable, precompiled index of the ASCL-tagged fields of one resource."""
+    __slots__ = ('_resource', '_fields')
+
+    def __init__(self, resource, fields):
+        object.__setattr__(self, '_resource', resource)
+        object.__setattr__(self, '_fields', tuple(fields))
+
+    def __setattr__(self, key, value):
+        raise AttributeError('SecurityDescriptor is immutable')
+
+    @property
+    def resource(self):
+        return self._resource
+
+    @property
+    def fields(self):
+        return self._fields
+
+    @property
+    def paths(self):
+        """Dotted paths of all security enabled fields, starting with "" for the document-level label."""
+        return tuple(field.path for field in self._fields)
+
+    def field_paths(self, include_arrays=True):
+        return tuple(field.path for field in self._fields if include_arrays or not field.in_array)
+
+    def __repr__(self):
+        return 'SecurityDescriptor({!r}, {!r})'.format(self._resource, self._fields)
+
 
 ascl = {
     "type": "dict",
@@ -25,7 +73,9 @@ attachment = {
     "type": "dict",
     "schema": {
         "_sec": ascl,
-        "documents": {"type": "list"}
+        "documents": {"type": "list"},
+        "sizes": {"type": "list", "schema": {"type": "integer"}},
+        "content_types": {"type": "list", "schema": {"type": "string"}}
     }
 }
 
@@ -60,6 +110,7 @@ schema_stub = {
 def update_schema(schema_definition):
     sc = Schema()
     sc.all_schemas = schema_stub
+    sc.descriptors = {}  # Compiled descriptors are stale once the schema changes
     for schema in schema_definition:
         sc.all_schemas[schema] = schema_definition[schema]
         for var in schema_definition[schema].get("vars", {}):
@@ -75,18 +126,55 @@ def get_schema(schema_name):
 
 def get_security_enabled_fields(schema_name):
     """Get list of fields with ASCL applied from the schema."""
-    schema = get_schema(schema_name)
-    return parse(schema, [""])
+    return list(get_security_descriptor(schema_name).paths)
+
+
+def get_security_descriptor(schema_name):
+    """Get the compiled security descriptor for a resource, compiling it on first use."""
+    sc = Schema()
+    descriptor = sc.descriptors.get(schema_name)
+    if descriptor is None:
+        descriptor = compile_security_descriptor(schema_name)
+        sc.descriptors[schema_name] = descriptor
+    return descriptor
 
 
-def parse(current, fields):
+def compile_security_descriptors():
+    """(Re)build the security descriptors for every registered schema. Call whenever the schemas change."""
+    sc = Schema()
+    sc.descriptors = {name: compile_security_descriptor(name) for name in sc.all_schemas}
+    return sc.descriptors
+
+
+def compile_security_descriptor(schema_name):
+    """Walk a resource schema once and record every ASCL-tagged field."""
+    # The document-level label is always enforced, whether or not the schema declares it
+    fields = [SecurityField('', 0, False)]
+    parse(get_schema(schema_name), fields, '', 0, False)
+    return SecurityDescriptor(schema_name, fields)
+
+
+def parse(current, fields, prefix, depth, in_array):
     """Recursive method to identify ASCL-tagged fields in schema."""
-    if type(current) == dict:
-        for key, value in current.items():
-            if type(value) == dict and value.get('schema') is not None:
-                # Check if this schema includes security rules
-                if value.get('schema').get('_sec') is not None:
-                    fields.append(key)
-                # Recurse on any key that has schema fields
-                fields = parse(value.get('schema'), fields)
+    if type(current) != dict:
+        return fields
+    for key, value in current.items():
+        if key == '_sec' or type(value) != dict or type(value.get('schema')) != dict:
+            continue
+
+        path = '{}.{}'.format(prefix, key) if prefix else key
+        sub_schema = value.get('schema')
+        is_array = False
+        if value.get('type') == 'list':
+            # Lists of subdocuments declare the subdocument's fields in the item rule's schema
+            if sub_schema.get('type') != 'dict' or type(sub_schema.get('schema')) != dict:
+                continue
+            sub_schema = sub_schema.get('schema')
+            is_array = True
+
+        # Check if this schema includes security rules
+        if sub_schema.get('_sec') is not None:
+            fields.append(SecurityField(path, depth + 1, in_array or is_array))
+        # Recurse on any key that has schema fields
+        parse(sub_schema, fields, path, depth + 1, in_array or is_array)
     return fields
@@ -1,10 +1,42 @@
 import os
 import json
-from schema import get_schema, update_schema
+from schema import get_schema, update_schema, compile_security_descriptors
 
 MONGO_HOST = os.environ['MONGO_HOST']
 MONGO_PORT = os.getenv('MONGO_PORT', 27017)
 
+# In-process cache of user security contexts (see user_context.py). Set the size to 0 to disable.
+USER_CONTEXT_CACHE_SIZE = int(os.getenv('USER_CONTEXT_CACHE_SIZE', 1000))
+USER_CONTEXT_CACHE_TTL = float(os.getenv('USER_CONTEXT_CACHE_TTL', 30))
+USER_CONTEXT_CACHE_WATCH = os.getenv('USER_CONTEXT_CACHE_WATCH', "True")
+# Seconds between checks of the cached users when their permissions can't be followed with a change stream
+USER_CONTEXT_CACHE_POLL_INTERVAL = float(os.getenv('USER_CONTEXT_CACHE_POLL_INTERVAL', 5))
+# Database holding charon_user_permissions. Mongo doesn't allow change streams on admin.
+USER_PERMISSIONS_DB = os.getenv('USER_PERMISSIONS_DB', 'admin')
+
+# Redaction engine for reads: "legacy" (per-field match stages) or "single_pass" (one inline $redact)
+REDACTION_ENGINE = os.getenv('REDACTION_ENGINE', 'legacy')
+# Filter out documents the user can't see with an index-backed $match before redaction
+REDACTION_PREFILTER = os.getenv('REDACTION_PREFILTER', "True")
+# Create missing _sec.cat / _sec.diss indexes for every secured field when a worker starts (see indexes.py)
+INDEX_SYNC_ON_STARTUP = os.getenv('INDEX_SYNC_ON_STARTUP', "True")
+# PATCH and DELETE an item with one find_one_and_update / find_one_and_delete, filtered on the user's labels and etag
+ATOMIC_WRITES = os.getenv('ATOMIC_WRITES', "False")
+# Etag stored by an atomic PATCH: "content" (a hash of the document, as Eve; reads the document first) or "token"
+ATOMIC_WRITES_ETAG = os.getenv('ATOMIC_WRITES_ETAG', 'content')
+
+# Opt-in keyset pagination for reads (see pagination.py). Page sizes use Eve's PAGINATION_DEFAULT / PAGINATION_LIMIT.
+KEYSET_PAGINATION = os.getenv('KEYSET_PAGINATION', "False")
+KEYSET_PAGINATION_KEY = os.getenv('KEYSET_PAGINATION_KEY', '_id')
+PAGINATION_DEFAULT = int(os.getenv('PAGINATION_DEFAULT', 25))
+PAGINATION_LIMIT = int(os.getenv('PAGINATION_LIMIT', 1000))
+
+# Documents per chunk (and per after_aggregation call) for GET /<resource>/stream
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', 100))
+
+# Largest number of documents accepted by POST, PATCH and DELETE /<resource>/bulk
+BULK_MAX_DOCUMENTS = int(os.getenv('BULK_MAX_DOCUMENTS', 10000))
+
 X_DOMAIN = "*"
 X_HEADERS = ["Access-Control-Allow-Origin", "Access-Control-Allow-Headers"]
 X_EXPOSE_HEADERS = ["Access-Control-Allow-Origin", "Access-Control-Allow-Headers"]
@@ -14,10 +46,55 @@ MONGO_PASSWORD = os.getenv("MONGO_PASSWORD", "")
 MONGO_AUTH_SOURCE = os.getenv("MONGO_AUTH_SOURCE", "admin")
 MONGO_DBNAME = os.environ['MONGO_DBNAME']
 
+# Connection pool for the MongoClient shared by each worker (see mongo.py)
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 100))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', 0))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv('MONGO_MAX_IDLE_TIME_MS', 60000))
+
 AWS_ACCESS_KEY = os.getenv('AWS_ACCESS_KEY', "")
 AWS_SECRET_KEY = os.getenv('AWS_SECRET_KEY', "")
 AWS_S3_BUCKET_NAME = 'test_bucket'
 S3_ATTACHMENTS = os.getenv('S3_ATTACHMENTS', False)
+# Where attachment objects are kept: "s3" or "local" (a directory served through signed /_objects urls)
+OBJECT_STORE = os.getenv('OBJECT_STORE', 's3')
+OBJECT_STORE_LOCAL_DIR = os.getenv('OBJECT_STORE_LOCAL_DIR', '/data/attachments')
+OBJECT_STORE_LOCAL_SECRET = os.getenv('OBJECT_STORE_LOCAL_SECRET', "")
+OBJECT_STORE_LOCAL_URL = os.getenv('OBJECT_STORE_LOCAL_URL', "")
+# Parallel attachment downloads: per request, per worker, and the per-object connect/read timeout in seconds
+S3_REQUEST_CONCURRENCY = int(os.getenv('S3_REQUEST_CONCURRENCY', 8))
+S3_MAX_CONCURRENCY = int(os.getenv('S3_MAX_CONCURRENCY', 32))
+S3_OBJECT_TIMEOUT = float(os.getenv('S3_OBJECT_TIMEOUT', 30))
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', 32))
+# Cache of decoded attachment content: "off", "memory" or "disk" (see attachment_cache.py)
+ATTACHMENT_CACHE = os.getenv('ATTACHMENT_CACHE', 'off')
+ATTACHMENT_CACHE_BYTES = int(os.getenv('ATTACHMENT_CACHE_BYTES', 64 * 1024 * 1024))
+ATTACHMENT_CACHE_MAX_ITEM_BYTES = int(os.getenv('ATTACHMENT_CACHE_MAX_ITEM_BYTES', 8 * 1024 * 1024))
+ATTACHMENT_CACHE_DIR = os.getenv('ATTACHMENT_CACHE_DIR', '/tmp/charon-attachments')
+ATTACHMENT_CACHE_FRESH_SECONDS = float(os.getenv('ATTACHMENT_CACHE_FRESH_SECONDS', 0))
+# Return attachments as content ("inline") or presigned GET urls ("reference"); ATTACHMENT_MODES overrides per resource
+ATTACHMENT_MODE = os.getenv('ATTACHMENT_MODE', 'inline')
+ATTACHMENT_MODES = json.loads(os.getenv('ATTACHMENT_MODES', '{}'))
+ATTACHMENT_URL_EXPIRY = int(os.getenv('ATTACHMENT_URL_EXPIRY', 300))
+# Read size when streaming attachments from GET /<resource>/<id>/attachments/<n>
+ATTACHMENT_CHUNK_SIZE = int(os.getenv('ATTACHMENT_CHUNK_SIZE', 64 * 1024))
+# Expiry of presigned attachment upload urls in seconds, and how many presigned urls each worker keeps for reuse
+ATTACHMENT_UPLOAD_URL_EXPIRY = int(os.getenv('ATTACHMENT_UPLOAD_URL_EXPIRY', 3600))
+PRESIGNED_URL_CACHE_SIZE = int(os.getenv('PRESIGNED_URL_CACHE_SIZE', 10000))
+# Attachments declared (in attachments.sizes) at least this large are uploaded in parts of this size
+ATTACHMENT_MULTIPART_THRESHOLD = int(os.getenv('ATTACHMENT_MULTIPART_THRESHOLD', 100 * 1024 * 1024))
+ATTACHMENT_MULTIPART_PART_SIZE = int(os.getenv('ATTACHMENT_MULTIPART_PART_SIZE', 64 * 1024 * 1024))
+# Extra content type -> attachment decoder mappings, e.g. {"application/vnd.ms-excel": "binary"} (see decoders.py)
+ATTACHMENT_DECODERS = json.loads(os.getenv('ATTACHMENT_DECODERS', '{}'))
+# Delete a document's attachments from the object store when the document is deleted (see attachment_cleanup.py)
+ATTACHMENT_CASCADE_DELETE = os.getenv('ATTACHMENT_CASCADE_DELETE', "False")
+ATTACHMENT_DELETE_QUEUE = os.getenv('ATTACHMENT_DELETE_QUEUE', 'charon_attachment_deletions')
+ATTACHMENT_DELETE_BATCH = int(os.getenv('ATTACHMENT_DELETE_BATCH', 1000))
+ATTACHMENT_DELETE_MAX_ATTEMPTS = int(os.getenv('ATTACHMENT_DELETE_MAX_ATTEMPTS', 5))
+ATTACHMENT_DELETE_RETRY_SECONDS = float(os.getenv('ATTACHMENT_DELETE_RETRY_SECONDS', 30))
+ATTACHMENT_DELETE_INTERVAL = float(os.getenv('ATTACHMENT_DELETE_INTERVAL', 10))
+ATTACHMENT_DELETE_GRACE_SECONDS = float(os.getenv('ATTACHMENT_DELETE_GRACE_SECONDS', 300))
+ATTACHMENT_DELETE_CLAIM_TIMEOUT = float(os.getenv('ATTACHMENT_DELETE_CLAIM_TIMEOUT', 600))
 
 RENDERERS = [
     'eve.render.JSONRenderer'
@@ -50,6 +127,7 @@ def register_schema(schema):
         }
         DOMAIN[rsc] = rsc_read
         DOMAIN['{}_write'.format(rsc)] = rsc_write
+    compile_security_descriptors()
 
 
 SCHEMA = json.loads(os.environ['SCHEMA'])
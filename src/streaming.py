@@ -0,0 +1,90 @@
+import copy
+import json
+
+from flask import g, request, current_app, abort, Response, stream_with_context
+from mongo import get_db
+from auth import require_auth
+
+
+def stream_resource(resource):
+    """
+    GET /<resource>/stream - read a resource like GET /<resource>, but write documents to the response as they come
+    off the cursor (chunked transfer encoding) instead of building the whole response in memory.
+
+    The same before_aggregation hooks (redaction) and after_aggregation hooks (e.g. include_s3_data) run as for a
+    normal read; after_aggregation hooks run on each batch of STREAM_BATCH_SIZE documents. Keyset pagination is not
+    applied to streamed reads.
+    """
+    domain = current_app.config['DOMAIN']
+    if resource not in domain or 'aggregation' not in domain[resource].get('datasource', {}):
+        abort(404)
+
+    require_auth(resource, 'GET')
+
+    g._streaming = True
+    pipeline = build_pipeline(resource)
+    getattr(current_app, 'before_aggregation')(resource, pipeline)
+    getattr(current_app, 'before_aggregation_{}'.format(resource))(pipeline)
+    current_app.logger.debug('Streaming pipeline: {}'.format(pipeline))
+
+    batch_size = int(current_app.config.get('STREAM_BATCH_SIZE', 100))
+    source = domain[resource]['datasource'].get('source', resource)
+    # Convert ids and dates in the pipeline the same way Eve does for aggregation reads
+    pipeline = current_app.data._mongotize({'key': pipeline}, resource)['key']
+    cursor = get_db()[source].aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+
+    return Response(stream_with_context(generate(resource, cursor, batch_size)), mimetype='application/json')
+
+
+def build_pipeline(resource):
+    """Copy the resource's aggregation pipeline and substitute the variables in the `aggregate` query parameter."""
+    pipeline = copy.deepcopy(current_app.config['DOMAIN'][resource]['datasource']['aggregation']['pipeline'])
+    try:
+        variables = json.loads(request.args.get('aggregate', '{}'))
+    except ValueError:
+        abort(400, description='Unable to parse `aggregate` query parameter')
+    for key, value in variables.items():
+        pipeline = substitute(pipeline, key, value)
+    return pipeline
+
+
+def substitute(node, key, value):
+    if isinstance(node, dict):
+        return {k: substitute(v, key, value) for k, v in node.items()}
+    if isinstance(node, list):
+        return [substitute(v, key, value) for v in node]
+    return value if node == key else node
+
+
+def generate(resource, cursor, batch_size):
+    """Yield the response body: `{"_items": [` then each batch of documents as it is read, then `]}`."""
+    encoder = current_app.data.json_encoder_class
+    separator = ''
+    try:
+        yield '{"_items": ['
+        batch = []
+        for document in cursor:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                chunk = render_batch(resource, batch, encoder)
+                if chunk:
+                    yield separator + chunk
+                    separator = ','
+                batch = []
+        if batch:
+            chunk = render_batch(resource, batch, encoder)
+            if chunk:
+                yield separator + chunk
+        yield ']}'
+    except Exception as exc:
+        # Headers are already sent, so the only way to signal failure is to end with invalid JSON
+        current_app.logger.error('Error streaming {}: {}'.format(resource, exc))
+    finally:
+        cursor.close()
+
+
+def render_batch(resource, documents, encoder):
+    """Run the after_aggregation hooks on a batch and serialize it."""
+    getattr(current_app, 'after_aggregation')(resource, documents)
+    getattr(current_app, 'after_aggregation_{}'.format(resource))(documents)
+    return ','.join(json.dumps(document, cls=encoder) for document in documents)
@@ -0,0 +1,122 @@
+"""
+Apps and database fixtures shared by test modules that exercise the redaction (fees) and update (signature) setups.
+Test modules mix these into their own unittest.TestCase classes and call the populate functions from their own
+pytest fixtures, so no test class is imported (and collected) twice.
+"""
+import os
+import json
+import base64
+
+from eve import Eve
+from pymongo import MongoClient
+from auth import check_insert_access, check_insert_data_context, CharonAuth
+from aggregators import add_ascl_redaction
+from update import check_perms_in_db
+from s3 import include_s3_data, generate_presigned_urls, include_presigned_urls
+
+MONGO_DBNAME = 'dbz-mongo-test'
+MONGO_HOST = '127.0.0.1'
+
+FIXTURES_PATH = os.path.dirname(os.path.abspath(__file__))
+TEST_SETTINGS = os.path.join(os.path.dirname(FIXTURES_PATH), 'settings.py')
+
+FEES_SCHEMA = '{"fees": {"Block": {"type": "string"},"Boro": {"type": "string"},"BoroID": {"type": "string"},"BuildingID": {"type": "string"},"DoFAccountType": {"type": "string"},"DoFTransferDate": {"type": "string"},"FeeAmount": {"type": "string"},"FeeID": {"type": "string"},"FeeIssuedDate": {"type": "string"},"FeeSourceID": {"type": "string"},"FeeSourceType": {"type": "string"},"FeeSourceTypeID": {"type": "string"},"FeeType": {"type": "string"},"FeeTypeID": {"type": "string"},"HouseNumber": {"type": "string"},"LifeCycle": {"type": "string"},"Lot": {"type": "string"},"StreetName": {"type": "string"},"Zip": {"type": "string"},"_sec": {"schema": {"cat": {"type": "string"},"diss": {"schema": {"type": "string"},"type": "list"}},"type": "dict"},"attachments": {"schema": {"_sec": {"schema": {"cat": {"type": "string"},"diss": {"schema": {"type": "string"},"type": "list"}},"type": "dict"},"documents": {"type": "list"}},"type": "dict"},"vars": {}},"fees_nested": {"Block": {"type": "string"},"Boro": {"type": "string"},"BoroID": {"type": "string"},"BuildingID": {"type": "string"},"DoFAccountType": {"type": "string"},"DoFTransferDate": {"type": "string"},"FeeAmount": {"type": "string"},"FeeID": {"schema": {"_sec": {"schema": {"cat": {"type": "string"},"diss": {"schema": {"type": "string"},"type": "list"}},"type": "dict"},"value": {"type": "string"}},"type": "dict"},"FeeIssuedDate": {"type": "string"},"FeeSourceID": {"type": "string"},"FeeSourceType": {"type": "string"},"FeeSourceTypeID": {"type": "string"},"FeeType": {"type": "string"},"FeeTypeID": {"type": "string"},"HouseNumber": {"type": "string"},"LifeCycle": {"type": "string"},"Lot": {"type": "string"},"StreetName": {"type": "string"},"Zip": {"type": "string"},"_sec": {"schema": {"cat": {"type": "string"},"diss": {"schema": {"type": "string"},"type": "list"}},"type": "dict"},"vars": {}}}'
+
+SIGNATURE_SCHEMA = '{"signature": {"_sec": {"schema": {"cat": {"type": "string"},"diss": {"schema": {"type": "string"},"type": "list"}},"type": "dict"},"attachments": {"schema": {"_sec": {"schema": {"cat": {"type": "string"},"diss": {"schema": {"type": "string"},"type": "list"}},"type": "dict"},"documents": {"type": "list"}},"type": "dict"},"date": {"type": "string"},"field_ref_id": {"type": "string"},"name": {"type": "string"},"signature": {"schema": {"_sec": {"schema": {"cat": {"type": "string"},"diss": {"schema": {"type": "string"},"type": "list"}},"type": "dict"},"value": {"type": "string"}},"type": "dict"},"user_ref_id": {"type": "string"},"vars": {}}}'
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_PATH, name)) as f:
+        return json.load(f)
+
+
+def populate_users():
+    """Load fixtures/users.json into charon_user_permissions, unless it already has users."""
+    client = MongoClient(MONGO_HOST, 27017)
+    user_collection = client['admin']['charon_user_permissions']
+    if user_collection.count_documents({}) == 0:
+        user_collection.insert_many(load_fixture('users.json'))
+    client.close()
+
+
+def populate_fees():
+    """Load fixtures/fee_charges_sec.json into the fees collection, unless it already has documents."""
+    client = MongoClient(MONGO_HOST, 27017)
+    fee_collection = client[MONGO_DBNAME]['fees']
+    if fee_collection.count_documents({}) == 0:
+        fee_collection.insert_many(load_fixture('fee_charges_sec.json'))
+    client.close()
+
+
+def populate_signatures():
+    """Reset the signature collection to fixtures/signature_sec.json."""
+    client = MongoClient(MONGO_HOST, 27017)
+    coll = client[MONGO_DBNAME]['signature']
+    coll.delete_many({})
+    coll.insert_many(load_fixture('signature_sec.json'))
+    client.close()
+
+
+def make_headers(username, password):
+    """Add standard headers - Basic Authorization and JSON content type. Pass auth string as decoded base64."""
+    cred_str = '{}:{}'.format(username, password).encode('utf-8')
+    creds = base64.b64encode(cred_str).decode('utf-8')
+    headers = {'Content-Type': 'application/json',
+               'Authorization': 'Basic {}'.format(creds)}
+    return headers
+
+
+def make_app(schema):
+    os.environ['TEST_SCHEMA'] = schema
+    app = Eve(settings=TEST_SETTINGS, auth=CharonAuth)
+    app.config['TESTING'] = True
+    app.config['DEBUG'] = True
+    app.config['MONGO_DBNAME'] = MONGO_DBNAME
+    app.config['MONGO_HOST'] = MONGO_HOST
+    app.testing = True
+    return app
+
+
+class RedactionAppMixin(object):
+    """The app, schema (fees, fees_nested) and hooks of test_redaction."""
+
+    def setUp(self):
+        self.app = make_app(FEES_SCHEMA)
+        self.app.on_pre_POST += check_insert_data_context
+        self.app.on_pre_POST += check_insert_access
+        self.app.before_aggregation += add_ascl_redaction
+        self.client = self.app.test_client()
+
+
+class UpdateAppMixin(object):
+    """The app, schema (signature) and hooks of test_update."""
+
+    def setUp(self):
+        self.app = make_app(SIGNATURE_SCHEMA)
+        self.app.config['IF_MATCH'] = False
+
+        self.app.on_pre_POST += check_insert_data_context
+        self.app.on_pre_POST += check_insert_access
+        self.app.on_pre_POST += generate_presigned_urls
+
+        self.app.on_pre_PATCH += check_insert_data_context
+        self.app.on_pre_PATCH += check_insert_access
+        self.app.on_pre_PATCH += check_perms_in_db
+
+        self.app.on_post_POST += include_presigned_urls
+
+        self.app.before_aggregation += add_ascl_redaction
+        self.app.after_aggregation += include_s3_data
+        self.client = self.app.test_client()
+
+    def get_id_for_name(self, name):
+        """Get the ID for a signature item with a given name. ID is used in update URL"""
+        return str(self.get_db_object_by_name(name).get("_id"))
+
+    def get_db_object_by_name(self, name):
+        """Get the data from Mongo for a given ID"""
+        client = MongoClient(MONGO_HOST, 27017)
+        try:
+            return client[MONGO_DBNAME]['signature'].find({"name": name}).next()
+        finally:
+            client.close()
@@ -1,6 +1,6 @@
 import os
 import json
-from schema import get_schema, update_schema
+from schema import get_schema, update_schema, compile_security_descriptors
 
 X_DOMAIN = "*"
 X_HEADERS = ["Access-Control-Allow-Origin", "Access-Control-Allow-Headers"]
@@ -12,11 +12,66 @@ MONGO_AUTH_SOURCE = "admin"
 MONGO_DBNAME = "dbz-mongo-test"
 MONGO_HOST = "127.0.0.1"
 MONGO_PORT = 27017
+MONGO_MAX_POOL_SIZE = 10
+MONGO_MIN_POOL_SIZE = 0
+MONGO_WAIT_QUEUE_TIMEOUT_MS = 5000
+MONGO_MAX_IDLE_TIME_MS = 60000
+
+USER_CONTEXT_CACHE_SIZE = 1000
+USER_CONTEXT_CACHE_TTL = 30
+USER_CONTEXT_CACHE_WATCH = "True"
+USER_CONTEXT_CACHE_POLL_INTERVAL = 5
+USER_PERMISSIONS_DB = "admin"
+
+REDACTION_ENGINE = os.getenv('REDACTION_ENGINE', 'legacy')
+REDACTION_PREFILTER = os.getenv('REDACTION_PREFILTER', "True")
+INDEX_SYNC_ON_STARTUP = "False"
+ATOMIC_WRITES = "False"
+ATOMIC_WRITES_ETAG = "content"
+
+KEYSET_PAGINATION = "False"
+KEYSET_PAGINATION_KEY = '_id'
+PAGINATION_DEFAULT = 25
+PAGINATION_LIMIT = 1000
+
+STREAM_BATCH_SIZE = 100
+
+BULK_MAX_DOCUMENTS = 10000
 
 AWS_ACCESS_KEY = os.getenv('AWS_ACCESS_KEY', "")
 AWS_SECRET_KEY = os.getenv('AWS_SECRET_KEY', "")
 AWS_S3_BUCKET_NAME = os.getenv('AWS_S3_BUCKET_NAME', "")
 S3_ATTACHMENTS = os.getenv('S3_ATTACHMENTS', True)
+OBJECT_STORE = 's3'
+OBJECT_STORE_LOCAL_DIR = '/tmp/charon-test-objects'
+OBJECT_STORE_LOCAL_SECRET = ''
+OBJECT_STORE_LOCAL_URL = ''
+S3_REQUEST_CONCURRENCY = 8
+S3_MAX_CONCURRENCY = 32
+S3_OBJECT_TIMEOUT = 30
+S3_MAX_POOL_CONNECTIONS = 32
+ATTACHMENT_CACHE = 'off'
+ATTACHMENT_CACHE_BYTES = 1024 * 1024
+ATTACHMENT_CACHE_MAX_ITEM_BYTES = 128 * 1024
+ATTACHMENT_CACHE_DIR = '/tmp/charon-attachments-test'
+ATTACHMENT_CACHE_FRESH_SECONDS = 0
+ATTACHMENT_MODE = 'inline'
+ATTACHMENT_MODES = {}
+ATTACHMENT_URL_EXPIRY = 300
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+ATTACHMENT_UPLOAD_URL_EXPIRY = 3600
+PRESIGNED_URL_CACHE_SIZE = 10000
+ATTACHMENT_MULTIPART_THRESHOLD = 100 * 1024 * 1024
+ATTACHMENT_MULTIPART_PART_SIZE = 64 * 1024 * 1024
+ATTACHMENT_DECODERS = {}
+ATTACHMENT_CASCADE_DELETE = "False"
+ATTACHMENT_DELETE_QUEUE = 'charon_attachment_deletions'
+ATTACHMENT_DELETE_BATCH = 1000
+ATTACHMENT_DELETE_MAX_ATTEMPTS = 5
+ATTACHMENT_DELETE_RETRY_SECONDS = 30
+ATTACHMENT_DELETE_INTERVAL = 10
+ATTACHMENT_DELETE_GRACE_SECONDS = 0
+ATTACHMENT_DELETE_CLAIM_TIMEOUT = 600
 
 RENDERERS = [
     'eve.render.JSONRenderer'
@@ -49,6 +104,7 @@ def register_schema(schema):
         }
         DOMAIN[rsc] = rsc_read
         DOMAIN['{}_write'.format(rsc)] = rsc_write
+    compile_security_descriptors()
 
 
 SCHEMA = json.loads(os.getenv('TEST_SCHEMA', "{}"))  # Needs a valid default to load before tests set TEST_SCHEMA
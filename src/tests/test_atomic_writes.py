@@ -0,0 +1,109 @@
+import unittest
+import json
+import pytest
+from unittest import mock
+
+from pymongo import MongoClient
+from atomic_writes import install_atomic_writes
+from .fixtures.apps import UpdateAppMixin, make_headers, populate_signatures, populate_users, MONGO_HOST, \
+    MONGO_DBNAME
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_users():
+    populate_users()
+
+
+@pytest.fixture(autouse=True)
+def setup_signatures():
+    populate_signatures()
+
+
+class AtomicWritesTestCase(UpdateAppMixin, unittest.TestCase):
+    def setUp(self):
+        """Use the same app, schema and fixtures as test_update, with PATCH and DELETE served by atomic_write."""
+        UpdateAppMixin.setUp(self)
+        install_atomic_writes(self.app)
+
+    def patch(self, username, name, data, **headers):
+        headers.update(make_headers(username, 'password'))
+        return self.client.patch('/signature_write/{}'.format(self.get_id_for_name(name)), headers=headers,
+                                 data=json.dumps(data))
+
+    def test_atomic_patch_permissions(self):
+        """Test that an atomic PATCH is allowed and denied as check_perms_in_db would."""
+        data = {"signature": {"value": "atomic_changes", "_sec": {"cat": "usg_unclassified", "diss": []}}}
+
+        self.assertEqual(self.patch('us_unclassified_only', 'all_unclassified', data).status_code, 200)
+        self.assertEqual(self.patch('us_unclassified_only', 'doc_confidential', data).status_code, 403)
+        self.assertEqual(self.patch('us_unclassified_only', 'sig_confidential', data).status_code, 403)
+        self.assertEqual(self.patch('us_unclassified_only', 'sig_diss_controlled', data).status_code, 403)
+        self.assertEqual(self.patch('us_unclassified_only', 'sig_confidential', {"user_ref_id": "atomic"}).status_code,
+                         200)
+
+        self.assertEqual(self.get_db_object_by_name('all_unclassified').get('signature'), data['signature'])
+        self.assertEqual(self.get_db_object_by_name('sig_confidential').get('signature').get('value'),
+                         'testing_updates_1')
+
+    def test_atomic_patch_etag(self):
+        """Test that a wrong etag is 412, and the etag returned by a PATCH is the one to use next."""
+        self.app.config['IF_MATCH'] = True
+        data = {"user_ref_id": "atomic"}
+
+        self.assertEqual(self.patch('us_unclassified_only', 'all_unclassified', data).status_code, 428)
+        self.assertEqual(self.patch('us_unclassified_only', 'all_unclassified', data, **{'If-Match': 'wrong'})
+                         .status_code, 412)
+
+        client = MongoClient(MONGO_HOST, 27017)
+        client[MONGO_DBNAME]['signature'].update_one({'name': 'all_unclassified'}, {'$set': {'_etag': 'first'}})
+        client.close()
+        res = self.patch('us_unclassified_only', 'all_unclassified', data, **{'If-Match': 'first'})
+        self.assertEqual(res.status_code, 200)
+        etag = json.loads(res.data).get('_etag')
+        self.assertEqual(self.get_db_object_by_name('all_unclassified').get('_etag'), etag)
+        self.assertEqual(self.patch('us_unclassified_only', 'all_unclassified', data, **{'If-Match': 'first'})
+                         .status_code, 412)
+
+    def test_atomic_delete(self):
+        """Test that an atomic DELETE checks every secured field, and a missing document is 404."""
+        headers = make_headers('us_unclassified_only', 'password')
+        oid = self.get_id_for_name('sig_confidential')
+
+        self.assertEqual(self.client.delete('/signature_write/{}'.format(oid), headers=headers).status_code, 403)
+        oid = self.get_id_for_name('all_unclassified')
+        self.assertEqual(self.client.delete('/signature_write/{}'.format(oid), headers=headers).status_code, 204)
+        self.assertEqual(self.client.delete('/signature_write/{}'.format(oid), headers=headers).status_code, 404)
+
+    def test_atomic_write_single_operation(self):
+        """Test that without pre-write hooks or content etags a successful write doesn't read the document first."""
+        self.app.config['IF_MATCH'] = True
+        self.app.config['ENFORCE_IF_MATCH'] = False
+        self.app.config['ATOMIC_WRITES_ETAG'] = 'token'
+        oid = self.get_id_for_name('all_unclassified')
+        headers = make_headers('us_unclassified_only', 'password')
+
+        with mock.patch('atomic_writes.read_original', side_effect=AssertionError('read before writing')):
+            res = self.patch('us_unclassified_only', 'all_unclassified', {"user_ref_id": "atomic"})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(self.get_db_object_by_name('all_unclassified').get('_etag'),
+                             json.loads(res.data).get('_etag'))
+            self.assertEqual(self.client.delete('/signature_write/{}'.format(oid), headers=headers).status_code, 204)
+
+    def test_atomic_write_hooks(self):
+        """Test that on_update can change the updates before they're written, and on_delete_item sees the document."""
+        deleted = []
+
+        def on_update(resource, updates, original):
+            updates['user_ref_id'] = 'from_hook'
+
+        self.app.on_update += on_update
+        self.app.on_delete_item += lambda resource, original: deleted.append(original.get('name'))
+
+        self.assertEqual(self.patch('us_unclassified_only', 'all_unclassified', {"user_ref_id": "atomic"})
+                         .status_code, 200)
+        self.assertEqual(self.get_db_object_by_name('all_unclassified').get('user_ref_id'), 'from_hook')
+
+        oid = self.get_id_for_name('all_unclassified')
+        headers = make_headers('us_unclassified_only', 'password')
+        self.assertEqual(self.client.delete('/signature_write/{}'.format(oid), headers=headers).status_code, 204)
+        self.assertEqual(deleted, ['all_unclassified'])
@@ -3,6 +3,12 @@ import json
 import os
 import pytest
 import base64
+import io
+import time
+import random
+import threading
+import tempfile
+from urllib.parse import urlsplit
 
 import boto
 # import boto3
@@ -15,7 +21,15 @@ from pymongo import MongoClient
 from auth import check_insert_access, check_insert_data_context, CharonAuth
 from aggregators import add_ascl_redaction
 from update import check_perms_in_db
-from s3 import include_s3_data, generate_presigned_urls, include_presigned_urls
+from unittest import mock
+from s3 import include_s3_data, generate_presigned_urls, include_presigned_urls, fetch_s3_objects, get_s3_object, \
+    get_s3_reference, stream_attachment, presign_urls, \
+    presign_multipart_upload, finish_multipart_upload
+from attachment_cache import MemoryAttachmentCache, DiskAttachmentCache, get_attachment_cache
+from object_store import S3ObjectStore, get_object_store, local_object, get_s3_client, s3_pool_stats
+from attachment_cleanup import queue_attachment_deletion, process_batch, queue_collection, \
+    remember_deleted_documents, queue_resource_deletion
+from botocore.exceptions import ClientError
 
 from .fixtures import mocks
 
@@ -27,6 +41,19 @@ GBR_CITIZEN_DISS = ['usg_relfvey', 'usg_relgbr']
 CAN_CITIZEN_DISS = ['usg_relfvey']
 
 
+SIGNATURE_SCHEMA = '{"signature": {"_sec": {"schema": {"cat": {"type": "string"},"diss": {"schema": {"type": "string"},"type": "list"}},"type": "dict"},"attachments": {"schema": {"_sec": {"schema": {"cat": {"type": "string"},"diss": {"schema": {"type": "string"},"type": "list"}},"type": "dict"},"documents": {"type": "list"}},"type": "dict"},"date": {"type": "string"},"field_ref_id": {"type": "string"},"name": {"type": "string"},"signature": {"schema": {"_sec": {"schema": {"cat": {"type": "string"},"diss": {"schema": {"type": "string"},"type": "list"}},"type": "dict"},"value": {"type": "string"}},"type": "dict"},"user_ref_id": {"type": "string"},"vars": {}}}'
+
+
+def live_attachment_schema():
+    """
+    SIGNATURE_SCHEMA with attachments taken from the attachment template in schema.py, as deployments do with vars.
+    """
+    schema = json.loads(SIGNATURE_SCHEMA)
+    schema['signature'].pop('attachments')
+    schema['signature']['vars'] = {'attachments': 'attachment'}
+    return json.dumps(schema)
+
+
 @pytest.fixture(scope='function', autouse=True)
 def setup_fee_db():
     client = MongoClient(MONGO_HOST, 27017)
@@ -63,6 +90,62 @@ def setup_users():
         client.close()
 
 
+class FakeS3(object):
+    """Minimal stand-in for a boto3 S3 client that serves each key's name as its body."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.calls = []
+        self.signed = 0
+        self.presigned = []
+        self.bodies = {}
+        self.content_types = {}
+        self.deleted = []
+
+    def get_object(self, Bucket, Key, **kwargs):
+        etag = '"{}"'.format(Key)
+        if kwargs.get('IfNoneMatch') == etag:
+            raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'}}, 'GetObject')
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.calls.append(Key)
+        time.sleep(random.random() / 100)
+        with self.lock:
+            self.active -= 1
+        body = self.bodies.get(Key, Key.encode('utf-8'))
+        if kwargs.get('Range'):
+            start, end = [int(x) for x in kwargs['Range'].replace('bytes=', '').split('-')]
+            part = body[start:end + 1]
+            return {'Body': io.BytesIO(part), 'ETag': etag, 'ContentLength': len(part),
+                    'ContentRange': 'bytes {}-{}/{}'.format(start, start + len(part) - 1, len(body))}
+        content_type = self.content_types.get(Key, 'binary/octet-stream')
+        return {'Body': io.BytesIO(body), 'ETag': etag, 'ContentLength': len(body),
+                'ContentType': content_type}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        keys = [obj['Key'] for obj in Delete['Objects']]
+        self.deleted.append(keys)
+        return {'Errors': [{'Key': key, 'Code': 'AccessDenied', 'Message': 'Access Denied'}
+                           for key in keys if key.startswith('denied')]}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        return {'ContentLength': len(Key), 'ContentType': 'text/plain', 'ETag': '"{}"'.format(Key)}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        return {'UploadId': 'upload-{}'.format(Key)}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.aborted = getattr(self, 'aborted', []) + [(Key, UploadId)]
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600, **kwargs):
+        self.signed += 1
+        self.presigned.append(dict(Params))
+        return 'https://s3.example.com/{}?method={}&expires={}'.format(Params.get('Key'), ClientMethod, ExpiresIn)
+
+
 def make_headers(username, password):
     """Add standard headers - Basic Authorization and JSON content type. Pass auth string as decoded base64."""
     cred_str = '{}:{}'.format(username, password).encode('utf-8')
@@ -105,10 +188,12 @@ class BasicTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        test_settings = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'settings.py')
+        self.make_app(SIGNATURE_SCHEMA)
 
-        # Set Schema
-        os.environ['TEST_SCHEMA'] = '{"signature": {"_sec": {"schema": {"cat": {"type": "string"},"diss": {"schema": {"type": "string"},"type": "list"}},"type": "dict"},"attachments": {"schema": {"_sec": {"schema": {"cat": {"type": "string"},"diss": {"schema": {"type": "string"},"type": "list"}},"type": "dict"},"documents": {"type": "list"}},"type": "dict"},"date": {"type": "string"},"field_ref_id": {"type": "string"},"name": {"type": "string"},"signature": {"schema": {"_sec": {"schema": {"cat": {"type": "string"},"diss": {"schema": {"type": "string"},"type": "list"}},"type": "dict"},"value": {"type": "string"}},"type": "dict"},"user_ref_id": {"type": "string"},"vars": {}}}'
+    def make_app(self, schema):
+        """Initialize the app for a schema (TEST_SCHEMA)."""
+        test_settings = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'settings.py')
+        os.environ['TEST_SCHEMA'] = schema
 
         self.app = Eve(settings=test_settings, auth=CharonAuth)
         self.app.config['TESTING'] = True
@@ -281,3 +366,362 @@ class BasicTestCase(unittest.TestCase):
             self.fail('Received invalid json from /signature: {}'.format(exc))
 
         # self.assertEqual(resp_data.get('_items')[0].get('attachments').get('documents'), attachments)
+
+    def test_fetch_s3_objects_parallel_ordered(self):
+        """Test that attachments are downloaded in parallel, within the concurrency limit, and returned in order."""
+        s3 = FakeS3()
+        store = S3ObjectStore(s3, 'test_bucket')
+        keys = ['key-{}'.format(i) for i in range(40)]
+
+        with self.app.test_request_context():
+            results = fetch_s3_objects(store, keys, 4)
+
+        self.assertEqual(results, [(True, key) for key in keys])
+        self.assertTrue(1 < s3.max_active <= 4)
+
+    def test_attachment_cache_revalidation(self):
+        """Test that cached attachment content is reused after an ETag revalidation instead of downloaded again."""
+        s3 = FakeS3()
+        store = S3ObjectStore(s3, 'test_bucket')
+        self.app.config['ATTACHMENT_CACHE'] = 'memory'
+
+        with self.app.test_request_context():
+            self.assertEqual(get_s3_object(store, 'key-1'), 'key-1')
+            self.assertEqual(get_s3_object(store, 'key-1'), 'key-1')
+            stats = get_attachment_cache().stats()
+
+        # Only the first read downloaded the body
+        self.assertEqual(s3.calls, ['key-1'])
+        self.assertEqual(stats.get('revalidated'), 1)
+
+    def test_attachment_cache_byte_budget(self):
+        """Test that the attachment cache evicts least recently used content to stay within its byte budget."""
+        cache = MemoryAttachmentCache(max_bytes=10, max_item_bytes=8)
+        cache.put('a', '"a"', 'aaaa')
+        cache.put('b', '"b"', 'bbbb')
+        cache.lookup('a')
+        cache.put('c', '"c"', 'cccc')
+        cache.put('d', '"d"', 'd' * 9)  # larger than max_item_bytes, not cached
+
+        self.assertIsNone(cache.lookup('b'))
+        self.assertIsNone(cache.lookup('d'))
+        self.assertEqual(cache.lookup('a')[1], 'aaaa')
+        self.assertEqual(cache.stats().get('evictions'), 1)
+        self.assertTrue(cache.stats().get('bytes') <= 10)
+
+        # The budget is in bytes, not characters
+        cache.put('e', '"e"', '\u00e9' * 5)
+        self.assertIsNone(cache.lookup('e'))
+        cache.put('a', '"a2"', '\u00e9' * 2)
+        self.assertEqual(cache.stats().get('bytes'), 8)
+
+    def test_disk_attachment_cache_etag(self):
+        """Test that disk cache entries are kept per worker, and content stored under another etag is not served."""
+        with tempfile.TemporaryDirectory() as directory:
+            cache = DiskAttachmentCache(directory, max_bytes=1024, max_item_bytes=512)
+            self.assertEqual(os.listdir(directory), [str(os.getpid())])
+
+            cache.put('a', '"a1"', 'first')
+            self.assertEqual(cache.lookup('a')[:2], ('"a1"', 'first'))
+            # Content replaced underneath the index, as by a racing put of the same key
+            cache.store('a', '"a2"', 'second')
+            self.assertIsNone(cache.lookup('a'))
+
+    def test_reference_mode_returns_urls(self):
+        """Test that reference attachment mode returns presigned urls and metadata instead of object content."""
+        s3 = FakeS3()
+        store = S3ObjectStore(s3, 'test_bucket')
+        self.app.config['S3_ATTACHMENTS'] = "True"
+        keys = ['key-1', 'key-22']
+
+        def read(path, endpoint='signature'):
+            documents = [{"attachments": {"documents": list(keys)}}]
+            with self.app.test_request_context(path), mock.patch('s3.get_object_store', return_value=store):
+                return include_s3_data(endpoint, documents)[0]['attachments']
+
+        # Chosen by the query parameter
+        refs = read('/signature?attachment_mode=reference')
+        self.assertEqual(s3.calls, [])  # nothing downloaded
+        self.assertEqual([ref.get('key') for ref in refs], keys)
+        self.assertEqual([ref.get('size') for ref in refs], [5, 6])
+        self.assertTrue(refs[0].get('url').startswith('https://s3.example.com/key-1?method=get_object'))
+
+        # Chosen by the resource's entry in ATTACHMENT_MODES, which the query parameter overrides
+        self.app.config['ATTACHMENT_MODES'] = {'signature': 'reference'}
+        refs = read('/signature')
+        self.assertEqual(s3.calls, [])
+        self.assertEqual([ref.get('key') for ref in refs], keys)
+        self.assertEqual(read('/signature?attachment_mode=inline'), keys)
+        self.assertEqual(sorted(s3.calls), keys)
+
+    def test_stream_attachment_download(self):
+        """Test that an attachment is streamed undecoded, with Range support, only to users who can see it."""
+        self.app.config['S3_ATTACHMENTS'] = "True"
+        self.app.add_url_rule('/<resource>/<oid>/attachments/<int:n>', 'stream_attachment', stream_attachment)
+        oid = self.get_id_for_name('all_unclassified')
+        key = '02867bec-d8a2-48fc-a6f7-859888f6883b'
+
+        store = S3ObjectStore(FakeS3(), 'test_bucket')
+        with mock.patch('s3.get_object_store', return_value=store):
+            headers = make_headers('us_unclassified_only', 'password')
+            res = self.client.get('/signature/{}/attachments/0'.format(oid), headers=headers)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.data, key.encode('utf-8'))
+
+            headers['Range'] = 'bytes=0-7'
+            res = self.client.get('/signature/{}/attachments/0'.format(oid), headers=headers)
+            self.assertEqual(res.status_code, 206)
+            self.assertEqual(res.data, key[:8].encode('utf-8'))
+            self.assertEqual(res.headers.get('Content-Range'), 'bytes 0-7/{}'.format(len(key)))
+
+            res = self.client.get('/signature/{}/attachments/1'.format(oid), headers=headers)
+            self.assertEqual(res.status_code, 404)
+
+            # A document the user can't see has no attachments to download
+            oid = self.get_id_for_name('doc_confidential')
+            res = self.client.get('/signature/{}/attachments/0'.format(oid), headers=headers)
+            self.assertEqual(res.status_code, 404)
+
+    def test_presign_urls_batch_reuse(self):
+        """Test that a batch of upload urls is signed with one client and still valid urls are reused."""
+        s3 = FakeS3()
+        store = S3ObjectStore(s3, 'test_bucket')
+        keys = ['key-{}'.format(i) for i in range(20)]
+
+        with self.app.test_request_context(), mock.patch('s3.get_object_store', return_value=store) as get_client:
+            urls = presign_urls(keys)
+            self.assertEqual(presign_urls(keys), urls)
+
+        self.assertEqual(get_client.call_count, 2)
+        self.assertEqual(s3.signed, len(keys))
+        self.assertTrue(all(url.startswith('https://s3.example.com/key-') for url in urls))
+        self.assertTrue(all('method=put_object&expires=3600' in url for url in urls))
+
+    def test_presign_multipart_upload(self):
+        """Test that attachments declared above the threshold get a multipart upload with a url per part."""
+        s3 = FakeS3()
+        store = S3ObjectStore(s3, 'test_bucket')
+        self.app.config['S3_ATTACHMENTS'] = "True"
+        self.app.config['ATTACHMENT_MULTIPART_THRESHOLD'] = 100
+        self.app.config['ATTACHMENT_MULTIPART_PART_SIZE'] = 40  # Raised to S3's minimum part size
+        mib = 1024 * 1024
+        data = {"attachments": {"documents": ["small-key", "large-key"], "sizes": [10, 12 * mib]}}
+
+        with self.app.test_request_context('/signature_write', method='POST', data=json.dumps(data),
+                                           content_type='application/json'), \
+                mock.patch('s3.get_object_store', return_value=store):
+            from flask import g, request
+            generate_presigned_urls('signature_write', request)
+            small, large = g.presigned_urls
+
+        self.assertTrue(small.startswith('https://s3.example.com/small-key?method=put_object'))
+        self.assertEqual(large.get('upload_id'), 'upload-large-key')
+        self.assertEqual(large.get('part_size'), 5 * mib)
+        self.assertEqual([part.get('part_number') for part in large.get('parts')], [1, 2, 3])
+        self.assertTrue(all('method=upload_part' in part.get('url') for part in large.get('parts')))
+
+        # Part size grows so no upload needs more than S3's 10,000 parts
+        with self.app.test_request_context():
+            upload = presign_multipart_upload(store, 'huge-key', 5 * mib * 10000 + 1)
+        self.assertEqual(upload.get('part_size'), 5 * mib + 1)
+        self.assertTrue(len(upload.get('parts')) <= 10000)
+
+    def test_post_multipart_upload(self):
+        """
+        Test that a POST declaring attachment sizes passes validation with the live schema and starts a multipart
+        upload.
+        """
+        self.make_app(live_attachment_schema())
+        s3 = FakeS3()
+        store = S3ObjectStore(s3, 'test_bucket')
+        self.app.config['S3_ATTACHMENTS'] = "True"
+        self.app.config['ATTACHMENT_MULTIPART_THRESHOLD'] = 100
+        data = {
+            "name": "Test User",
+            "attachments": {"_sec": {"cat": "usg_unclassified", "diss": []}, "documents": ["small-key", "large-key"],
+                            "sizes": [10, 100]},
+            "_sec": {"cat": "usg_unclassified", "diss": []}
+        }
+
+        with mock.patch('s3.get_object_store', return_value=store):
+            res = self.client.post('/signature_write', data=json.dumps(data),
+                                   headers=make_headers('us_secret_cumul', 'password'))
+
+        self.assertEqual(res.status_code, 201)
+        small, large = json.loads(res.data).get('_presigned_urls')
+        self.assertTrue(small.startswith('https://s3.example.com/small-key?method=put_object'))
+        self.assertEqual(large.get('upload_id'), 'upload-large-key')
+        self.assertEqual(self.get_db_object_by_name('Test User').get('attachments').get('sizes'), [10, 100])
+
+    def test_post_content_types(self):
+        """
+        Test that a POST declaring content types passes validation with the live schema and signs them into the urls.
+        """
+        self.make_app(live_attachment_schema())
+        s3 = FakeS3()
+        store = S3ObjectStore(s3, 'test_bucket')
+        self.app.config['S3_ATTACHMENTS'] = "True"
+        data = {
+            "name": "Test User",
+            "attachments": {"_sec": {"cat": "usg_unclassified", "diss": []}, "documents": ["pdf-key", "text-key"],
+                            "content_types": ["application/pdf", "text/plain"]},
+            "_sec": {"cat": "usg_unclassified", "diss": []}
+        }
+
+        with mock.patch('s3.get_object_store', return_value=store):
+            res = self.client.post('/signature_write', data=json.dumps(data),
+                                   headers=make_headers('us_secret_cumul', 'password'))
+
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(len(json.loads(res.data).get('_presigned_urls')), 2)
+        self.assertEqual([params.get('ContentType') for params in s3.presigned], ['application/pdf', 'text/plain'])
+
+    def test_finish_multipart_upload_requires_write_access(self):
+        """Test that only a user who may modify a document referencing the key can complete or abort its upload."""
+        self.app.add_url_rule('/<resource>/attachments/multipart/<action>', 'finish_multipart_upload',
+                              finish_multipart_upload, methods=['POST'])
+        self.app.config['S3_ATTACHMENTS'] = "True"
+        client = MongoClient(MONGO_HOST, 27017)
+        client[MONGO_DBNAME]['signature'].insert_many([
+            {"name": "upload_unclassified", "_sec": {"cat": "usg_unclassified", "diss": []},
+             "attachments": {"_sec": {"cat": "usg_unclassified", "diss": []}, "documents": ["open-key"]}},
+            {"name": "upload_confidential", "_sec": {"cat": "usg_unclassified", "diss": []},
+             "attachments": {"_sec": {"cat": "usg_confidential", "diss": []}, "documents": ["closed-key"]}}
+        ])
+        client.close()
+        headers = make_headers('us_unclassified_only', 'password')
+
+        s3 = FakeS3()
+        store = S3ObjectStore(s3, 'test_bucket')
+        with mock.patch('s3.get_object_store', return_value=store):
+            def finish(key):
+                return self.client.post('/signature/attachments/multipart/abort', headers=headers,
+                                        data=json.dumps({"key": key, "upload_id": "upload-1"})).status_code
+            self.assertEqual(finish('open-key'), 200)
+            self.assertEqual(finish('closed-key'), 403)
+            self.assertEqual(finish('unknown-key'), 404)
+        self.assertEqual(s3.aborted, [('open-key', 'upload-1')])
+
+    def test_decode_by_content_type(self):
+        """Test that the stored content type selects the attachment decoder, and legacy objects decode as before."""
+        s3 = FakeS3()
+        store = S3ObjectStore(s3, 'test_bucket')
+        png = b'\x89PNG\r\n\x1a\n\x00\xff'
+        s3.bodies = {'image-key': png, 'text-key': 'caf\u00e9'.encode('utf-8'), 'b64-key': b'aGVsbG8='}
+        s3.content_types = {'image-key': 'image/png', 'text-key': 'text/plain; charset=utf-8',
+                            'b64-key': 'application/base64'}
+
+        with self.app.test_request_context():
+            self.assertEqual(get_s3_object(store, 'image-key'), base64.b64encode(png).decode('ascii'))
+            self.assertEqual(get_s3_object(store, 'text-key'), 'caf\u00e9')
+            self.assertEqual(get_s3_object(store, 'b64-key'), 'aGVsbG8=')
+            self.assertEqual(get_s3_object(store, 'legacy-key'), 'legacy-key')
+
+    def test_shared_attachment_keys_fetched_once(self):
+        """Test that a key referenced by several documents in a response is downloaded once and given to each."""
+        s3 = FakeS3()
+        store = S3ObjectStore(s3, 'test_bucket')
+        self.app.config['S3_ATTACHMENTS'] = "True"
+        documents = [{"attachments": {"documents": ["template", "key-{}".format(i)]}} for i in range(5)]
+
+        with self.app.test_request_context('/signature'), mock.patch('s3.get_object_store', return_value=store):
+            include_s3_data('signature', documents)
+
+        self.assertEqual(sorted(s3.calls), sorted(['template'] + ['key-{}'.format(i) for i in range(5)]))
+        for i, doc in enumerate(documents):
+            self.assertEqual(doc.get('attachments'), ['template', 'key-{}'.format(i)])
+
+    def test_s3_client_reused_per_process(self):
+        """Test that the S3 client is shared within a process and rebuilt after the process id changes (a fork)."""
+        with self.app.test_request_context(), \
+                mock.patch.multiple('object_store', _s3_client=None, _s3_client_pid=None, _s3_clients_created=0), \
+                mock.patch('object_store.boto3.client', side_effect=lambda *a, **kw: mock.MagicMock()) as client, \
+                mock.patch('object_store.os.getpid', return_value=100) as getpid:
+            self.assertEqual(s3_pool_stats(), {})  # nothing until first use
+
+            first = get_s3_client()
+            self.assertIs(get_s3_client(), first)
+            self.assertEqual(client.call_count, 1)
+            self.assertEqual(s3_pool_stats().get('clients_created'), 1)
+
+            getpid.return_value = 101
+            self.assertEqual(s3_pool_stats(), {})  # the parent's client isn't reported in the child
+            second = get_s3_client()
+            self.assertIsNot(second, first)
+            self.assertIs(get_s3_client(), second)
+            self.assertEqual(client.call_count, 2)
+            self.assertEqual(s3_pool_stats().get('clients_created'), 2)
+
+    def test_local_object_store(self):
+        """Test that the local object store accepts uploads and serves reads through its signed urls."""
+        self.app.config['S3_ATTACHMENTS'] = "True"
+        self.app.config['OBJECT_STORE'] = 'local'
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.app.config['OBJECT_STORE_LOCAL_DIR'] = directory.name
+        self.app.config['OBJECT_STORE_LOCAL_SECRET'] = 'test-secret'
+        self.app.add_url_rule('/_objects/<path:key>', 'local_object', local_object, methods=['GET', 'PUT'])
+
+        def path(url):
+            parts = urlsplit(url)
+            return '{}?{}'.format(parts.path, parts.query)
+
+        with self.app.test_request_context():
+            put_url = presign_urls(['local/key-1'], content_types=['text/plain'])[0]
+            res = self.client.put(path(put_url), data=b'hello local', content_type='text/plain')
+            self.assertEqual(res.status_code, 200)
+
+            store = get_object_store()
+            self.assertEqual(get_s3_object(store, 'local/key-1'), 'hello local')
+            get_url = get_s3_reference(store, 'local/key-1').get('url')
+
+        res = self.client.get(path(get_url), headers={'Range': 'bytes=6-'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.data, b'local')
+        self.assertEqual(res.headers.get('Content-Range'), 'bytes 6-10/11')
+
+        # Urls can't be altered, and upload urls only accept the signed content type
+        self.assertEqual(self.client.get(path(get_url).replace('key-1', 'key-2')).status_code, 403)
+        self.assertEqual(self.client.put(path(put_url), data=b'x', content_type='image/png').status_code, 403)
+
+    def test_cascade_attachment_deletion(self):
+        """Test that a deleted document's attachments are deleted in one batch, except keys other documents use."""
+        s3 = FakeS3()
+        store = S3ObjectStore(s3, 'test_bucket')
+        self.app.config['S3_ATTACHMENTS'] = "True"
+        self.app.config['ATTACHMENT_CASCADE_DELETE'] = "True"
+        self.app.config['ATTACHMENT_DELETE_MAX_ATTEMPTS'] = 1
+        shared_key = '02867bec-d8a2-48fc-a6f7-859888f6883b'  # still attached to all_unclassified
+        original = {"_id": "deleted-doc", "attachments": {"documents": ['orphan-1', 'orphan-2', shared_key,
+                                                                       'denied-1']}}
+
+        with self.app.test_request_context(), \
+                mock.patch('attachment_cleanup.get_object_store', return_value=store):
+            queue_collection().delete_many({})
+            queue_attachment_deletion('signature_write', original)
+            # Nothing is deleted until the keys have waited out the grace period
+            self.app.config['ATTACHMENT_DELETE_GRACE_SECONDS'] = 300
+            self.assertEqual(process_batch(self.app), 0)
+            self.app.config['ATTACHMENT_DELETE_GRACE_SECONDS'] = 0
+            self.assertEqual(process_batch(self.app), 4)
+            remaining = list(queue_collection().find())
+
+        self.assertEqual(len(s3.deleted), 1)
+        self.assertEqual(sorted(s3.deleted[0]), ['denied-1', 'orphan-1', 'orphan-2'])
+        self.assertEqual([(entry['key'], entry['status']) for entry in remaining], [('denied-1', 'dead')])
+
+    def test_cascade_resource_deletion(self):
+        """Test that deleting all documents of a resource queues the attachments of each of them."""
+        self.app.config['S3_ATTACHMENTS'] = "True"
+        self.app.config['ATTACHMENT_CASCADE_DELETE'] = "True"
+        originals = [{"_id": "deleted-1", "attachments": {"documents": ['orphan-1']}},
+                     {"_id": "deleted-2", "attachments": {"documents": ['orphan-2', 'orphan-3']}},
+                     {"_id": "deleted-3"}]
+
+        with self.app.test_request_context():
+            queue_collection().delete_many({})
+            remember_deleted_documents('signature_write', originals, {})
+            queue_resource_deletion('signature_write')
+            queued = sorted((entry['document'], entry['key']) for entry in queue_collection().find())
+
+        self.assertEqual(queued, [('deleted-1', 'orphan-1'), ('deleted-2', 'orphan-2'), ('deleted-2', 'orphan-3')])
@@ -0,0 +1,66 @@
+import unittest
+import json
+import pytest
+
+from bulk import bulk_insert
+from .fixtures.apps import RedactionAppMixin, make_headers, populate_fees, populate_users
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_db():
+    populate_fees()
+    populate_users()
+
+
+def make_fee(fee_id, cat):
+    return {
+        'FeeID': fee_id,
+        'BuildingID': '306039',
+        'Boro': 'BROOKLYN',
+        'FeeAmount': '3000.00',
+        'attachments': {'_sec': {'cat': 'usg_unclassified', 'diss': []}, 'documents': []},
+        '_sec': {'cat': cat, 'diss': []}
+    }
+
+
+class BulkTestCase(RedactionAppMixin, unittest.TestCase):
+    def setUp(self):
+        """Use the same app, schema and fixtures as test_redaction, with the bulk insert endpoint added."""
+        RedactionAppMixin.setUp(self)
+        self.app.add_url_rule('/<resource>/bulk', 'bulk_insert', bulk_insert, methods=['POST'])
+
+    def test_bulk_insert_array(self):
+        """Test that a JSON array is inserted with a result for each document."""
+        headers = make_headers('us_secret_cumul', 'password')
+        docs = [make_fee('bulk-{}'.format(i), 'usg_secret') for i in range(5)]
+
+        res = self.client.post('/fees/bulk', data=json.dumps(docs), headers=headers)
+
+        self.assertEqual(res.status_code, 201)
+        items = json.loads(res.data).get('_items')
+        self.assertEqual([item.get('_status') for item in items], ['OK'] * 5)
+        self.assertTrue(all(item.get('_id') and item.get('_etag') for item in items))
+
+    def test_bulk_insert_ndjson_partial(self):
+        """Test that denied and invalid documents in an NDJSON body don't stop the others being inserted."""
+        headers = make_headers('us_unclassified_only', 'password')
+        headers['Content-Type'] = 'application/x-ndjson'
+        lines = [json.dumps(make_fee('bulk-ok', 'usg_unclassified')),
+                 json.dumps(make_fee('bulk-denied', 'usg_secret')),
+                 '{not json',
+                 json.dumps(dict(make_fee('bulk-invalid', 'usg_unclassified'), FeeAmount=3000))]
+
+        res = self.client.post('/fees/bulk', data='\n'.join(lines) + '\n', headers=headers)
+
+        self.assertEqual(res.status_code, 207)
+        items = json.loads(res.data).get('_items')
+        self.assertEqual([item.get('_status') for item in items], ['OK', 'ERR', 'ERR', 'ERR'])
+        self.assertEqual(items[1].get('_error'),
+                         {'code': 403, 'message': {'reason': 'missing_labels', 'missing': ['usg_secret']}})
+        self.assertEqual(items[2].get('_error').get('code'), 400)
+        self.assertIn('FeeAmount', items[3].get('_issues'))
+
+    def test_bulk_insert_unknown_resource(self):
+        """Test that only resources with a _write resource accept bulk inserts."""
+        res = self.client.post('/fees_write/bulk', data='[]', headers=make_headers('us_secret_cumul', 'password'))
+        self.assertEqual(res.status_code, 404)
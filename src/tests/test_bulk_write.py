@@ -0,0 +1,67 @@
+import unittest
+import json
+import pytest
+
+from bulk import bulk_write
+from .fixtures.apps import UpdateAppMixin, make_headers, populate_signatures, populate_users
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_users():
+    populate_users()
+
+
+@pytest.fixture(autouse=True)
+def setup_signatures():
+    populate_signatures()
+
+
+class BulkWriteTestCase(UpdateAppMixin, unittest.TestCase):
+    def setUp(self):
+        """Use the same app, schema and fixtures as test_update, with the bulk write endpoint added."""
+        UpdateAppMixin.setUp(self)
+        self.app.add_url_rule('/<resource>/bulk', 'bulk_write', bulk_write, methods=['PATCH', 'DELETE'])
+
+    def bulk(self, method, username, entries):
+        res = self.client.open('/signature/bulk', method=method, headers=make_headers(username, 'password'),
+                               data=json.dumps(entries))
+        return res.status_code, json.loads(res.data).get('_items')
+
+    def test_bulk_patch_per_item_results(self):
+        """Test that each entry is checked as a single PATCH would be, and only allowed changes are written."""
+        change = {"signature": {"value": "bulk_changes", "_sec": {"cat": "usg_unclassified", "diss": []}}}
+        entries = [{"_id": self.get_id_for_name(name), "changes": change}
+                   for name in ['all_unclassified', 'doc_confidential', 'sig_confidential']]
+        entries.append({"_id": self.get_id_for_name('sig_confidential'), "changes": {"user_ref_id": "bulk"}})
+
+        status, items = self.bulk('PATCH', 'us_unclassified_only', entries)
+
+        self.assertEqual(status, 207)
+        self.assertEqual([item.get('_status') for item in items], ['OK', 'ERR', 'ERR', 'ERR'])
+        self.assertEqual([item.get('_error', {}).get('code') for item in items[1:3]], [403, 403])
+        self.assertEqual(items[3].get('_error').get('code'), 400)  # Duplicate _id in the batch
+        self.assertEqual(self.get_db_object_by_name('all_unclassified').get('signature').get('value'), 'bulk_changes')
+        self.assertEqual(self.get_db_object_by_name('doc_confidential').get('signature').get('value'),
+                         'testing_updates_1')
+
+    def test_bulk_patch_denies_higher_labels(self):
+        """Test that a bulk PATCH can't set labels the user doesn't have."""
+        change = {"signature": {"value": "bulk_changes", "_sec": {"cat": "usg_topsecret", "diss": []}}}
+        status, items = self.bulk('PATCH', 'us_secret_cumul',
+                                  [{"_id": self.get_id_for_name('all_unclassified'), "changes": change}])
+
+        self.assertEqual(status, 207)
+        self.assertEqual(items[0].get('_error'),
+                         {'code': 403, 'message': {'reason': 'missing_labels', 'missing': ['usg_topsecret']}})
+
+    def test_bulk_delete(self):
+        """Test that a bulk DELETE removes the documents the user may delete, and reports missing ones."""
+        oid = self.get_id_for_name('all_unclassified')
+        entries = [{"_id": oid}, {"_id": self.get_id_for_name('sig_diss_controlled')}, {"_id": '0' * 24}]
+
+        status, items = self.bulk('DELETE', 'us_unclassified_only', entries)
+
+        self.assertEqual(status, 207)
+        self.assertEqual([item.get('_error', {}).get('code') for item in items], [None, 403, 404])
+        self.assertEqual(items[0].get('_id'), oid)
+        self.assertEqual(self.get_db_object_by_name('sig_diss_controlled').get('name'), 'sig_diss_controlled')
@@ -3,13 +3,21 @@ import json
 import os
 import pytest
 import base64
+import time
+import copy
 
 from eve import Eve
+from flask import g
 from pymongo import MongoClient
 from auth import check_insert_access, check_insert_data_context, CharonAuth
-from aggregators import add_ascl_redaction
+from aggregators import add_ascl_redaction, redaction_template, bind_user_context
 from update import check_perms_in_db
 from s3 import include_s3_data, generate_presigned_urls, include_presigned_urls
+from mongo import CharonMongo, get_client, pool_stats
+from user_context import UserContextCache, handle_user_change, check_cached_users
+from schema import get_security_descriptor
+from indexes import security_index_keys, index_drift, index_name, sync_indexes
+from request_body import request_body
 
 from .fixtures.schemas import fees_with_attachments
 
@@ -94,7 +102,7 @@ class BasicTestCase(unittest.TestCase):
         # Set Schema
         os.environ['TEST_SCHEMA'] = json.dumps(fees_with_attachments)
 
-        self.app = Eve(settings=test_settings, auth=CharonAuth)
+        self.app = Eve(settings=test_settings, auth=CharonAuth, data=CharonMongo)
         self.app.config['TESTING'] = True
         self.app.config['DEBUG'] = True
         self.app.config['MONGO_DBNAME'] = MONGO_DBNAME
@@ -135,3 +143,134 @@ class BasicTestCase(unittest.TestCase):
         # Assert that nested metadata match fields were removed
         self.assertEqual(item.get('attachments').get('cat_matches'), None)
         self.assertEqual(item.get('attachments').get('diss_matches'), None)
+
+    def test_shared_mongo_client(self):
+        """Test that auth, redaction and Eve reuse one pooled MongoClient across requests."""
+        headers = make_headers('us_topsecret_cumul', 'password')
+
+        res = self.client.get('/fees_with_attachments', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        client = get_client(self.app.config)
+        created = pool_stats().get('connections_created')
+
+        res = self.client.get('/fees_with_attachments', headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+        # Same client, and the second request was served from already-open pooled connections
+        self.assertIs(get_client(self.app.config), client)
+        self.assertEqual(pool_stats().get('connections_created'), created)
+        self.assertEqual(pool_stats().get('connections_checked_out'), 0)
+
+    def test_user_context_cache_lru_and_invalidation(self):
+        """Test that the user context cache evicts least recently used users and honors change stream events."""
+        cache = UserContextCache(max_size=2, ttl=30)
+        cache.put('a', {'_id': 1, 'username': 'a', 'cat': ['usg_unclassified'], 'diss': []})
+        cache.put('b', {'_id': 2, 'username': 'b', 'cat': ['usg_secret'], 'diss': []})
+        cache.get('a')
+        cache.put('c', {'_id': 3, 'username': 'c', 'cat': [], 'diss': []})
+
+        # 'b' was least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+
+        # Update events invalidate by username, deletes by document id
+        handle_user_change(cache, {'operationType': 'update', 'documentKey': {'_id': 1},
+                                   'fullDocument': {'_id': 1, 'username': 'a'}})
+        self.assertIsNone(cache.get('a'))
+        handle_user_change(cache, {'operationType': 'delete', 'documentKey': {'_id': 3}})
+        self.assertIsNone(cache.get('c'))
+
+    def test_user_context_cache_ttl(self):
+        """Test that cached user contexts expire after the TTL."""
+        cache = UserContextCache(max_size=10, ttl=0)
+        cache.put('a', {'_id': 1, 'username': 'a', 'cat': [], 'diss': []})
+        time.sleep(0.01)
+        self.assertIsNone(cache.get('a'))
+
+    def test_user_context_cache_generation(self):
+        """Test that a context read before an invalidation isn't cached, and polling invalidates changed users."""
+        cache = UserContextCache(max_size=10, ttl=30)
+        generation = cache.generation('a')
+        cache.invalidate(username='a')
+        cache.put('a', {'_id': 1, 'username': 'a', 'cat': ['usg_secret'], 'diss': []}, generation)
+        self.assertIsNone(cache.get('a'))
+
+        cache.put('a', {'_id': 1, 'username': 'a', 'cat': ['usg_secret'], 'diss': []}, cache.generation('a'))
+        cache.put('b', {'_id': 2, 'username': 'b', 'cat': [], 'diss': []})
+        # A collection of the test database stands in for admin.charon_user_permissions, so no real users are touched
+        client = MongoClient(MONGO_HOST, 27017)
+        coll = client[MONGO_DBNAME]['test_user_permissions']
+        coll.insert_many([{'_id': 1, 'username': 'a', 'cat': ['usg_unclassified'], 'diss': []},
+                          {'_id': 2, 'username': 'b', 'cat': [], 'diss': []}])
+        try:
+            check_cached_users(cache, coll)
+        finally:
+            coll.drop()
+            client.close()
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('b'))
+
+    def test_security_descriptor(self):
+        """Test that the compiled security descriptor lists every ASCL-tagged field once, by full path."""
+        descriptor = get_security_descriptor('fees_with_attachments')
+
+        self.assertEqual(descriptor.paths, ('', 'attachments'))
+        self.assertEqual([(f.depth, f.in_array) for f in descriptor.fields], [(0, False), (1, False)])
+        with self.assertRaises(AttributeError):
+            descriptor.fields = ()
+
+    def test_redaction_template_cached(self):
+        """Test that redaction stages are built once per resource and user permissions are only bound per request."""
+        with self.app.test_request_context():
+            g._cat = ['usg_unclassified', 'usg_secret']
+            g._diss = ['usg_noforn']
+
+            template = redaction_template('fees_with_attachments')
+            self.assertIs(redaction_template('fees_with_attachments'), template)
+
+            stages = bind_user_context(template)
+            self.assertEqual(len(stages), len(template))
+            self.assertNotIn('usg_secret', str(template))
+            self.assertIn('usg_secret', str(stages))
+
+    def test_security_index_drift(self):
+        """Test that index drift reports the security label indexes missing from a collection."""
+        keys = security_index_keys(get_security_descriptor('fees_with_attachments'))
+        self.assertEqual(keys, ['_sec.cat', '_sec.diss', 'attachments._sec.cat', 'attachments._sec.diss'])
+
+        client = MongoClient(MONGO_HOST, 27017)
+        self.addCleanup(client.close)
+        coll = client[MONGO_DBNAME]['fees_with_attachments']
+        coll.create_index('_sec.cat', name=index_name('_sec.cat'))
+        self.addCleanup(coll.drop_index, index_name('_sec.cat'))
+        drift = index_drift(coll, keys)
+        self.assertNotIn('_sec.cat', drift.get('missing'))
+        self.assertIn('attachments._sec.diss', drift.get('missing'))
+
+        report = sync_indexes(self.app.config, self.app.logger, dry_run=True)
+        self.assertIn('fees_with_attachments', report)
+        self.assertNotIn('users', report)
+        self.assertNotIn('ascl_rule', report)
+
+    def test_request_body_parsed_once_and_read_only(self):
+        """Test that hooks share one read-only parse of the request body, and Eve reuses Flask's cached parse."""
+        data = {"name": "test", "_sec": {"cat": "usg_unclassified", "diss": ["usg_noforn"]}}
+        with self.app.test_request_context('/fees_with_attachments_write', method='POST', data=json.dumps(data),
+                                           content_type='application/json'):
+            from flask import request
+            body = request_body()
+            self.assertIs(request_body(), body)
+            self.assertEqual(body, data)
+            self.assertEqual(request.get_json(force=True), data)
+
+            with self.assertRaises(TypeError):
+                body['name'] = 'changed'
+            with self.assertRaises(TypeError):
+                body['_sec']['diss'].append('usg_relfvey')
+
+            self.assertEqual(body.get('_sec').get('diss'), ['usg_noforn'])
+            self.assertIs(body['_sec'], body['_sec'])
+
+            copied = copy.deepcopy(body)
+            copied['_sec']['diss'].append('usg_relfvey')
+            self.assertEqual(request_body()['_sec']['diss'], ['usg_noforn'])
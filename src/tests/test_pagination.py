@@ -0,0 +1,63 @@
+import unittest
+import json
+import pytest
+
+from pagination import add_keyset_pagination, trim_keyset_page, include_next_cursor
+from .fixtures.apps import RedactionAppMixin, make_headers, populate_fees, populate_users
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_db():
+    populate_fees()
+    populate_users()
+
+
+class KeysetPaginationTestCase(RedactionAppMixin, unittest.TestCase):
+    def setUp(self):
+        """Use the same app, schema and fixtures as test_redaction, with keyset pagination hooks added."""
+        RedactionAppMixin.setUp(self)
+        self.app.before_aggregation += add_keyset_pagination
+        self.app.after_aggregation += trim_keyset_page
+        self.app.on_post_GET += include_next_cursor
+
+    def get(self, url, headers):
+        res = self.client.get(url, headers=headers)
+        self.assertEqual(res.status_code, 200)
+        try:
+            return json.loads(res.data)
+        except json.decoder.JSONDecodeError as exc:
+            self.fail('Received invalid json from {}: {}'.format(url, exc))
+
+    def test_pages_cover_visible_documents(self):
+        """Test that following cursors returns every visible document exactly once, in pages of max_results."""
+        headers = make_headers('us_secret_only', 'password')
+        all_ids = [item.get('_id') for item in self.get('/fees', headers).get('_items')]
+
+        self.app.config['KEYSET_PAGINATION'] = "True"
+        paged_ids = []
+        url = '/fees?max_results=7'
+        while True:
+            resp_data = self.get(url, headers)
+            items = resp_data.get('_items')
+            self.assertTrue(len(items) <= 7)
+            paged_ids.extend(item.get('_id') for item in items)
+            if resp_data.get('_next_cursor') is None:
+                break
+            self.assertEqual(len(items), 7)
+            url = '/fees?max_results=7&cursor={}'.format(resp_data.get('_next_cursor'))
+
+        self.assertEqual(sorted(paged_ids), sorted(all_ids))
+        self.assertEqual(len(paged_ids), len(set(paged_ids)))
+
+    def test_max_results_capped(self):
+        """Test that max_results is capped at PAGINATION_LIMIT."""
+        self.app.config['KEYSET_PAGINATION'] = "True"
+        self.app.config['PAGINATION_LIMIT'] = 3
+        resp_data = self.get('/fees?max_results=100', make_headers('us_topsecret_cumul', 'password'))
+        self.assertEqual(len(resp_data.get('_items')), 3)
+
+    def test_invalid_cursor(self):
+        """Test that a malformed cursor is rejected."""
+        self.app.config['KEYSET_PAGINATION'] = "True"
+        res = self.client.get('/fees?cursor=not-a-cursor', headers=make_headers('us_topsecret_cumul', 'password'))
+        self.assertEqual(res.status_code, 400)
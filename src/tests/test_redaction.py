@@ -527,6 +527,25 @@ class BasicTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 403)
 
+    def test_insert_denied_reports_missing_labels(self):
+        """Test that a denied insert reports every label the user is missing in a structured 403."""
+        headers = make_headers('us_unclassified_only', 'password')
+
+        data = {
+            'FeeID': {
+                'value': '471',
+                '_sec': {'cat': 'usg_secret', 'diss': ['usg_noforn', 'usg_fouo']}
+            },
+            'BuildingID': '306039',
+            '_sec': {'cat': 'usg_unclassified', 'diss': ['usg_relgbr']}
+        }
+
+        res = self.client.post('/fees_nested_write', data=json.dumps(data), headers=headers)
+
+        self.assertEqual(res.status_code, 403)
+        error = json.loads(res.data).get('_error', {}).get('message')
+        self.assertEqual(error, {'reason': 'missing_labels', 'missing': ['usg_fouo', 'usg_secret']})
+
     def test_secret_nested_insert_user_us_secret(self):
         """Test redaction for a user with cat == unclassified and US citizen dissemination rights."""
         headers = make_headers('us_secret_cumul', 'password')
@@ -0,0 +1,81 @@
+import unittest
+import json
+import pytest
+
+from pymongo import MongoClient
+
+from .fixtures.apps import RedactionAppMixin, make_headers, load_fixture, populate_fees, populate_users, \
+    MONGO_HOST, MONGO_DBNAME
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_db():
+    populate_fees()
+    populate_users()
+
+
+class RedactionEngineTestCase(RedactionAppMixin, unittest.TestCase):
+    """Checks that the redaction engines, with and without the security prefilter, return the same documents."""
+
+    def setUp(self):
+        """Use the same app, schema and fixtures as test_redaction."""
+        RedactionAppMixin.setUp(self)
+        self.usernames = [user.get('username') for user in load_fixture('users.json')]
+
+    def get_items(self, engine, username, url, prefilter="False"):
+        self.app.config['REDACTION_ENGINE'] = engine
+        self.app.config['REDACTION_PREFILTER'] = prefilter
+        res = self.client.get(url, headers=make_headers(username, 'password'))
+        self.assertEqual(res.status_code, 200)
+        try:
+            resp_data = json.loads(res.data)
+        except json.decoder.JSONDecodeError as exc:
+            self.fail('Received invalid json from {}: {}'.format(url, exc))
+        return sorted(resp_data.get('_items'), key=lambda item: item.get('_id'))
+
+    def assert_engines_equivalent(self, url):
+        for username in self.usernames:
+            legacy = self.get_items('legacy', username, url)
+            single_pass = self.get_items('single_pass', username, url)
+            self.assertEqual(legacy, single_pass, 'Engines disagree on {} for user {}'.format(url, username))
+
+    def test_fees_equivalent(self):
+        """Test that both engines return the same documents from /fees for every fixture user."""
+        self.assert_engines_equivalent('/fees')
+
+    def test_fees_nested_equivalent(self):
+        """Test that both engines return the same documents, with nested fields redacted, from /fees_nested."""
+        self.assert_engines_equivalent('/fees_nested')
+
+    def test_single_id_equivalent(self):
+        """Test that both engines agree for single-document reads."""
+        items = self.get_items('legacy', 'us_topsecret_cumul', '/fees')
+        for item in items[:5]:
+            self.assert_engines_equivalent('/fees?aggregate={"$id":"' + str(item.get('_id')) + '"}')
+
+    def test_prefilter_equivalent(self):
+        """Test that the security prefilter $match doesn't change what either engine returns."""
+        for username in self.usernames:
+            for engine in ['legacy', 'single_pass']:
+                self.assertEqual(self.get_items(engine, username, '/fees'),
+                                 self.get_items(engine, username, '/fees', prefilter="True"),
+                                 'Prefilter changed {} results for user {}'.format(engine, username))
+
+    def test_unlabelled_secured_field_equivalent(self):
+        """Test that both engines remove a field the schema declares as secured when it has no _sec label."""
+        client = MongoClient(MONGO_HOST, 27017)
+        coll = client[MONGO_DBNAME]['fees_nested']
+        result = coll.insert_many([
+            {"FeeType": "unlabelled", "FeeID": {"value": "1"}, "_sec": {"cat": "usg_unclassified", "diss": []}},
+            {"FeeType": "unlabelled", "_sec": {"cat": "usg_unclassified", "diss": []}},
+            {"FeeType": "unlabelled", "FeeID": {"value": "2", "_sec": {"cat": "usg_unclassified", "diss": []}},
+             "_sec": {"cat": "usg_unclassified", "diss": []}}
+        ])
+        try:
+            self.assert_engines_equivalent('/fees_nested')
+            items = [item for item in self.get_items('single_pass', 'us_topsecret_cumul', '/fees_nested')
+                     if item.get('FeeType') == 'unlabelled']
+            self.assertEqual([item.get('FeeID', {}).get('value') for item in items], [None, None, '2'])
+        finally:
+            coll.delete_many({"_id": {"$in": result.inserted_ids}})
+            client.close()
@@ -0,0 +1,46 @@
+import unittest
+import json
+import pytest
+
+from streaming import stream_resource
+from .fixtures.apps import RedactionAppMixin, make_headers, populate_fees, populate_users
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_db():
+    populate_fees()
+    populate_users()
+
+
+class StreamingTestCase(RedactionAppMixin, unittest.TestCase):
+    def setUp(self):
+        """Use the same app, schema and fixtures as test_redaction, with the streaming endpoint added."""
+        RedactionAppMixin.setUp(self)
+        self.app.add_url_rule('/<resource>/stream', 'stream_resource', stream_resource, methods=['GET'])
+        self.app.config['STREAM_BATCH_SIZE'] = 7
+
+    def get_items(self, url, headers):
+        res = self.client.get(url, headers=headers)
+        self.assertEqual(res.status_code, 200)
+        try:
+            return json.loads(res.data).get('_items')
+        except json.decoder.JSONDecodeError as exc:
+            self.fail('Received invalid json from {}: {}'.format(url, exc))
+
+    def test_stream_matches_read(self):
+        """Test that a streamed read returns the same redacted documents as a normal read."""
+        for username in ['us_unclassified_only', 'us_secret_cumul', 'can_topsecret_cumul']:
+            headers = make_headers(username, 'password')
+            self.assertEqual(self.get_items('/fees/stream', headers), self.get_items('/fees', headers))
+
+    def test_stream_single_id(self):
+        """Test that the aggregate parameter selects a single document when streaming."""
+        headers = make_headers('us_topsecret_cumul', 'password')
+        oid = self.get_items('/fees', headers)[0].get('_id')
+        items = self.get_items('/fees/stream?aggregate={"$id":"' + str(oid) + '"}', headers)
+        self.assertEqual([item.get('_id') for item in items], [oid])
+
+    def test_stream_unknown_resource(self):
+        """Test that only readable resources can be streamed."""
+        res = self.client.get('/fees_write/stream', headers=make_headers('us_topsecret_cumul', 'password'))
+        self.assertEqual(res.status_code, 404)
@@ -1,9 +1,9 @@
-import json
-from pymongo import MongoClient
 from bson import ObjectId
 from aggregators import redact_field
 from flask import g, current_app, abort
-from schema import get_security_enabled_fields
+from schema import get_security_descriptor
+from mongo import get_db
+from request_body import request_body
 
 
 def check_perms_in_db(resource, request, lookup):
@@ -15,7 +15,8 @@ def check_perms_in_db(resource, request, lookup):
     current_app.logger.info('Checking permissions for user {} to update {} object.'.format(g.user, rsc))
     oid = request.url.split('{}/'.format(resource))[1]
 
-    sec_enabled_fields = get_security_enabled_fields(rsc)
+    # Array fields can't be checked per element with $addFields, so only non-array fields are compared here
+    sec_enabled_fields = get_security_descriptor(rsc).field_paths(include_arrays=False)
 
     # Build pipeline to return whether user has permission to modify security-enabled fields
     pipeline, updates = make_perm_check_pipeline(oid, sec_enabled_fields, request)
@@ -51,7 +52,7 @@ def make_perm_check_pipeline(oid, sec_enabled_fields, request):
     # Add pipeline stage to evaluate whether data in database is allowed based on user context
     if request.method == 'PATCH':
         # Only consider security-enabled fields being updated by this request
-        updates = json.loads(request.data)
+        updates = request_body()
         for key in updates.keys():
             if key in sec_enabled_fields:
                 pipeline = redact_field(key, pipeline)
@@ -66,7 +67,7 @@ def make_perm_check_pipeline(oid, sec_enabled_fields, request):
 
 def perform_perm_check_aggregation(rsc, pipeline):
     # Get object from DB, confirm user has permissions to update the fields in the PATCH
-    coll = MongoClient(current_app.config.get('MONGO_HOST'), 27017)[current_app.config.get('MONGO_DBNAME')][rsc]
+    coll = get_db()[rsc]
 
     agg_result = list(coll.aggregate(pipeline))
     if len(agg_result) > 0:
@@ -77,13 +78,48 @@ def perform_perm_check_aggregation(rsc, pipeline):
 
 
 def abort_request_if_insufficient_perms(key, agg_result, rsc):
-    val = agg_result.get(key)
+    if not has_field_perms(key, agg_result):
+        current_app.logger.info('User {} has insufficient permissions to modify data in the {} object'.format(
+            g.user, rsc))
+        abort(403)
+
+
+def has_doc_perms(agg_result):
+    """Whether the perm check aggregation result allows the user to modify the document."""
+    return "false" not in agg_result.get('cat_matches', []) and "false" not in agg_result.get('diss_matches', [])
+
+
+def has_field_perms(key, agg_result):
+    """Whether the perm check aggregation result allows the user to modify the security-enabled field at key."""
+    val = agg_result
+    for part in key.split('.'):
+        val = val.get(part) if type(val) == dict else None
     if type(val) == dict:
-        if "false" in val.get('cat_matches', []):
-            current_app.logger.info('User {} has insufficient permissions to modify data in the {} object'.format(
-                g.user, rsc))
-            abort(403)
-        if "false" in val.get('diss_matches', []):
-            current_app.logger.info('User {} has insufficient permissions to modify data in the {} object'.format(
-                g.user, rsc))
-            abort(403)
+        return has_doc_perms(val)
+    return True
+
+
+def make_batch_perm_check_pipeline(oids, sec_enabled_fields):
+    """Like make_perm_check_pipeline, for all of the documents in oids at once."""
+    return make_match_perm_check_pipeline({"_id": {"$in": list(oids)}}, sec_enabled_fields)
+
+
+def make_match_perm_check_pipeline(match, sec_enabled_fields):
+    """Like make_perm_check_pipeline, for the documents matching a query."""
+    pipeline = [{"$match": match}]
+    pipeline = redact_field('', pipeline)
+    for key in sec_enabled_fields:
+        pipeline = redact_field(key, pipeline)
+    return pipeline
+
+
+def strip_perm_check_fields(agg_result, sec_enabled_fields):
+    """Remove the fields added by the perm check pipeline, leaving the document as it is stored."""
+    for path in ('',) + tuple(sec_enabled_fields):
+        val = agg_result
+        for part in path.split('.') if path else []:
+            val = val.get(part) if type(val) == dict else None
+        if type(val) == dict:
+            val.pop('cat_matches', None)
+            val.pop('diss_matches', None)
+    return agg_result
@@ -0,0 +1,249 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from pymongo.errors import OperationFailure, PyMongoError
+from mongo import get_db
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+class UserContext(dict):
+    """
+    A user's permissions document, with its labels precomputed when it is loaded: `cat` and `diss` as tuples of label
+    strings (for aggregation pipelines) and `labels`, the frozenset of both (for the write checks in auth.py). Cached
+    contexts are shared by every request for the user, so they must not be modified.
+    """
+
+    def __init__(self, user):
+        super(UserContext, self).__init__(user)
+        self.cat = tuple(str(label) for label in user.get('cat') or [])
+        self.diss = tuple(str(label) for label in user.get('diss') or [])
+        self.labels = frozenset(self.cat + self.diss)
+
+
+class UserContextCache(object):
+    """
+    Bounded, LRU-evicted, TTL-limited cache of user security contexts (the `cat` and `diss` lists from
+    charon_user_permissions), keyed by username.
+
+    Each username has a generation, bumped whenever its entry is invalidated (and all of them by clear). A loader
+    takes the generation before reading the database and passes it to put, so a context read before an invalidation
+    is never cached after it.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self._generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, username):
+        """Return the cached user document for username, or None if it is missing or expired."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._entries[username]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(username)
+            self.hits += 1
+            return entry[1]
+
+    def generation(self, username):
+        with self._lock:
+            return self._epoch, self._generations.get(username, 0)
+
+    def put(self, username, user, generation=None):
+        """Cache a user document, unless the entry was invalidated since `generation` was taken."""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != (self._epoch, self._generations.get(username, 0)):
+                return
+            self._entries[username] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, username=None, user_id=None):
+        """Drop the entry for a username and/or any entry that was loaded from the document with user_id."""
+        with self._lock:
+            matched = False
+            for key in list(self._entries.keys()):
+                user = self._entries[key][1]
+                if key == username or (user_id is not None and user.get('_id') == user_id):
+                    del self._entries[key]
+                    self._bump(key)
+                    self.invalidations += 1
+                    matched = True
+            if username is not None:
+                self._bump(username)
+            elif not matched:
+                # The user isn't known (e.g. a delete event); a load of it may be in flight
+                self._bump_all()
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._bump_all()
+
+    def snapshot(self):
+        """The cached user documents by username."""
+        with self._lock:
+            return dict((key, entry[1]) for key, entry in self._entries.items())
+
+    def _bump(self, username):
+        self._generations[username] = self._generations.get(username, 0) + 1
+        if len(self._generations) > max(self.max_size, 1) * 4:
+            self._bump_all()
+
+    def _bump_all(self):
+        self._epoch += 1
+        self._generations.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+def get_user_context_cache():
+    """
+    Return this worker's user context cache, creating it (and starting the change stream watcher, if enabled) on
+    first use after fork.
+    """
+    global _cache, _cache_pid
+
+    pid = os.getpid()
+    if _cache is not None and _cache_pid == pid:
+        return _cache
+
+    with _cache_lock:
+        if _cache is None or _cache_pid != pid:
+            config = current_app.config
+            _cache = UserContextCache(int(config.get('USER_CONTEXT_CACHE_SIZE', 1000)),
+                                      float(config.get('USER_CONTEXT_CACHE_TTL', 30)))
+            _cache_pid = pid
+            if _cache.max_size > 0 and config.get('USER_CONTEXT_CACHE_WATCH') == "True":
+                start_watcher(current_app._get_current_object(), _cache)
+    return _cache
+
+
+def load_user(username):
+    """
+    Get the UserContext (permissions document) for a user, from the cache if possible. Raises IndexError if not found.
+    """
+    cache = get_user_context_cache()
+    user = cache.get(username)
+    if user is None:
+        generation = cache.generation(username)
+        user = UserContext(permissions_collection().find({'username': username})[0])
+        cache.put(username, user, generation)
+    return user
+
+
+def permissions_collection(config=None):
+    config = config or current_app.config
+    return get_db(config.get('USER_PERMISSIONS_DB', 'admin'), config=config)['charon_user_permissions']
+
+
+def start_watcher(app, cache):
+    thread = threading.Thread(target=watch_user_permissions, args=(app, cache), name='charon-user-context-watcher')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def watch_user_permissions(app, cache):
+    """
+    Invalidate cached contexts for users whose permissions change, so revocations apply without waiting for the TTL.
+
+    Follows the change stream on charon_user_permissions where Mongo allows one. Change streams need a replica set
+    and aren't allowed on the admin, local and config databases, so otherwise the cached users are polled instead
+    (see poll_user_permissions).
+    """
+    if app.config.get('USER_PERMISSIONS_DB', 'admin') in ('admin', 'local', 'config'):
+        return poll_user_permissions(app, cache)
+
+    backoff = 1
+    while True:
+        try:
+            coll = permissions_collection(app.config)
+            with coll.watch(full_document='updateLookup') as stream:
+                # Anything could have changed while the stream was not open
+                cache.clear()
+                backoff = 1
+                for change in stream:
+                    handle_user_change(cache, change)
+        except OperationFailure as exc:
+            app.logger.warning('User context change stream unavailable, polling instead: {}'.format(exc))
+            return poll_user_permissions(app, cache)
+        except PyMongoError as exc:
+            app.logger.error('User context change stream failed, retrying in {}s: {}'.format(backoff, exc))
+            cache.clear()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+
+def poll_user_permissions(app, cache):
+    """
+    Every USER_CONTEXT_CACHE_POLL_INTERVAL seconds, read the permissions of the cached users with one query and
+    invalidate those that changed or were deleted.
+    """
+    interval = float(app.config.get('USER_CONTEXT_CACHE_POLL_INTERVAL', 5))
+    while True:
+        time.sleep(interval)
+        try:
+            check_cached_users(cache, permissions_collection(app.config))
+        except PyMongoError as exc:
+            app.logger.error('Polling user contexts failed, clearing the cache: {}'.format(exc))
+            cache.clear()
+
+
+def check_cached_users(cache, coll):
+    """Invalidate the cached users whose permissions document changed or no longer exists."""
+    cached = cache.snapshot()
+    if not cached:
+        return
+    current = dict((user.get('username'), user) for user in coll.find({'username': {'$in': list(cached)}}))
+    for username, user in cached.items():
+        if dict(user) != current.get(username):
+            cache.invalidate(username=username)
+
+
+def handle_user_change(cache, change):
+    """Invalidate the cache entries affected by one change stream event."""
+    if change.get('operationType') in ('drop', 'dropDatabase', 'rename', 'invalidate'):
+        cache.clear()
+        return
+    user_id = change.get('documentKey', {}).get('_id')
+    username = (change.get('fullDocument') or {}).get('username')
+    cache.invalidate(username=username, user_id=user_id)
+
+
+def cache_stats():
+    if _cache is None or _cache_pid != os.getpid():
+        return {}
+    return _cache.stats()